@@ -0,0 +1,144 @@
+"""Request size and CPU per `/agent/chat` turn, the client resending the
+conversation against a server side session.
+
+Holds a `--turns` long conversation through the agent router in process,
+the Responses API mock in a subprocess, once sending the growing
+`chat_history` on every turn and once with `server_history`, the query
+only. Reports the request body size and the CPU time of this process, the
+client and the API, per turn at a few points of the conversation. Turns
+are sent one at a time so the CPU time is the turn's own.
+
+Needs the Postgres database from `.env`, the session user and its messages
+are deleted at the end.
+
+    python -m benchmarks.chat_sessions --turns 60
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+from benchmarks.mock_services import MockSettings, free_port, settings_arguments
+
+# Before anything imports `src.config`
+OPENAI_PORT = free_port()
+os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{OPENAI_PORT}/v1"
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("SERVER_API_KEY", "benchmark")
+os.environ["GUARDRAIL_PRE_CLASSIFIER"] = "none"
+os.environ["GUARDRAIL_CACHE"] = "false"
+# Summaries would add model calls to some turns only
+os.environ["CONTEXT_SUMMARIES"] = "false"
+
+import httpx  # noqa: E402
+from fastapi import FastAPI  # noqa: E402
+from sqlalchemy import delete, func, select  # noqa: E402
+
+from benchmarks.load_test import start, stop, wait_until_up  # noqa: E402
+
+from src.cache.conversation import conversation_cache  # noqa: E402
+from src.database.database import AsyncSessionLocal, init_db  # noqa: E402
+from src.database.message_writer import message_writer  # noqa: E402
+from src.models.message import Message  # noqa: E402
+from src.models.usage import UsageRollup  # noqa: E402
+from src.models.user import User  # noqa: E402
+from src.routes.agent import router as agent_router  # noqa: E402
+from src.utils.usage import usage_ledger  # noqa: E402
+from src import config  # noqa: E402
+
+BENCH_CHAT_ID = "9300000777"
+QUERIES = [
+    "I have been feeling anxious before my exams and I can't sleep well.",
+    "It gets worse at night, my thoughts keep racing about everything I have to do.",
+    "I tried the breathing exercise but I still feel tense the next morning.",
+    "Sometimes I feel like I'm falling behind everyone else in my class.",
+]
+
+
+async def conversation(client: httpx.AsyncClient, turns: int, server_history: bool):
+    url = f"/api/{config.API_VERSION}/agent/chat"
+    headers = {"Authorization": f"Bearer {config.SERVER_API_KEY}"}
+    history = []
+    sizes, cpu_ms = [], []
+    for turn in range(turns):
+        body = {"query": QUERIES[turn % len(QUERIES)], "user_id": BENCH_CHAT_ID}
+        if server_history:
+            body["server_history"] = True
+        else:
+            body["chat_history"] = history
+        content = json.dumps(body).encode()
+        started_at = time.process_time()
+        answer = []
+        async with client.stream("POST", url, content=content, headers=headers) as response:
+            async for line in response.aiter_lines():
+                if line:
+                    event = json.loads(line)
+                    if event.get("type") == "answer":
+                        answer.append(event["content"])
+        cpu_ms.append((time.process_time() - started_at) * 1000)
+        sizes.append(len(content))
+        history.append({"query": body["query"], "response": "".join(answer)})
+    return sizes, cpu_ms
+
+
+def report(name: str, sizes, cpu_ms, points) -> None:
+    print(name)
+    for point in points:
+        # Median CPU of the few turns around the point, one turn is noisy
+        window = cpu_ms[max(point - 3, 0) : point]
+        print(
+            f"  turn {point:4d} request {sizes[point - 1]:7d} bytes "
+            f"CPU {statistics.median(window):7.2f} ms/turn"
+        )
+
+
+async def main(turns: int) -> None:
+    await init_db()
+    async with AsyncSessionLocal() as session:
+        session.add(User(first_name="Session", chat_id=BENCH_CHAT_ID, is_verified=True, age=30, gender="Other"))
+        await session.commit()
+    settings = MockSettings(latency=0.02, deltas=40, delta_interval=0)
+    mocks = start(
+        [sys.executable, "-m", "benchmarks.mock_services", "--openai-port", str(OPENAI_PORT),
+         "--telegram-port", str(free_port())] + settings_arguments(settings),
+        dict(os.environ),
+    )
+    app = FastAPI()
+    app.include_router(agent_router)
+    points = sorted({1, 5, 10, 20, 40, 80, turns} & set(range(1, turns + 1)))
+    try:
+        await wait_until_up(f"http://127.0.0.1:{OPENAI_PORT}/v1/responses", mocks)
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app), base_url="http://bench", timeout=60
+        ) as client:
+            # Imports and clients of the first request are not a turn's cost
+            await conversation(client, 1, False)
+            report("client sends chat_history", *await conversation(client, turns, False), points)
+            conversation_cache.invalidate(BENCH_CHAT_ID)
+            report("server_history session", *await conversation(client, turns, True), points)
+        # Flush the session turns to count them
+        await message_writer.stop()
+        async with AsyncSessionLocal() as session:
+            stored = await session.scalar(
+                select(func.count()).select_from(Message).filter(Message.chat_id == BENCH_CHAT_ID)
+            )
+        print(f"{stored} session turns stored as messages")
+    finally:
+        stop(mocks)
+        await message_writer.stop()
+        await usage_ledger.stop()
+        async with AsyncSessionLocal() as session:
+            for model in (Message, UsageRollup, User):
+                await session.execute(delete(model).filter(model.chat_id == BENCH_CHAT_ID))
+            await session.commit()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=60)
+    args = parser.parse_args()
+    asyncio.run(main(args.turns))
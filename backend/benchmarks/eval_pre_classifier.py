@@ -0,0 +1,95 @@
+"""Offline evaluation of the guardrail pre classifier.
+
+Compares the local verdicts with the labels of a JSONL sample
+(`{"text": ..., "is_mental_health": ...}`) and, with `--llm`, with the LLM
+guardrail itself, which costs one OpenAI call per sample line.
+
+    python -m benchmarks.eval_pre_classifier --threshold 0.9 --llm
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from pathlib import Path
+
+from agents import Runner
+
+from src.agents.guard_rail import GuardrailCheckOutput, guardrail_agent
+from src.agents.pre_classifier import load_pre_classifier
+from src import config
+
+DEFAULT_SAMPLE = Path(__file__).parent / "data" / "guardrail_sample.jsonl"
+
+
+async def llm_verdict(text: str):
+    started_at = time.perf_counter()
+    result = await Runner.run(
+        starting_agent=guardrail_agent, input=[{"role": "user", "content": text}]
+    )
+    elapsed = time.perf_counter() - started_at
+    return result.final_output_as(GuardrailCheckOutput).is_mental_health, elapsed
+
+
+async def main(args):
+    classifier = load_pre_classifier(args.classifier)
+    samples = [json.loads(line) for line in open(args.sample) if line.strip()]
+
+    decided = 0
+    label_agreement = 0
+    llm_agreement = 0
+    local_timings = []
+    llm_timings = []
+
+    for sample in samples:
+        started_at = time.perf_counter()
+        result = classifier.classify(sample["text"])
+        local_timings.append(time.perf_counter() - started_at)
+        if result is not None and result.confidence < args.threshold:
+            result = None
+
+        llm_label = None
+        if args.llm:
+            llm_label, elapsed = await llm_verdict(sample["text"])
+            llm_timings.append(elapsed)
+
+        if result is None:
+            continue
+        decided += 1
+        label_agreement += result.is_mental_health == sample["is_mental_health"]
+        if llm_label is not None:
+            llm_agreement += result.is_mental_health == llm_label
+        elif result.is_mental_health != sample["is_mental_health"]:
+            print(f"disagrees with label: {sample['text']!r}")
+
+    report = {
+        "classifier": args.classifier,
+        "threshold": args.threshold,
+        "samples": len(samples),
+        "decided_locally": decided,
+        "coverage": round(decided / len(samples), 4),
+        "label_agreement": round(label_agreement / decided, 4) if decided else None,
+        "local_p50_us": round(statistics.median(local_timings) * 1e6, 2),
+    }
+    if args.llm:
+        llm_avg = statistics.mean(llm_timings)
+        report["llm_agreement"] = round(llm_agreement / decided, 4) if decided else None
+        report["llm_avg_ms"] = round(llm_avg * 1000, 2)
+        # Every locally decided message skips one guardrail round trip
+        report["latency_saved_ms_per_message"] = round(
+            llm_avg * 1000 * decided / len(samples), 2
+        )
+        report["llm_model"] = config.OPENAI_GUARDRAIL_MODEL
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sample", default=str(DEFAULT_SAMPLE))
+    parser.add_argument("--classifier", default=config.GUARDRAIL_PRE_CLASSIFIER)
+    parser.add_argument(
+        "--threshold", type=float, default=config.GUARDRAIL_PRE_CLASSIFIER_THRESHOLD
+    )
+    parser.add_argument("--llm", action="store_true", help="Compare with the LLM guardrail")
+    asyncio.run(main(parser.parse_args()))
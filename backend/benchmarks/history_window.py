@@ -0,0 +1,99 @@
+"""Latency of the Telegram history window query as one chat grows.
+
+Needs the Postgres database from `.env`, it creates a throwaway user and
+deletes it at the end.
+
+    python -m benchmarks.history_window --sizes 1000 10000 100000
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, insert, select, asc, text
+
+from src.database.database import AsyncSessionLocal, init_db
+from src.models.message import Message
+from src.models.user import User
+from src.utils.history import fetch_history_window
+from src import config
+
+BENCH_CHAT_ID = "benchmark-history-window"
+
+
+async def insert_messages(start: int, stop: int) -> None:
+    base = datetime(2024, 1, 1)
+    async with AsyncSessionLocal() as session:
+        for offset in range(start, stop, 5000):
+            rows = [
+                {
+                    "query": f"query {i}",
+                    "response": f"response {i}",
+                    "chat_id": BENCH_CHAT_ID,
+                    "created_at": base + timedelta(seconds=i),
+                    "is_deleted": False,
+                }
+                for i in range(offset, min(offset + 5000, stop))
+            ]
+            await session.execute(insert(Message), rows)
+        await session.commit()
+
+
+async def time_query(statement_factory, iterations: int) -> float:
+    timings = []
+    async with AsyncSessionLocal() as session:
+        for _ in range(iterations):
+            started_at = time.perf_counter()
+            await statement_factory(session)
+            timings.append((time.perf_counter() - started_at) * 1000)
+    return statistics.median(timings)
+
+
+async def oldest_rows(session):
+    # The query the webhook used to run
+    result = await session.execute(
+        select(Message)
+        .filter(Message.chat_id == BENCH_CHAT_ID, Message.is_deleted.is_(False))
+        .order_by(asc(Message.created_at))
+        .limit(config.HISTORY_TURNS)
+    )
+    return result.scalars().all()
+
+
+async def latest_window(session):
+    return await fetch_history_window(db=session, chat_id=BENCH_CHAT_ID)
+
+
+async def main(sizes, iterations):
+    await init_db()
+    async with AsyncSessionLocal() as session:
+        session.add(User(first_name="Benchmark", chat_id=BENCH_CHAT_ID))
+        await session.commit()
+
+    try:
+        inserted = 0
+        print(f"{'messages':>10} {'latest window ms':>18} {'old query ms':>14}")
+        for size in sorted(sizes):
+            await insert_messages(inserted, size)
+            inserted = size
+            async with AsyncSessionLocal() as session:
+                await session.execute(text("ANALYZE messages"))
+                await session.commit()
+            latest_ms = await time_query(latest_window, iterations)
+            oldest_ms = await time_query(oldest_rows, iterations)
+            print(f"{size:>10} {latest_ms:>18.3f} {oldest_ms:>14.3f}")
+    finally:
+        async with AsyncSessionLocal() as session:
+            await session.execute(delete(Message).filter(Message.chat_id == BENCH_CHAT_ID))
+            await session.execute(delete(User).filter(User.chat_id == BENCH_CHAT_ID))
+            await session.commit()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--iterations", type=int, default=50)
+    args = parser.parse_args()
+    asyncio.run(main(args.sizes, args.iterations))
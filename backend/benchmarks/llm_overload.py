@@ -0,0 +1,113 @@
+"""Model calls under 10x overload, with and without the managed client.
+
+The Responses API mock serves `--capacity` requests at once and answers the
+others with a 429 and `retry-after`, like a rate limit. `--overload` times
+that many calls are started together through:
+
+- a plain `AsyncOpenAI` client, the SDK retrying twice on its own
+- the managed client limited to the capacity, calls queue for a slot
+- the managed client limited to twice the capacity, the calls over it are
+  retried with jittered backoff after the `retry-after`
+
+and for each the calls that succeeded, the 429s the mock sent and the call
+latency.
+
+    python -m benchmarks.llm_overload --capacity 8 --overload 10
+"""
+
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import time
+
+import uvicorn
+from openai import AsyncOpenAI
+
+from benchmarks.mock_services import MockOpenAI, MockSettings
+from src.utils.llm import AsyncResponses, LLMLimits
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+async def timed_call(create, index: int):
+    started_at = time.perf_counter()
+    try:
+        await create(model="gpt-4o-mini", input=f"How do I sleep better? ({index})")
+        return time.perf_counter() - started_at, None
+    except Exception as e:
+        return time.perf_counter() - started_at, type(e).__name__
+
+
+async def run(name: str, create, mock: MockOpenAI, calls: int) -> None:
+    requests, rejected = mock.requests, mock.rejected
+    mock.peak_in_flight = 0
+    started_at = time.perf_counter()
+    results = await asyncio.gather(*(timed_call(create, i) for i in range(calls)))
+    seconds = time.perf_counter() - started_at
+    latencies = [latency * 1000 for latency, error in results if error is None]
+    errors = [error for _, error in results if error is not None]
+    line = (
+        f"{name:34} {len(latencies):4d}/{calls} ok {seconds:6.2f} s | "
+        f"{mock.requests - requests:4d} requests {mock.rejected - rejected:4d} 429s "
+        f"peak {mock.peak_in_flight:3d} in flight"
+    )
+    if latencies:
+        line += f" | p50 {statistics.median(latencies):7.0f} ms p99 {percentile(latencies, 0.99):7.0f} ms"
+    if errors:
+        line += f" | failed: {', '.join(sorted(set(errors)))}"
+    print(line)
+
+
+async def main(capacity: int, overload: int, latency: float, retry_after: float) -> None:
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}/v1"
+    settings = MockSettings(
+        latency=latency, deltas=5, delta_interval=0, max_concurrency=capacity, retry_after=retry_after
+    )
+    mock = MockOpenAI(settings)
+    server = uvicorn.Server(
+        uvicorn.Config(mock.app(), host="127.0.0.1", port=port, log_level="warning")
+    )
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+
+    api_key = os.getenv("OPENAI_API_KEY") or "benchmark"
+    calls = capacity * overload
+    print(
+        f"{calls} concurrent calls against a capacity of {capacity}, "
+        f"{latency}s per call, retry-after {retry_after}s\n"
+    )
+    try:
+        plain = AsyncOpenAI(api_key=api_key, base_url=base_url)
+        await run("plain client, SDK retries", plain.responses.create, mock, calls)
+        await plain.close()
+        for limit in (capacity, capacity * 2):
+            client = AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0)
+            responses = AsyncResponses(client, LLMLimits(limit, {}), deadline=120)
+            await run(f"managed client, limit {limit}", responses.create, mock, calls)
+            await client.close()
+    finally:
+        server.should_exit = True
+        await server_task
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--capacity", type=int, default=8, help="Requests the mock serves at once")
+    parser.add_argument("--overload", type=int, default=10, help="Calls per unit of capacity")
+    parser.add_argument("--latency", type=float, default=0.2, help="Mock seconds per call")
+    parser.add_argument("--retry-after", type=float, default=0.5)
+    args = parser.parse_args()
+    asyncio.run(main(args.capacity, args.overload, args.latency, args.retry_after))
@@ -0,0 +1,373 @@
+"""Load test of `/agent/chat` and the Telegram webhook and worker, against
+the local OpenAI and Bot API mocks of `benchmarks.mock_services`.
+
+Starts the mocks and the API (`src.main:app` under uvicorn) as subprocesses,
+the API pointed at the mocks through `OPENAI_BASE_URL` and `TELEGRAM_API_URL`,
+then sends `--requests` requests per scenario with `--concurrency` in flight:
+
+- `chat`: streamed `POST /agent/chat`, TTFB is the first NDJSON line
+- `webhook`: `POST /telegram/webhook` from registered chats, `--burst`
+  messages in a row per chat, the worker latency is the time from the
+  chat's first message until the mock Bot API gets its first `sendMessage`
+
+Throughput, TTFB and p50/p95/p99 latency, plus the RSS of the API process,
+are written as JSON to `--output` so runs can be compared between releases.
+The API runs the in process async worker unless `TG_WORKER_BACKEND` is set,
+and every guardrail verdict goes to the mock LLM unless the guardrail
+settings are set.
+
+Needs the Postgres database from `.env`, it creates throwaway users and
+deletes them and their messages at the end.
+
+    python -m benchmarks.load_test --requests 200 --concurrency 20
+    python -m benchmarks.load_test --scenario chat --latency 1.5 --off-topic-ratio 0.2
+    python -m benchmarks.load_test --scenario webhook --burst 3
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import httpx
+from sqlalchemy import delete, insert
+
+from benchmarks.mock_services import (
+    OFF_TOPIC_MARKER,
+    add_settings_arguments,
+    free_port,
+    settings_arguments,
+    settings_from,
+)
+from src.database.database import AsyncSessionLocal, init_db
+from src.models.chat_summary import ChatSummary
+from src.models.message import Message
+from src.models.telegram_update import TelegramUpdate
+from src.models.usage import UsageRollup
+from src.models.user import User
+from src import config
+
+# Sent by the scenarios and given to the servers they start
+API_KEY = config.SERVER_API_KEY or "benchmark"
+
+BENCH_CHAT_ID_BASE = 9_300_000_000
+# Unique per run, the API drops update ids it has seen
+UPDATE_ID_BASE = int(time.time() * 1000) * 10_000
+SCENARIOS = ("chat", "webhook")
+
+
+def percentile(samples: List[float], fraction: float) -> Optional[float]:
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return round(samples[min(int(len(samples) * fraction), len(samples) - 1)], 2)
+
+
+def summarize(samples: List[float]) -> Dict[str, Optional[float]]:
+    return {
+        "p50": percentile(samples, 0.5),
+        "p95": percentile(samples, 0.95),
+        "p99": percentile(samples, 0.99),
+        "max": round(max(samples), 2) if samples else None,
+    }
+
+
+def process_memory_mb(pid: int) -> Dict[str, Optional[float]]:
+    """Current and peak RSS, from /proc so only on Linux."""
+    memory: Dict[str, Optional[float]] = {"rss_mb": None, "peak_rss_mb": None}
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    memory["rss_mb"] = round(int(line.split()[1]) / 1024, 1)
+                elif line.startswith("VmHWM:"):
+                    memory["peak_rss_mb"] = round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return memory
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def wait_until_up(url: str, process: subprocess.Popen, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"{process.args} exited with {process.returncode}")
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up in {timeout}s")
+
+
+async def run_requests(requests: int, concurrency: int, send) -> float:
+    """Run `send(i)` for every request, `concurrency` at a time, returns the elapsed seconds."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(i: int):
+        async with semaphore:
+            await send(i)
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(bounded(i) for i in range(requests)))
+    return time.perf_counter() - started_at
+
+
+async def chat_scenario(base_url: str, args) -> Dict[str, Any]:
+    url = f"{base_url}/api/{config.API_VERSION}/agent/chat"
+    headers = {"Authorization": f"Bearer {API_KEY}"}
+    off_topic_every = round(1 / args.off_topic_ratio) if args.off_topic_ratio > 0 else 0
+    ttfb, latency = [], []
+    errors = 0
+
+    async def send(i: int):
+        nonlocal errors
+        query = "I feel anxious before my exams"
+        if off_topic_every and i % off_topic_every == 0:
+            query = f"{OFF_TOPIC_MARKER} Write me a poem about databases"
+        body = {"query": query, "user_id": str(BENCH_CHAT_ID_BASE + i), "chat_history": []}
+        started_at = time.perf_counter()
+        first_line_at = None
+        try:
+            async with client.stream("POST", url, json=body, headers=headers) as response:
+                async for line in response.aiter_lines():
+                    if first_line_at is None and line:
+                        first_line_at = time.perf_counter()
+                if response.status_code != 200:
+                    errors += 1
+                    return
+        except httpx.HTTPError:
+            errors += 1
+            return
+        latency.append((time.perf_counter() - started_at) * 1000)
+        if first_line_at is not None:
+            ttfb.append((first_line_at - started_at) * 1000)
+
+    async with httpx.AsyncClient(timeout=120, limits=httpx.Limits(max_connections=None)) as client:
+        elapsed = await run_requests(args.requests, args.concurrency, send)
+
+    return {
+        "requests": args.requests,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 2),
+        "throughput_rps": round(args.requests / elapsed, 2),
+        "ttfb_ms": summarize(ttfb),
+        "latency_ms": summarize(latency),
+    }
+
+
+async def webhook_scenario(base_url: str, telegram_url: str, args) -> Dict[str, Any]:
+    url = f"{base_url}/api/{config.API_VERSION}/telegram/webhook"
+    posted_at: Dict[str, float] = {}
+    latency = []
+    errors = 0
+
+    async def send(i: int):
+        nonlocal errors
+        chat_id = BENCH_CHAT_ID_BASE + i // args.burst
+        update = {
+            "update_id": UPDATE_ID_BASE + i,
+            "message": {
+                "message_id": i,
+                "from": {"id": chat_id, "is_bot": False, "first_name": "Load"},
+                "chat": {"id": chat_id, "type": "private"},
+                "date": int(time.time()),
+                "text": "I feel anxious before my exams",
+            },
+        }
+        posted_at.setdefault(str(chat_id), time.time())
+        started_at = time.perf_counter()
+        try:
+            response = await client.post(url, json=update)
+        except httpx.HTTPError:
+            errors += 1
+            return
+        if response.status_code != 200:
+            errors += 1
+            return
+        latency.append((time.perf_counter() - started_at) * 1000)
+
+    async with httpx.AsyncClient(timeout=120, limits=httpx.Limits(max_connections=None)) as client:
+        await client.post(f"{telegram_url}/_mock/reset")
+        elapsed = await run_requests(args.requests, args.concurrency, send)
+
+        # The worker keeps going after the webhook answered, wait until every
+        # chat got a reply and no more replies come in
+        delivered: Dict[str, float] = {}
+        replies: List[Dict[str, Any]] = []
+        deadline = time.monotonic() + args.worker_timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(1)
+            calls = (await client.get(f"{telegram_url}/_mock/calls")).json()["calls"]
+            settled = len(delivered) == len(posted_at)
+            previous_replies = len(replies)
+            replies = [
+                call for call in calls if call["method"] == "sendMessage" and call["chat_id"] in posted_at
+            ]
+            for call in replies:
+                delivered.setdefault(call["chat_id"], call["at"])
+            if settled and len(replies) == previous_replies:
+                break
+        coalescing = (
+            await client.get(
+                f"{base_url}/api/{config.API_VERSION}/telegram/coalescing",
+                headers={"Authorization": f"Bearer {API_KEY}"},
+            )
+        ).json()
+
+    worker_latency = [(at - posted_at[chat_id]) * 1000 for chat_id, at in delivered.items()]
+    worker_elapsed = max(delivered.values()) - min(posted_at.values()) if delivered else 0
+    return {
+        "requests": args.requests,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 2),
+        "throughput_rps": round(args.requests / elapsed, 2),
+        "latency_ms": summarize(latency),
+        "worker": {
+            "chats": len(posted_at),
+            "delivered": len(delivered),
+            "replies": len(replies),
+            "coalesced_messages": coalescing["messages"] - coalescing["turns"],
+            "saved_tokens": coalescing["saved_tokens"],
+            "delivered_rps": round(len(delivered) / worker_elapsed, 2) if worker_elapsed else 0,
+            "latency_ms": summarize(worker_latency),
+        },
+    }
+
+
+async def create_users(chat_ids: List[str]) -> None:
+    await init_db()
+    async with AsyncSessionLocal() as session:
+        await session.execute(
+            insert(User),
+            [
+                {"first_name": "Load", "chat_id": chat_id, "is_verified": True, "age": 30, "gender": "Other"}
+                for chat_id in chat_ids
+            ],
+        )
+        await session.commit()
+
+
+async def delete_users(chat_ids: List[str]) -> None:
+    async with AsyncSessionLocal() as session:
+        for model in (Message, UsageRollup, ChatSummary, User):
+            await session.execute(delete(model).filter(model.chat_id.in_(chat_ids)))
+        await session.execute(
+            delete(TelegramUpdate).filter(TelegramUpdate.update_id >= UPDATE_ID_BASE)
+        )
+        await session.commit()
+
+
+def start(command: List[str], env: Dict[str, str]) -> subprocess.Popen:
+    return subprocess.Popen(command, env=env, stdout=sys.stderr, stderr=sys.stderr)
+
+
+def stop(process: subprocess.Popen) -> None:
+    if process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+async def main(args) -> None:
+    settings = settings_from(args)
+    openai_port, telegram_port, app_port = free_port(), free_port(), free_port()
+    telegram_url = f"http://127.0.0.1:{telegram_port}"
+    base_url = f"http://127.0.0.1:{app_port}"
+
+    env = dict(os.environ)
+    env["OPENAI_BASE_URL"] = f"http://127.0.0.1:{openai_port}/v1"
+    env["TELEGRAM_API_URL"] = telegram_url
+    env["SERVER_API_KEY"] = API_KEY
+    env.setdefault("OPENAI_API_KEY", "benchmark")
+    env.setdefault("TELEGRAM_BOT_TOKEN", "benchmark")
+    env.setdefault("TG_WORKER_BACKEND", "async")
+    env.setdefault("TG_WORKER_BROKER_URL", "memory://")
+    env.setdefault("GUARDRAIL_PRE_CLASSIFIER", "none")
+    env.setdefault("GUARDRAIL_CACHE", "false")
+    # The mock would answer the pool prompt with support text
+    env.setdefault("REFUSAL_POOL_REFRESH", "0")
+
+    chat_ids = [str(BENCH_CHAT_ID_BASE + i) for i in range(args.requests)]
+    await create_users(chat_ids)
+
+    mocks = start(
+        [sys.executable, "-m", "benchmarks.mock_services", "--openai-port", str(openai_port),
+         "--telegram-port", str(telegram_port)] + settings_arguments(settings),
+        env,
+    )
+    api = start(
+        [sys.executable, "-m", "uvicorn", "src.main:app", "--host", "127.0.0.1",
+         "--port", str(app_port), "--log-level", "warning"],
+        env,
+    )
+    results: Dict[str, Any] = {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "git_commit": git_commit(),
+        "settings": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "off_topic_ratio": args.off_topic_ratio,
+            "burst": args.burst,
+            "coalesce_window": env.get("TG_COALESCE_WINDOW", str(config.TG_COALESCE_WINDOW)),
+            "mock": vars(settings),
+            "tg_worker_backend": env["TG_WORKER_BACKEND"],
+            "speculative_guardrail": env.get("SPECULATIVE_GUARDRAIL", "false"),
+            "refusal_mode": env.get("REFUSAL_MODE", config.REFUSAL_MODE),
+        },
+        "scenarios": {},
+    }
+    try:
+        await wait_until_up(f"{telegram_url}/_mock/calls", mocks)
+        await wait_until_up(f"{base_url}/api/{config.API_VERSION}/health", api)
+        results["memory_idle"] = process_memory_mb(api.pid)
+
+        for scenario in args.scenario:
+            if scenario == "chat":
+                result = await chat_scenario(base_url, args)
+            else:
+                result = await webhook_scenario(base_url, telegram_url, args)
+            result["memory"] = process_memory_mb(api.pid)
+            results["scenarios"][scenario] = result
+    finally:
+        stop(api)
+        stop(mocks)
+        await delete_users(chat_ids)
+
+    output = Path(args.output or f"benchmarks/results/load-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2) + "\n")
+    print(json.dumps(results["scenarios"], indent=2))
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenario", choices=SCENARIOS, action="append")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--off-topic-ratio", type=float, default=0.1)
+    parser.add_argument("--burst", type=int, default=1)
+    parser.add_argument("--worker-timeout", type=float, default=120)
+    parser.add_argument("--output")
+    add_settings_arguments(parser)
+    args = parser.parse_args()
+    args.scenario = args.scenario or list(SCENARIOS)
+    asyncio.run(main(args))
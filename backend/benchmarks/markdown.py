@@ -0,0 +1,106 @@
+"""Cost of formatting outbound Telegram text, per reply of 2 to 4 KB.
+
+Compares the previous escaping, one `str.replace` pass per special
+character, with the current one, which skips the characters not present,
+and with a `str.translate` table. Then the Markdown to MarkdownV2 and to
+`entities` renderers, and rendering a streamed reply delta by delta
+incrementally against re-rendering it whole on every delta.
+
+    python -m benchmarks.markdown --iterations 2000
+"""
+
+import argparse
+import random
+import statistics
+import time
+
+from src.utils.markdown import (
+    ESCAPE_CHARS,
+    IncrementalMarkdownV2,
+    escape_markdown_v2,
+    render_entities,
+    render_markdown_v2,
+)
+
+PREVIOUS_ESCAPE_CHARS = r"_*[]()~`>#+-=|{}.!"
+TRANSLATE_TABLE = str.maketrans({char: f"\\{char}" for char in ESCAPE_CHARS})
+
+PARAGRAPHS = [
+    "It sounds like you're carrying a lot right now 😔, and it's **completely okay** to feel this way. "
+    "Stress often builds up quietly until it feels *overwhelming*.",
+    "### A few things that might help 🌱",
+    "- **Breathe slowly:** in for 4 counts, hold for 4, out for 6 (repeat 5-6 times).\n"
+    "- **Name it:** write down what's bothering you, even 2-3 words helps!\n"
+    "- **Move a little:** a 10-minute walk can lower tension by a surprising amount.",
+    "1. Notice *five* things you can see 👀.\n2. Four things you can touch.\n"
+    "3. Three things you can hear 🎧.\n4. Two things you can smell.\n5. One thing you can taste.",
+    "If you'd like, try the `box breathing` exercise tonight before bed 😴. "
+    "You can read more in [this guide](https://www.example.org/breathing-guide).",
+    "Remember: progress isn't linear, and small steps still count 💪. "
+    "Would you like to talk about what's been weighing on you the most?",
+    "```\nInhale  - 4s\nHold    - 4s\nExhale  - 6s\n```",
+    "You're not alone in this ❤️. ~~Pushing through~~ Taking a pause is a strength, not a weakness!",
+]
+
+
+def make_reply(rng: random.Random, size: int) -> str:
+    parts = []
+    while sum(len(part) + 2 for part in parts) < size:
+        parts.append(rng.choice(PARAGRAPHS))
+    return "\n\n".join(parts)
+
+
+def previous_escape(text: str) -> str:
+    for char in PREVIOUS_ESCAPE_CHARS:
+        text = text.replace(char, f"\\{char}")
+    return text
+
+
+def translate_escape(text: str) -> str:
+    return text.translate(TRANSLATE_TABLE)
+
+
+def per_reply_us(operation, replies, iterations: int) -> float:
+    started_at = time.perf_counter()
+    for i in range(iterations):
+        operation(replies[i % len(replies)])
+    return (time.perf_counter() - started_at) / iterations * 1e6
+
+
+def streamed_incremental(text: str, delta: int = 20) -> None:
+    renderer = IncrementalMarkdownV2()
+    for start in range(0, len(text), delta):
+        renderer.feed(text[start : start + delta])
+    renderer.finish()
+
+
+def streamed_rerender(text: str, delta: int = 20) -> None:
+    for end in range(delta, len(text) + delta, delta):
+        render_markdown_v2(text[:end])
+
+
+def main(iterations: int, seed: int) -> None:
+    rng = random.Random(seed)
+    replies = [make_reply(rng, rng.randint(2048, 4096)) for _ in range(50)]
+    print(
+        f"{len(replies)} replies, {statistics.mean(map(len, replies)):.0f} characters on average\n"
+    )
+    results = [
+        ("escape, replace per character (previous)", previous_escape, iterations),
+        ("escape, replace the characters present", escape_markdown_v2, iterations),
+        ("escape, translate table", translate_escape, iterations),
+        ("render Markdown to MarkdownV2", render_markdown_v2, iterations),
+        ("render Markdown to entities", render_entities, iterations),
+        ("stream in 20 character deltas, incremental", streamed_incremental, iterations // 20),
+        ("stream in 20 character deltas, re-render", streamed_rerender, iterations // 20),
+    ]
+    for name, operation, count in results:
+        print(f"{name:48} {per_reply_us(operation, replies, max(count, 1)):9.1f} us/reply")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+    main(args.iterations, args.seed)
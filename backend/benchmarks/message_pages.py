@@ -0,0 +1,110 @@
+"""Latency of one page of the messages API at increasing depth, keyset cursor
+against LIMIT/OFFSET.
+
+Needs the Postgres database from `.env`, it creates a throwaway user and
+deletes it at the end.
+
+    python -m benchmarks.message_pages --messages 200000 --page-size 50
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, insert, select, text
+
+from src.database.database import AsyncSessionLocal, init_db
+from src.models.base import generate_uuid
+from src.models.message import Message
+from src.models.user import User
+from src.utils.history import encode_cursor, fetch_message_page
+
+BENCH_CHAT_ID = "benchmark-message-pages"
+
+
+async def insert_messages(count: int) -> None:
+    base = datetime(2024, 1, 1)
+    async with AsyncSessionLocal() as session:
+        for offset in range(0, count, 5000):
+            rows = [
+                {
+                    "id": generate_uuid(),
+                    "query": f"query {i}",
+                    "response": f"response {i}",
+                    "chat_id": BENCH_CHAT_ID,
+                    # Pairs of messages share a timestamp, so `id` breaks ties
+                    "created_at": base + timedelta(seconds=i // 2),
+                    "is_deleted": False,
+                }
+                for i in range(offset, min(offset + 5000, count))
+            ]
+            await session.execute(insert(Message), rows)
+        await session.execute(text("ANALYZE messages"))
+        await session.commit()
+
+
+def offset_statement(depth: int, page_size: int):
+    return (
+        select(Message)
+        .filter(Message.chat_id == BENCH_CHAT_ID, Message.is_deleted.is_(False))
+        .order_by(Message.created_at, Message.id)
+        .offset(depth)
+        .limit(page_size)
+    )
+
+
+async def cursor_at(depth: int) -> str:
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(offset_statement(depth - 1, 1))
+        return encode_cursor(result.scalars().one())
+
+
+async def median_ms(page, iterations: int) -> float:
+    timings = []
+    async with AsyncSessionLocal() as session:
+        for _ in range(iterations):
+            started_at = time.perf_counter()
+            await page(session)
+            timings.append((time.perf_counter() - started_at) * 1000)
+    return statistics.median(timings)
+
+
+async def main(messages: int, page_size: int, iterations: int) -> None:
+    await init_db()
+    async with AsyncSessionLocal() as session:
+        session.add(User(first_name="Benchmark", chat_id=BENCH_CHAT_ID))
+        await session.commit()
+
+    try:
+        await insert_messages(messages)
+        print(f"{'depth':>10} {'keyset ms':>10} {'offset ms':>10}")
+        for fraction in (0, 0.1, 0.5, 0.9, 0.999):
+            depth = int(messages * fraction)
+            cursor = await cursor_at(depth) if depth else None
+
+            async def keyset_page(session):
+                return await fetch_message_page(session, BENCH_CHAT_ID, page_size, cursor)
+
+            async def offset_page(session):
+                result = await session.execute(offset_statement(depth, page_size))
+                return result.scalars().all()
+
+            keyset_ms = await median_ms(keyset_page, iterations)
+            offset_ms = await median_ms(offset_page, iterations)
+            print(f"{depth:>10} {keyset_ms:>10.3f} {offset_ms:>10.3f}")
+    finally:
+        async with AsyncSessionLocal() as session:
+            await session.execute(delete(Message).filter(Message.chat_id == BENCH_CHAT_ID))
+            await session.execute(delete(User).filter(User.chat_id == BENCH_CHAT_ID))
+            await session.commit()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--iterations", type=int, default=30)
+    args = parser.parse_args()
+    asyncio.run(main(args.messages, args.page_size, args.iterations))
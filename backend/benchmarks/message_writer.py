@@ -0,0 +1,107 @@
+"""Rows per second of message persistence: one session and commit per message,
+as `handle_tg_message` used to do, against the write behind `MessageWriter`
+with multi row INSERT and with COPY.
+
+Needs the Postgres database from `.env`, it creates a throwaway user and
+deletes it at the end.
+
+    python -m benchmarks.message_writer --messages 5000 --concurrency 32
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from sqlalchemy import delete
+
+from src.database.database import AsyncSessionLocal, init_db
+from src.database.message_writer import MessageWriter, message_record
+from src.models.message import Message
+from src.models.user import User
+
+BENCH_CHAT_ID = "benchmark-message-writer"
+
+
+def record(i: int) -> dict:
+    return message_record(
+        query=f"query {i}",
+        response=f"response {i} " * 20,
+        input_tokens=100,
+        output_tokens=200,
+        total_tokens=300,
+        model="benchmark",
+        provider="Openai",
+        chat_id=BENCH_CHAT_ID,
+    )
+
+
+async def per_message_commit(messages: int, concurrency: int) -> None:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def save(i: int) -> None:
+        async with semaphore:
+            async with AsyncSessionLocal() as session:
+                session.add(Message(**record(i)))
+                await session.commit()
+
+    await asyncio.gather(*(save(i) for i in range(messages)))
+
+
+def write_behind(method: str):
+    async def run(messages: int, concurrency: int) -> None:
+        spill_path = os.path.join(tempfile.mkdtemp(), "spill.jsonl")
+        writer = MessageWriter(method=method, spill_path=spill_path)
+        await writer.start()
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def save(i: int) -> None:
+            async with semaphore:
+                await writer.write(record(i))
+
+        await asyncio.gather(*(save(i) for i in range(messages)))
+        await writer.stop()
+        if writer.stats.spilled:
+            raise RuntimeError(f"{writer.stats.spilled} messages spilled to {spill_path}")
+
+    return run
+
+
+async def clean() -> None:
+    async with AsyncSessionLocal() as session:
+        await session.execute(delete(Message).filter(Message.chat_id == BENCH_CHAT_ID))
+        await session.commit()
+
+
+async def main(messages: int, concurrency: int) -> None:
+    await init_db()
+    async with AsyncSessionLocal() as session:
+        session.add(User(first_name="Benchmark", chat_id=BENCH_CHAT_ID))
+        await session.commit()
+
+    try:
+        print(f"{'strategy':>20} {'seconds':>9} {'rows/s':>10}")
+        for name, strategy in (
+            ("per message commit", per_message_commit),
+            ("batched insert", write_behind("insert")),
+            ("batched copy", write_behind("copy")),
+        ):
+            started_at = time.perf_counter()
+            await strategy(messages, concurrency)
+            elapsed = time.perf_counter() - started_at
+            print(f"{name:>20} {elapsed:>9.3f} {messages / elapsed:>10.0f}")
+            await clean()
+    finally:
+        await clean()
+        async with AsyncSessionLocal() as session:
+            await session.execute(delete(User).filter(User.chat_id == BENCH_CHAT_ID))
+            await session.commit()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    args = parser.parse_args()
+    asyncio.run(main(args.messages, args.concurrency))
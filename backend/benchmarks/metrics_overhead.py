@@ -0,0 +1,153 @@
+"""Cost of the metrics instrumentation against the request it measures.
+
+Times the metric operations themselves and the statement timing listeners,
+then sequential cold webhook updates, from the request until the ingestor
+processed them, with the instrumentation on, and reports the share of an
+update spent in instrumentation.
+
+Needs the Postgres database from `.env`.
+
+    python -m benchmarks.metrics_overhead
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+os.environ["TG_WORKER_BACKEND"] = "async"
+os.environ["TG_WORKER_BROKER_URL"] = "memory://"
+
+import httpx  # noqa: E402
+from fastapi import FastAPI  # noqa: E402
+from sqlalchemy import create_engine, delete  # noqa: E402
+
+from src.cache.conversation import conversation_cache  # noqa: E402
+from src.database.database import AsyncSessionLocal, init_db  # noqa: E402
+from src.models.user import User  # noqa: E402
+from src.models.telegram_update import TelegramUpdate  # noqa: E402
+from src.routes.telegram import router as telegram_router, update_ingestor  # noqa: E402
+from src.utils.context import summary_store  # noqa: E402
+from src.utils.metrics import (  # noqa: E402
+    AGENT_SECONDS,
+    DB_QUERY_SECONDS,
+    IN_FLIGHT,
+    TOKENS,
+    instrument_engine,
+)
+from src import config  # noqa: E402
+
+BENCH_CHAT_ID = 9_200_000_000
+# Unique per run, the ingestor drops update ids it has seen
+UPDATE_ID_BASE = int(time.time() * 1000) * 10_000
+
+
+def per_op_ns(operation, iterations: int) -> float:
+    started_at = time.perf_counter()
+    for _ in range(iterations):
+        operation()
+    return (time.perf_counter() - started_at) / iterations * 1e9
+
+
+def statement_listeners_ns(iterations: int) -> float:
+    """The listener calls SQLAlchemy adds around every statement."""
+    bench_engine = create_engine("postgresql+psycopg2://bench@localhost/bench")
+    instrument_engine(bench_engine, "benchmark")
+    dispatch = bench_engine.dispatch
+    statement = "SELECT users.id, users.chat_id FROM users WHERE users.chat_id = $1"
+
+    class Context:
+        pass
+
+    context = Context()
+
+    def execute():
+        dispatch.before_cursor_execute(None, None, statement, None, context, False)
+        dispatch.after_cursor_execute(None, None, statement, None, context, False)
+
+    return per_op_ns(execute, iterations)
+
+
+def statements_observed() -> int:
+    return sum(child.count for child in DB_QUERY_SECONDS._children.values())
+
+
+async def webhook_ms(iterations: int):
+    app = FastAPI()
+    app.include_router(telegram_router)
+    url = f"/api/{config.API_VERSION}/telegram/webhook"
+    update = {
+        "message": {
+            "message_id": 1,
+            "from": {"id": BENCH_CHAT_ID, "is_bot": False, "first_name": "Metrics"},
+            "chat": {"id": BENCH_CHAT_ID, "type": "private"},
+            "date": int(time.time()),
+            "text": "I feel anxious",
+        },
+    }
+    timings = []
+    statements = statements_observed()
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for i in range(iterations):
+            # Cold chat every time, so the request runs its database queries
+            conversation_cache.invalidate(str(BENCH_CHAT_ID))
+            summary_store._entries.pop(str(BENCH_CHAT_ID), None)
+            started_at = time.perf_counter()
+            await client.post(url, json={"update_id": UPDATE_ID_BASE + i, **update})
+            await update_ingestor.join()
+            timings.append(time.perf_counter() - started_at)
+    statements_per_request = (statements_observed() - statements) / iterations
+    return statistics.median(timings) * 1000, statements_per_request
+
+
+async def main(iterations: int) -> None:
+    await init_db()
+    async with AsyncSessionLocal() as session:
+        session.add(
+            User(first_name="Metrics", chat_id=str(BENCH_CHAT_ID), is_verified=True, age=30, gender="Other")
+        )
+        await session.commit()
+
+    await update_ingestor.start()
+    try:
+        histogram = AGENT_SECONDS.labels("benchmark", "agent")
+        observe_ns = per_op_ns(lambda: AGENT_SECONDS.labels("benchmark", "agent").observe(0.2), 200_000)
+        observe_child_ns = per_op_ns(lambda: histogram.observe(0.2), 200_000)
+        counter_ns = per_op_ns(lambda: TOKENS.labels("benchmark", "model", "input").inc(100), 200_000)
+        gauge_ns = per_op_ns(
+            lambda: (IN_FLIGHT.labels("benchmark").inc(), IN_FLIGHT.labels("benchmark").dec()),
+            200_000,
+        )
+        listeners_ns = statement_listeners_ns(200_000)
+        request_ms, statements = await webhook_ms(iterations)
+
+        # Webhook and update histograms, in flight inc/dec and the statement listeners
+        per_request_us = (2 * observe_ns + gauge_ns + statements * listeners_ns) / 1000
+
+        print(f"histogram observe with labels() {observe_ns:8.0f} ns")
+        print(f"histogram observe on a child    {observe_child_ns:8.0f} ns")
+        print(f"counter inc with labels()       {counter_ns:8.0f} ns")
+        print(f"gauge inc + dec                 {gauge_ns:8.0f} ns")
+        print(f"statement listeners             {listeners_ns:8.0f} ns")
+        print(f"cold webhook update             {request_ms:8.2f} ms, {statements:.1f} statements")
+        print(
+            f"instrumentation per update      {per_request_us:8.1f} us "
+            f"({per_request_us / (request_ms * 1000) * 100:.2f}% of the update)"
+        )
+    finally:
+        await update_ingestor.stop()
+        async with AsyncSessionLocal() as session:
+            await session.execute(
+                delete(TelegramUpdate).filter(TelegramUpdate.update_id >= UPDATE_ID_BASE)
+            )
+            await session.execute(delete(User).filter(User.chat_id == str(BENCH_CHAT_ID)))
+            await session.commit()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=500)
+    args = parser.parse_args()
+    asyncio.run(main(args.iterations))
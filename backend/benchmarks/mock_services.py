@@ -0,0 +1,360 @@
+"""Local mocks of the OpenAI Responses API and the Telegram Bot API.
+
+The Responses mock answers `POST /v1/responses`, streamed or not, with a
+configurable latency before the first byte and delta cadence. Requests with
+a JSON schema output (the guardrail agent) get a `GuardrailCheckOutput`,
+off topic when the last user message contains `OFF_TOPIC_MARKER`. With
+`max_concurrency` set, requests over it get a 429 with `retry-after`, like
+the rate limits of the real API.
+
+The Bot API mock answers every `POST /bot<token>/<method>` and records the
+calls, `GET /_mock/calls` returns them so a benchmark can tell when a reply
+reached a chat. `getUpdates` long polls the updates queued with
+`POST /_mock/updates` and honours `offset` and `limit`.
+
+    python -m benchmarks.mock_services --openai-port 8901 --telegram-port 8902
+    OPENAI_BASE_URL=http://127.0.0.1:8901/v1 TELEGRAM_API_URL=http://127.0.0.1:8902 ...
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import socket
+import time
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, List
+from urllib.parse import parse_qs
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+OFF_TOPIC_MARKER = "[off-topic]"
+
+ANSWER_WORDS = (
+    "It sounds like you are carrying a lot right now, and that is completely "
+    "understandable. Try a slow breath in for four counts, hold it, and let it "
+    "out for six. Would you like to talk about what is weighing on you the most?"
+).split()
+
+
+@dataclass
+class MockSettings:
+    # Seconds before the first byte of every OpenAI response
+    latency: float = 0.5
+    # Text deltas of a streamed answer and the seconds between them
+    deltas: int = 40
+    delta_interval: float = 0.02
+    # Requests the OpenAI mock serves at once, 0 for no limit, and the
+    # `retry-after` seconds of the 429s over it
+    max_concurrency: int = 0
+    retry_after: float = 1.0
+    # Seconds of every Bot API call
+    telegram_latency: float = 0.05
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def estimate_tokens(payload: Any) -> int:
+    return max(len(json.dumps(payload)) // 4, 1)
+
+
+def last_user_text(input_items: Any) -> str:
+    if isinstance(input_items, str):
+        return input_items
+    for item in reversed(input_items or []):
+        if item.get("role") != "user":
+            continue
+        content = item.get("content")
+        if isinstance(content, str):
+            return content
+        return " ".join(part.get("text", "") for part in content or [])
+    return ""
+
+
+class MockOpenAI:
+    def __init__(self, settings: MockSettings):
+        self.settings = settings
+        self.requests = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.rejected = 0
+        self._ids = itertools.count(1)
+
+    def answer(self, body: Dict[str, Any]) -> List[str]:
+        """The output text of a request, as the deltas it is streamed in."""
+        text_format = (body.get("text") or {}).get("format") or {}
+        if text_format.get("type") == "json_schema":
+            off_topic = OFF_TOPIC_MARKER in last_user_text(body.get("input"))
+            output = {
+                "is_mental_health": not off_topic,
+                "reasoning": "Off topic request." if off_topic else "Mental health request.",
+            }
+            return [json.dumps(output)]
+        words = itertools.islice(itertools.cycle(ANSWER_WORDS), self.settings.deltas)
+        return [f"{word} " for word in words]
+
+    def response(self, body: Dict[str, Any], response_id: str, text: str, status: str) -> Dict:
+        message = {
+            "type": "message",
+            "id": f"msg_{response_id}",
+            "status": status,
+            "role": "assistant",
+            "content": [{"type": "output_text", "text": text, "annotations": []}] if text else [],
+        }
+        input_tokens = estimate_tokens(body.get("input"))
+        output_tokens = estimate_tokens(text) if text else 0
+        return {
+            "id": response_id,
+            "object": "response",
+            "created_at": int(time.time()),
+            "model": body.get("model", "mock"),
+            "status": status,
+            "output": [message] if text else [],
+            "parallel_tool_calls": True,
+            "tool_choice": "auto",
+            "tools": [],
+            "usage": {
+                "input_tokens": input_tokens,
+                "input_tokens_details": {"cached_tokens": 0},
+                "output_tokens": output_tokens,
+                "output_tokens_details": {"reasoning_tokens": 0},
+                "total_tokens": input_tokens + output_tokens,
+            },
+        }
+
+    async def create(self, request: Request):
+        body = await request.json()
+        self.requests += 1
+        if self.settings.max_concurrency and self.in_flight >= self.settings.max_concurrency:
+            self.rejected += 1
+            return JSONResponse(
+                {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+                status_code=429,
+                headers={"retry-after": str(self.settings.retry_after)},
+            )
+        response_id = f"resp_mock_{next(self._ids)}"
+        deltas = self.answer(body)
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        if not body.get("stream"):
+            try:
+                await asyncio.sleep(self.settings.latency + len(deltas) * self.settings.delta_interval)
+            finally:
+                self.in_flight -= 1
+            return JSONResponse(self.response(body, response_id, "".join(deltas), "completed"))
+        return StreamingResponse(
+            self.stream(body, response_id, deltas), media_type="text/event-stream"
+        )
+
+    async def stream(self, body: Dict[str, Any], response_id: str, deltas: List[str]):
+        try:
+            async for event in self.stream_events(body, response_id, deltas):
+                yield event
+        finally:
+            self.in_flight -= 1
+
+    async def stream_events(self, body: Dict[str, Any], response_id: str, deltas: List[str]):
+        item_id = f"msg_{response_id}"
+        text = "".join(deltas)
+
+        def event(payload: Dict[str, Any]) -> str:
+            return f"event: {payload['type']}\ndata: {json.dumps(payload)}\n\n"
+
+        await asyncio.sleep(self.settings.latency)
+        yield event(
+            {"type": "response.created", "response": self.response(body, response_id, "", "in_progress")}
+        )
+        yield event(
+            {
+                "type": "response.output_item.added",
+                "output_index": 0,
+                "item": {
+                    "type": "message",
+                    "id": item_id,
+                    "status": "in_progress",
+                    "role": "assistant",
+                    "content": [],
+                },
+            }
+        )
+        part = {"type": "output_text", "text": "", "annotations": []}
+        yield event(
+            {
+                "type": "response.content_part.added",
+                "item_id": item_id,
+                "output_index": 0,
+                "content_index": 0,
+                "part": part,
+            }
+        )
+        for i, delta in enumerate(deltas):
+            if i:
+                await asyncio.sleep(self.settings.delta_interval)
+            yield event(
+                {
+                    "type": "response.output_text.delta",
+                    "item_id": item_id,
+                    "output_index": 0,
+                    "content_index": 0,
+                    "delta": delta,
+                }
+            )
+        yield event(
+            {
+                "type": "response.output_text.done",
+                "item_id": item_id,
+                "output_index": 0,
+                "content_index": 0,
+                "text": text,
+            }
+        )
+        yield event(
+            {
+                "type": "response.content_part.done",
+                "item_id": item_id,
+                "output_index": 0,
+                "content_index": 0,
+                "part": {**part, "text": text},
+            }
+        )
+        completed = self.response(body, response_id, text, "completed")
+        yield event(
+            {"type": "response.output_item.done", "output_index": 0, "item": completed["output"][0]}
+        )
+        yield event({"type": "response.completed", "response": completed})
+
+    def app(self) -> Starlette:
+        return Starlette(routes=[Route("/v1/responses", self.create, methods=["POST"])])
+
+
+class MockTelegram:
+    def __init__(self, settings: MockSettings):
+        self.settings = settings
+        self.calls: List[Dict[str, Any]] = []
+        self.updates: List[Dict[str, Any]] = []
+        self._updates_added = asyncio.Event()
+        self._message_ids = itertools.count(1)
+
+    def add_updates(self, updates: List[Dict[str, Any]]) -> None:
+        self.updates.extend(updates)
+        self._updates_added.set()
+
+    async def get_updates(self, form: Dict[str, str]) -> List[Dict[str, Any]]:
+        offset = int(form.get("offset") or 0)
+        limit = int(form.get("limit") or 100)
+        deadline = time.monotonic() + float(form.get("timeout") or 0)
+        # Updates below the offset are confirmed, Telegram forgets them
+        self.updates = [update for update in self.updates if update["update_id"] >= offset]
+        while not self.updates and time.monotonic() < deadline:
+            self._updates_added.clear()
+            try:
+                await asyncio.wait_for(self._updates_added.wait(), deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:limit]
+
+    async def call(self, request: Request):
+        method = request.path_params["method"]
+        # The client posts urlencoded forms, parsed here so the mock does not
+        # need python-multipart
+        form = {key: values[0] for key, values in parse_qs((await request.body()).decode()).items()}
+        await asyncio.sleep(self.settings.telegram_latency)
+        if method == "getUpdates":
+            self.calls.append({"method": method, "chat_id": None, "at": time.time()})
+            return JSONResponse({"ok": True, "result": await self.get_updates(form)})
+        chat_id = form.get("chat_id")
+        self.calls.append({"method": method, "chat_id": chat_id, "at": time.time()})
+        if method in ("sendMessage", "editMessageText"):
+            result: Any = {
+                "message_id": int(form.get("message_id") or next(self._message_ids)),
+                "date": int(time.time()),
+                "chat": {"id": int(chat_id) if chat_id else 0, "type": "private"},
+                "text": form.get("text", ""),
+            }
+        else:
+            result = True
+        return JSONResponse({"ok": True, "result": result})
+
+    async def list_calls(self, request: Request):
+        return JSONResponse({"calls": self.calls})
+
+    async def reset(self, request: Request):
+        self.calls.clear()
+        self.updates.clear()
+        return JSONResponse({"ok": True})
+
+    async def post_updates(self, request: Request):
+        self.add_updates((await request.json())["updates"])
+        return JSONResponse({"ok": True, "pending": len(self.updates)})
+
+    def app(self) -> Starlette:
+        return Starlette(
+            routes=[
+                Route("/_mock/calls", self.list_calls, methods=["GET"]),
+                Route("/_mock/reset", self.reset, methods=["POST"]),
+                Route("/_mock/updates", self.post_updates, methods=["POST"]),
+                Route("/bot{token}/{method}", self.call, methods=["POST"]),
+            ]
+        )
+
+
+async def serve(settings: MockSettings, openai_port: int, telegram_port: int) -> None:
+    servers = [
+        uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+        for app, port in (
+            (MockOpenAI(settings).app(), openai_port),
+            (MockTelegram(settings).app(), telegram_port),
+        )
+    ]
+    print(f"Mock services on :{openai_port} and :{telegram_port}, {asdict(settings)}", flush=True)
+    await asyncio.gather(*(server.serve() for server in servers))
+
+
+def add_settings_arguments(parser: argparse.ArgumentParser) -> None:
+    defaults = MockSettings()
+    parser.add_argument("--latency", type=float, default=defaults.latency)
+    parser.add_argument("--deltas", type=int, default=defaults.deltas)
+    parser.add_argument("--delta-interval", type=float, default=defaults.delta_interval)
+    parser.add_argument("--telegram-latency", type=float, default=defaults.telegram_latency)
+    parser.add_argument("--max-concurrency", type=int, default=defaults.max_concurrency)
+    parser.add_argument("--retry-after", type=float, default=defaults.retry_after)
+
+
+def settings_from(args: argparse.Namespace) -> MockSettings:
+    return MockSettings(
+        latency=args.latency,
+        deltas=args.deltas,
+        delta_interval=args.delta_interval,
+        telegram_latency=args.telegram_latency,
+        max_concurrency=args.max_concurrency,
+        retry_after=args.retry_after,
+    )
+
+
+def settings_arguments(settings: MockSettings) -> List[str]:
+    """Command line of the mock services with these settings."""
+    return [
+        "--latency", str(settings.latency),
+        "--deltas", str(settings.deltas),
+        "--delta-interval", str(settings.delta_interval),
+        "--telegram-latency", str(settings.telegram_latency),
+        "--max-concurrency", str(settings.max_concurrency),
+        "--retry-after", str(settings.retry_after),
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--openai-port", type=int, default=8901)
+    parser.add_argument("--telegram-port", type=int, default=8902)
+    add_settings_arguments(parser)
+    args = parser.parse_args()
+    asyncio.run(serve(settings_from(args), args.openai_port, args.telegram_port))
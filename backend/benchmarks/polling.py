@@ -0,0 +1,180 @@
+"""Updates per second of long polling against the webhook path.
+
+Queues `--chats` x `--per-chat` text updates from registered users in an in
+process mock of the Bot API, polls them with `UpdatePoller` in batches of
+`--limit`, then posts the same kind of updates to the webhook one by one and
+waits for the ingestor. Reports updates/s and database statements per update
+of both, the poller claims a batch and looks its users up with one query
+each. Agent jobs are only queued, no worker runs.
+
+Needs the Postgres database from `.env`.
+
+    python -m benchmarks.polling --chats 100 --per-chat 3
+"""
+
+import argparse
+import asyncio
+import os
+import time
+
+os.environ["TG_WORKER_BACKEND"] = "async"
+os.environ["TG_WORKER_BROKER_URL"] = "memory://"
+
+import httpx  # noqa: E402
+from fastapi import FastAPI  # noqa: E402
+from sqlalchemy import delete  # noqa: E402
+
+from benchmarks.mock_services import MockSettings, MockTelegram  # noqa: E402
+from src.cache.conversation import conversation_cache  # noqa: E402
+from src.database.database import AsyncSessionLocal, init_db  # noqa: E402
+from src.models.message import Message  # noqa: E402
+from src.models.user import User  # noqa: E402
+from src.models.telegram_update import TelegramPollState, TelegramUpdate  # noqa: E402
+from src.routes.telegram import router as telegram_router, update_ingestor  # noqa: E402
+from src.tasks.polling import UpdatePoller  # noqa: E402
+from src.utils.context import summary_store  # noqa: E402
+from src.utils.metrics import DB_QUERY_SECONDS  # noqa: E402
+from src.utils.telegram import TelegramClient  # noqa: E402
+from src import config  # noqa: E402
+
+BENCH_CHAT_BASE = 9_300_000_000
+BENCH_BOT_ID = 9_300_000_000
+# Unique per run, the ingestor drops update ids it has seen
+UPDATE_ID_BASE = int(time.time() * 1000) * 10_000
+
+
+def statements_observed(operation=None) -> int:
+    return sum(
+        child.count
+        for labels, child in DB_QUERY_SECONDS._children.items()
+        if operation is None or labels[-1] == operation
+    )
+
+
+def make_updates(first_update_id: int, chats: int, per_chat: int):
+    updates = []
+    for turn in range(per_chat):
+        for chat in range(chats):
+            chat_id = BENCH_CHAT_BASE + chat
+            updates.append(
+                {
+                    "update_id": first_update_id + len(updates),
+                    "message": {
+                        "message_id": turn + 1,
+                        "from": {"id": chat_id, "is_bot": False, "first_name": "Polling"},
+                        "chat": {"id": chat_id, "type": "private"},
+                        "date": int(time.time()),
+                        "text": f"I feel anxious, message {turn + 1}",
+                    },
+                }
+            )
+    return updates
+
+
+def forget_chats(chats: int) -> None:
+    for chat in range(chats):
+        conversation_cache.invalidate(str(BENCH_CHAT_BASE + chat))
+        summary_store._entries.pop(str(BENCH_CHAT_BASE + chat), None)
+
+
+def report(name: str, count: int, seconds: float, statements: int, selects: int) -> None:
+    print(
+        f"{name:8} {count:6d} updates {seconds:7.2f} s {count / seconds:8.1f} updates/s "
+        f"{statements / count:5.2f} statements/update {selects / count:5.2f} selects/update"
+    )
+
+
+async def run_polling(updates, limit: int, latency: float) -> None:
+    mock = MockTelegram(MockSettings(telegram_latency=latency))
+    client = TelegramClient(
+        base_url="http://telegram/botbench", transport=httpx.ASGITransport(app=mock.app())
+    )
+    poller = UpdatePoller(update_ingestor, client=client, bot_id=BENCH_BOT_ID, limit=limit, timeout=1)
+    last_offset = updates[-1]["update_id"] + 1
+
+    statements, selects = statements_observed(), statements_observed("SELECT")
+    started_at = time.perf_counter()
+    mock.add_updates(updates)
+    task = asyncio.create_task(poller.run())
+    while poller.offset < last_offset and not task.done():
+        await asyncio.sleep(0.005)
+    seconds = time.perf_counter() - started_at
+    poller.stop()
+    await task
+    await client.aclose()
+    report(
+        "polling",
+        len(updates),
+        seconds,
+        statements_observed() - statements,
+        statements_observed("SELECT") - selects,
+    )
+    print(f"         {poller.snapshot()}")
+
+
+async def run_webhook(updates) -> None:
+    app = FastAPI()
+    app.include_router(telegram_router)
+    url = f"/api/{config.API_VERSION}/telegram/webhook"
+    transport = httpx.ASGITransport(app=app)
+    statements, selects = statements_observed(), statements_observed("SELECT")
+    started_at = time.perf_counter()
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for update in updates:
+            await client.post(url, json=update)
+        await update_ingestor.join()
+    seconds = time.perf_counter() - started_at
+    report(
+        "webhook",
+        len(updates),
+        seconds,
+        statements_observed() - statements,
+        statements_observed("SELECT") - selects,
+    )
+
+
+async def main(chats: int, per_chat: int, limit: int, latency: float) -> None:
+    await init_db()
+    async with AsyncSessionLocal() as session:
+        for chat in range(chats):
+            session.add(
+                User(
+                    first_name="Polling",
+                    chat_id=str(BENCH_CHAT_BASE + chat),
+                    is_verified=True,
+                    age=30,
+                    gender="Other",
+                )
+            )
+        await session.commit()
+
+    count = chats * per_chat
+    await update_ingestor.start()
+    try:
+        forget_chats(chats)
+        await run_polling(make_updates(UPDATE_ID_BASE, chats, per_chat), limit, latency)
+        forget_chats(chats)
+        await run_webhook(make_updates(UPDATE_ID_BASE + count, chats, per_chat))
+    finally:
+        await update_ingestor.stop()
+        chat_ids = [str(BENCH_CHAT_BASE + chat) for chat in range(chats)]
+        async with AsyncSessionLocal() as session:
+            await session.execute(
+                delete(TelegramUpdate).filter(TelegramUpdate.update_id >= UPDATE_ID_BASE)
+            )
+            await session.execute(
+                delete(TelegramPollState).filter(TelegramPollState.bot_id == BENCH_BOT_ID)
+            )
+            await session.execute(delete(Message).filter(Message.chat_id.in_(chat_ids)))
+            await session.execute(delete(User).filter(User.chat_id.in_(chat_ids)))
+            await session.commit()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=100)
+    parser.add_argument("--per-chat", type=int, default=3)
+    parser.add_argument("--limit", type=int, default=100, help="getUpdates batch size")
+    parser.add_argument("--latency", type=float, default=0.01, help="Bot API seconds per call")
+    args = parser.parse_args()
+    asyncio.run(main(args.chats, args.per_chat, args.limit, args.latency))
@@ -0,0 +1,103 @@
+"""Latency of an off topic refusal, from the template pool and from the model.
+
+Runs `stream_refusal` of `/agent/chat` `--iterations` times per mode, the
+"llm" mode against the local Responses API mock with `--latency` seconds
+before its first byte, and reports the time to the first NDJSON `answer`
+line and to the whole refusal, plus the model tokens the pool saved.
+
+    python -m benchmarks.refusal --iterations 200 --latency 0.5
+"""
+
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import time
+
+import uvicorn
+
+from benchmarks.mock_services import MockOpenAI, MockSettings
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+PORT = free_port()
+os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{PORT}/v1"
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+from src.agents.guard_rail import GuardrailCheckOutput  # noqa: E402
+from src.routes.agent import stream_refusal  # noqa: E402
+from src.utils.metrics import SAVED_TOKENS  # noqa: E402
+from src.utils.usage import UsageCollector  # noqa: E402
+from src import config  # noqa: E402
+
+QUERIES = [
+    ("Can you fix my Python code?", "The user asks for help with programming, not mental health."),
+    ("Should I buy bitcoin now?", "The query is about investing in crypto, a financial topic."),
+    ("What is the weather tomorrow?", "The user asks about the weather, unrelated to well being."),
+    ("Who won the match yesterday?", "The query is not about mental health or well being."),
+]
+
+
+def percentile(values, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+async def refusal_ms(mode: str, iterations: int):
+    config.REFUSAL_MODE = mode
+    first_chunk, total = [], []
+    for i in range(iterations):
+        query, reasoning = QUERIES[i % len(QUERIES)]
+        output = GuardrailCheckOutput(is_mental_health=False, reasoning=reasoning)
+        meta = {}
+        started_at = time.perf_counter()
+        first = None
+        async for _ in stream_refusal(query, output, UsageCollector(), meta):
+            if first is None:
+                first = time.perf_counter() - started_at
+        total.append((time.perf_counter() - started_at) * 1000)
+        first_chunk.append(first * 1000)
+        assert meta["response"]
+    return first_chunk, total
+
+
+def report(mode: str, first_chunk, total) -> None:
+    print(
+        f"{mode:8} first answer p50 {statistics.median(first_chunk):9.3f} ms "
+        f"p99 {percentile(first_chunk, 0.99):9.3f} ms | whole refusal p50 "
+        f"{statistics.median(total):9.3f} ms p99 {percentile(total, 0.99):9.3f} ms"
+    )
+
+
+async def main(iterations: int, llm_iterations: int, latency: float) -> None:
+    settings = MockSettings(latency=latency, deltas=30, delta_interval=0.005)
+    server = uvicorn.Server(
+        uvicorn.Config(MockOpenAI(settings).app(), host="127.0.0.1", port=PORT, log_level="warning")
+    )
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    try:
+        saved = SAVED_TOKENS.labels("refusal_template").value
+        report("template", *await refusal_ms("template", iterations))
+        saved = SAVED_TOKENS.labels("refusal_template").value - saved
+        print(f"         {saved / iterations:.0f} model tokens saved per refusal")
+        report("llm", *await refusal_ms("llm", llm_iterations))
+    finally:
+        server.should_exit = True
+        await server_task
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--llm-iterations", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.5, help="Mock seconds to first byte")
+    args = parser.parse_args()
+    asyncio.run(main(args.iterations, args.llm_iterations, args.latency))
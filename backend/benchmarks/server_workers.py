@@ -0,0 +1,150 @@
+"""Throughput of `/agent/chat` with one server process against N, and the
+drain of streamed replies on SIGTERM.
+
+Starts the mocks of `benchmarks.mock_services`, then for every `--workers`
+count the API with `python run.py` in production mode, runs the `chat`
+scenario of `benchmarks.load_test` against it and reports requests/s, TTFB
+and latency. Then starts `--drain` streamed chats on the last server, sends
+it SIGTERM while they are still streaming and counts the replies that
+completed, uvicorn waits for them up to `SERVER_GRACEFUL_TIMEOUT`.
+
+Needs the Postgres database from `.env`. More processes only help with
+more cores, `os.cpu_count()` is printed with the results.
+
+    python -m benchmarks.server_workers --workers 1 --workers 4 --requests 400 --concurrency 50
+"""
+
+import argparse
+import asyncio
+import os
+import signal
+import sys
+import time
+
+import httpx
+
+from benchmarks.load_test import (
+    API_KEY,
+    BENCH_CHAT_ID_BASE,
+    chat_scenario,
+    create_users,
+    delete_users,
+    free_port,
+    start,
+    stop,
+    wait_until_up,
+)
+from benchmarks.mock_services import add_settings_arguments, settings_arguments, settings_from
+from src import config
+
+
+def server_env(env, port: int, workers: int):
+    return {
+        **env,
+        "PORT": str(port),
+        "SERVER_HOST": "127.0.0.1",
+        "SERVER_RELOAD": "false",
+        "SERVER_WORKERS": str(workers),
+        # The tables exist, every process would check them again
+        "DB_INIT": "false",
+    }
+
+
+async def drain(base_url: str, server, streams: int) -> None:
+    url = f"{base_url}/api/{config.API_VERSION}/agent/chat"
+    headers = {"Authorization": f"Bearer {API_KEY}"}
+    started = asyncio.Event()
+    started_count = 0
+
+    async def chat(i: int) -> bool:
+        nonlocal started_count
+        body = {
+            "query": "I feel anxious before my exams",
+            "user_id": str(BENCH_CHAT_ID_BASE + i),
+            "chat_history": [],
+        }
+        lines = []
+        try:
+            async with client.stream("POST", url, json=body, headers=headers) as response:
+                async for line in response.aiter_lines():
+                    if not lines:
+                        started_count += 1
+                        if started_count == streams:
+                            started.set()
+                    lines.append(line)
+        except httpx.HTTPError:
+            return False
+        return any('"type": "answer"' in line for line in lines) and '"type": "error"' not in "".join(lines)
+
+    async with httpx.AsyncClient(timeout=120, limits=httpx.Limits(max_connections=None)) as client:
+        tasks = [asyncio.create_task(chat(i)) for i in range(streams)]
+        await asyncio.wait_for(started.wait(), 60)
+        sent_at = time.perf_counter()
+        server.send_signal(signal.SIGTERM)
+        completed = sum(await asyncio.gather(*tasks))
+    exited = await asyncio.to_thread(server.wait, 120)
+    print(
+        f"SIGTERM with {streams} replies streaming: {completed}/{streams} completed, "
+        f"server exited with {exited} after {time.perf_counter() - sent_at:.2f} s"
+    )
+
+
+async def main(args) -> None:
+    settings = settings_from(args)
+    openai_port, telegram_port = free_port(), free_port()
+    env = dict(os.environ)
+    env["OPENAI_BASE_URL"] = f"http://127.0.0.1:{openai_port}/v1"
+    env["TELEGRAM_API_URL"] = f"http://127.0.0.1:{telegram_port}"
+    env["SERVER_API_KEY"] = API_KEY
+    env.setdefault("OPENAI_API_KEY", "benchmark")
+    env.setdefault("TELEGRAM_BOT_TOKEN", "benchmark")
+    env.setdefault("TG_WORKER_BACKEND", "async")
+    env.setdefault("GUARDRAIL_PRE_CLASSIFIER", "none")
+    env.setdefault("GUARDRAIL_CACHE", "false")
+    env.setdefault("REFUSAL_POOL_REFRESH", "0")
+
+    chat_ids = [str(BENCH_CHAT_ID_BASE + i) for i in range(max(args.requests, args.drain))]
+    await create_users(chat_ids)
+    mocks = start(
+        [sys.executable, "-m", "benchmarks.mock_services", "--openai-port", str(openai_port),
+         "--telegram-port", str(telegram_port)] + settings_arguments(settings),
+        env,
+    )
+    print(f"{os.cpu_count()} cores, mock latency {settings.latency}s, {args.concurrency} in flight\n")
+    try:
+        await wait_until_up(f"{env['TELEGRAM_API_URL']}/_mock/calls", mocks)
+        for index, workers in enumerate(args.workers):
+            port = free_port()
+            base_url = f"http://127.0.0.1:{port}"
+            server = start([sys.executable, "run.py"], server_env(env, port, workers))
+            try:
+                await wait_until_up(f"{base_url}/api/{config.API_VERSION}/health", server)
+                # Every process answers a few requests before the timed run
+                await chat_scenario(base_url, argparse.Namespace(requests=workers * 4, concurrency=workers * 4, off_topic_ratio=0))
+                result = await chat_scenario(base_url, args)
+                print(
+                    f"{workers:2d} workers {result['throughput_rps']:8.2f} requests/s "
+                    f"{result['errors']} errors | TTFB p50 {result['ttfb_ms']['p50']} ms "
+                    f"p99 {result['ttfb_ms']['p99']} ms | latency p50 {result['latency_ms']['p50']} ms "
+                    f"p99 {result['latency_ms']['p99']} ms"
+                )
+                if args.drain and index == len(args.workers) - 1:
+                    await drain(base_url, server, args.drain)
+            finally:
+                stop(server)
+    finally:
+        stop(mocks)
+        await delete_users(chat_ids)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, action="append")
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--off-topic-ratio", type=float, default=0.1)
+    parser.add_argument("--drain", type=int, default=10, help="Streams in flight at SIGTERM, 0 skips it")
+    add_settings_arguments(parser)
+    args = parser.parse_args()
+    args.workers = args.workers or [1, os.cpu_count() or 1]
+    asyncio.run(main(args))
@@ -0,0 +1,136 @@
+"""Startup time of the API process and of the Celery worker.
+
+Starts `uvicorn src.main:app` `--runs` times with the database checks of
+`init_db` on and with `DB_INIT=false`, and reports the seconds until
+`/health` first answers and the clients and engines the process created by
+then. For the worker, the seconds to import `src.tasks.tasks` and run its
+`worker_process_init` handlers, which is what a Celery pool process does
+before its first task, and what it created.
+
+Needs the Postgres database from `.env`.
+
+    python -m benchmarks.startup --runs 5
+"""
+
+import argparse
+import json
+import logging
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+from src import config
+
+API_KEY = config.SERVER_API_KEY or "benchmark"
+
+WORKER_SCRIPT = """
+import json, time
+started_at = time.perf_counter()
+from src.tasks.tasks import start_telegram_client, close_telegram_client
+imported_at = time.perf_counter()
+start_telegram_client()
+ready_at = time.perf_counter()
+from src.utils.resources import resources
+created = resources.created()
+close_telegram_client()
+print(json.dumps({"import": imported_at - started_at, "ready": ready_at - started_at, "created": created}))
+"""
+
+
+# One line per health poll otherwise
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def environment(**overrides) -> dict:
+    env = dict(os.environ)
+    # No refusal refresh, it would call the model at startup
+    env["REFUSAL_POOL_REFRESH"] = "0"
+    env["SERVER_API_KEY"] = API_KEY
+    env.update(overrides)
+    return env
+
+
+def api_startup(db_init: bool):
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}/api/{config.API_VERSION}"
+    started_at = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "src.main:app", "--port", str(port), "--log-level", "warning"],
+        env=environment(DB_INIT=str(db_init).lower()),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        with httpx.Client(timeout=1) as client:
+            while True:
+                if process.poll() is not None:
+                    raise RuntimeError("The API process exited, is the database up?")
+                try:
+                    if client.get(f"{base_url}/health").status_code == 200:
+                        break
+                except httpx.TransportError:
+                    time.sleep(0.005)
+            seconds = time.perf_counter() - started_at
+            created = client.get(
+                f"{base_url}/resources", headers={"Authorization": f"Bearer {API_KEY}"}
+            ).json()["open"]
+    finally:
+        process.terminate()
+        process.wait()
+    return seconds, created
+
+
+def worker_startup():
+    output = subprocess.run(
+        [sys.executable, "-c", WORKER_SCRIPT],
+        env=environment(),
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    return result["import"], result["ready"], result["created"]
+
+
+def library_imports() -> float:
+    """Seconds to import the libraries alone, the floor of both processes."""
+    script = (
+        "import time; started_at = time.perf_counter(); "
+        "import agents, openai, fastapi, sqlalchemy.ext.asyncio, celery, asyncpg; "
+        "print(time.perf_counter() - started_at)"
+    )
+    return float(subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True).stdout)
+
+
+def main(runs: int) -> None:
+    print(f"libraries alone {statistics.median(library_imports() for _ in range(runs)):6.2f} s\n")
+    for db_init in (True, False):
+        results = [api_startup(db_init) for _ in range(runs)]
+        seconds = [result[0] for result in results]
+        print(
+            f"API DB_INIT={str(db_init).lower():5} until /health p50 {statistics.median(seconds):6.2f} s "
+            f"min {min(seconds):6.2f} s | created {results[-1][1]}"
+        )
+    results = [worker_startup() for _ in range(runs)]
+    print(
+        f"Celery worker import p50 {statistics.median(r[0] for r in results):6.2f} s "
+        f"ready p50 {statistics.median(r[1] for r in results):6.2f} s | created {results[-1][2]}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+    main(args.runs)
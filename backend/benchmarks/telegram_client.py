@@ -0,0 +1,82 @@
+"""Connection reuse of the shared Telegram client against a local mock Bot API.
+
+    python -m benchmarks.telegram_client --sends 1000
+"""
+
+import argparse
+import asyncio
+import socket
+import time
+
+import httpx
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+from src.utils.telegram import TelegramClient
+
+connections = set()
+
+
+async def send_message(request: Request):
+    connections.add(request.scope["client"])
+    return JSONResponse({"ok": True, "result": {"message_id": 1}})
+
+
+mock_bot_api = Starlette(routes=[Route("/botTEST/sendMessage", send_message, methods=["POST"])])
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def per_call_clients(base_url: str, sends: int) -> float:
+    # What `send_telegram_message` used to do
+    started_at = time.perf_counter()
+    for i in range(sends):
+        async with httpx.AsyncClient() as client:
+            await client.post(f"{base_url}/sendMessage", data={"chat_id": i, "text": "hi"})
+    return time.perf_counter() - started_at
+
+
+async def shared_client(base_url: str, sends: int) -> float:
+    client = TelegramClient(base_url=base_url)
+    started_at = time.perf_counter()
+    for i in range(sends):
+        await client.call("sendMessage", {"chat_id": i, "text": "hi"})
+    elapsed = time.perf_counter() - started_at
+    await client.aclose()
+    return elapsed
+
+
+async def main(sends: int):
+    port = free_port()
+    server = uvicorn.Server(
+        uvicorn.Config(mock_bot_api, host="127.0.0.1", port=port, log_level="warning")
+    )
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+
+    base_url = f"http://127.0.0.1:{port}/botTEST"
+    for name, runner in (("per call client", per_call_clients), ("shared client", shared_client)):
+        connections.clear()
+        elapsed = await runner(base_url, sends)
+        print(
+            f"{name:>16}: {sends} sends in {elapsed:.2f}s "
+            f"({sends / elapsed:.0f}/s), {len(connections)} TCP connections"
+        )
+
+    server.should_exit = True
+    await server_task
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sends", type=int, default=1000)
+    args = parser.parse_args()
+    asyncio.run(main(args.sends))
@@ -0,0 +1,126 @@
+"""Webhook latency under a burst of concurrent updates, with the pool stats.
+
+Every update comes from a different verified chat with a cold conversation
+cache, so each one runs the update claim, `SELECT User`, history window and
+summary queries. Jobs go to the in memory broker and are not processed, the
+numbers are the webhook acknowledgement and the time until the ingestor
+processed every update, which is where the database work happens.
+
+Needs the Postgres database from `.env`, it creates throwaway users and
+deletes them at the end. Compare pool settings through the environment:
+
+    DB_POOL_SIZE=5 DB_MAX_OVERFLOW=10 DB_POOL_TIMEOUT=30 python -m benchmarks.webhook_load
+    python -m benchmarks.webhook_load --updates 500
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+os.environ["TG_WORKER_BACKEND"] = "async"
+os.environ["TG_WORKER_BROKER_URL"] = "memory://"
+
+import httpx  # noqa: E402
+from sqlalchemy import delete, insert  # noqa: E402
+
+from src.database.database import AsyncSessionLocal, init_db, pool_snapshot  # noqa: E402
+from src.models.telegram_update import TelegramUpdate  # noqa: E402
+from src.models.user import User  # noqa: E402
+from src.routes.telegram import router as telegram_router, update_ingestor  # noqa: E402
+from src import config  # noqa: E402
+
+from fastapi import FastAPI  # noqa: E402
+
+BENCH_CHAT_ID_BASE = 9_100_000_000
+# Unique per run, the ingestor drops update ids it has seen
+UPDATE_ID_BASE = int(time.time() * 1000) * 10_000
+
+
+def update(i: int) -> dict:
+    chat_id = BENCH_CHAT_ID_BASE + i
+    return {
+        "update_id": UPDATE_ID_BASE + i,
+        "message": {
+            "message_id": i,
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Load"},
+            "chat": {"id": chat_id, "type": "private"},
+            "date": int(time.time()),
+            "text": "I feel anxious before exams",
+        },
+    }
+
+
+def percentile(samples, fraction: float) -> float:
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+async def main(updates: int) -> None:
+    await init_db()
+    chat_ids = [str(BENCH_CHAT_ID_BASE + i) for i in range(updates)]
+    async with AsyncSessionLocal() as session:
+        await session.execute(
+            insert(User),
+            [
+                {"first_name": "Load", "chat_id": chat_id, "is_verified": True, "age": 30, "gender": "Other"}
+                for chat_id in chat_ids
+            ],
+        )
+        await session.commit()
+
+    app = FastAPI()
+    app.include_router(telegram_router)
+    url = f"/api/{config.API_VERSION}/telegram/webhook"
+    timings = []
+    errors = 0
+
+    async def post(client, i):
+        nonlocal errors
+        started_at = time.perf_counter()
+        response = await client.post(url, json=update(i))
+        timings.append((time.perf_counter() - started_at) * 1000)
+        if response.status_code != 200:
+            errors += 1
+
+    await update_ingestor.start()
+    try:
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            started_at = time.perf_counter()
+            await asyncio.gather(*(post(client, i) for i in range(updates)))
+            acked = time.perf_counter() - started_at
+            await update_ingestor.join()
+            elapsed = time.perf_counter() - started_at
+
+        pool = pool_snapshot()["async"]
+        print(
+            f"pool_size={config.DB_POOL_SIZE} max_overflow={config.DB_MAX_OVERFLOW} "
+            f"statement_cache={config.DB_STATEMENT_CACHE_SIZE}"
+        )
+        print(
+            f"{updates} updates acknowledged in {acked:.2f}s, errors: {errors}, "
+            f"p50 {statistics.median(timings):.1f} ms, p95 {percentile(timings, 0.95):.1f} ms, "
+            f"p99 {percentile(timings, 0.99):.1f} ms"
+        )
+        print(f"processed in {elapsed:.2f}s, ingestor: {update_ingestor.snapshot()}")
+        print(
+            f"checkouts {pool['checkouts']}, overflow checkouts {pool['overflow_checkouts']}, "
+            f"timeouts {pool['timeouts']}, checkout wait p95 {pool['wait']['p95_ms']} ms"
+        )
+    finally:
+        await update_ingestor.stop()
+        async with AsyncSessionLocal() as session:
+            await session.execute(
+                delete(TelegramUpdate).filter(TelegramUpdate.update_id >= UPDATE_ID_BASE)
+            )
+            await session.execute(delete(User).filter(User.chat_id.in_(chat_ids)))
+            await session.commit()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=500)
+    args = parser.parse_args()
+    asyncio.run(main(args.updates))
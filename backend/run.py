@@ -1,5 +1,55 @@
+def check_workers(config, logger) -> None:
+    """Settings that only work in one process."""
+    if config.SERVER_WORKERS > 1 and config.TG_INGEST_MODE == "polling":
+        raise SystemExit(
+            "Telegram allows one getUpdates consumer, run `python -m src.tasks.polling` "
+            "next to the API and set TG_INGEST_MODE=webhook for it"
+        )
+    if (
+        config.SERVER_WORKERS > 1
+        and config.TG_WORKER_BACKEND == "async"
+        and config.TG_WORKER_BROKER_URL.startswith("memory://")
+        and not config.TG_COALESCE_REDIS_URL
+    ):
+        logger.warning(
+            "Every worker process coalesces the messages it receives on its own, "
+            "set TG_COALESCE_REDIS_URL to merge bursts across them"
+        )
+    if config.SERVER_WORKERS > 1:
+        logger.warning(
+            f"{config.SERVER_WORKERS} worker processes each keep their own state: "
+            "the conversation cache, invalidated only in the process that got the "
+            "profile change; the update dedup set, duplicates across processes are "
+            "dropped by the database claim only; the /metrics registry, a scrape "
+            "reports the one process that answered it; the daily quota counters, "
+            "which see the other processes' usage up to USAGE_QUOTA_REFRESH "
+            f"({config.USAGE_QUOTA_REFRESH}s) plus USAGE_FLUSH_INTERVAL "
+            f"({config.USAGE_FLUSH_INTERVAL}s) late"
+        )
+
+
 if __name__ == "__main__":
     import uvicorn
     from src import config
+    from src import logging
+
+    logger = logging.getLogger(__name__)
 
-    uvicorn.run("src.main:app", host="0.0.0.0", port=config.PORT, reload=True)
+    if config.SERVER_RELOAD:
+        uvicorn.run("src.main:app", host=config.SERVER_HOST, port=config.PORT, reload=True)
+    else:
+        check_workers(config, logger)
+        # uvicorn waits for the requests in flight on SIGTERM, streamed
+        # `/agent/chat` replies included, before the lifespan shutdown
+        uvicorn.run(
+            "src.main:app",
+            host=config.SERVER_HOST,
+            port=config.PORT,
+            workers=config.SERVER_WORKERS,
+            loop=config.SERVER_LOOP,
+            http=config.SERVER_HTTP,
+            backlog=config.SERVER_BACKLOG,
+            timeout_keep_alive=config.SERVER_KEEPALIVE,
+            timeout_graceful_shutdown=config.SERVER_GRACEFUL_TIMEOUT,
+            proxy_headers=True,
+        )
@@ -1,9 +1,7 @@
-from agents import (
-    Agent,
-    OpenAIResponsesModel,
-)
+from agents import Agent
 from pydantic import BaseModel
 
+from src.utils.llm import LazyResponsesModel
 from src import config
 from src.prompts.prompts import GUARDRAIL_PROMPT
 
@@ -17,8 +15,5 @@ guardrail_agent = Agent(
     name="Gaurdrail Check",
     instructions=GUARDRAIL_PROMPT,
     output_type=GuardrailCheckOutput,
-    model=OpenAIResponsesModel(
-        model=config.OPENAI_GUARDRAIL_MODEL,
-        openai_client=config.OPENAI_ASYNC_CLIENT,
-    ),
+    model=LazyResponsesModel(config.OPENAI_GUARDRAIL_MODEL),
 )
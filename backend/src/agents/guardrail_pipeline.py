@@ -0,0 +1,130 @@
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from agents import Runner
+from agents.usage import Usage
+
+from src.agents.guard_rail import GuardrailCheckOutput, guardrail_agent
+from src.agents.pre_classifier import pre_classifier
+from src.cache.guardrail import CachedVerdict, guardrail_cache, guardrail_cache_key
+from src.utils.context import guardrail_window
+from src.utils.metrics import GUARDRAIL_SECONDS
+from src import config
+
+
+@dataclass
+class GuardrailVerdict:
+    output: GuardrailCheckOutput
+    # Tokens actually spent, zero when the verdict did not need the LLM
+    usage: Usage = field(default_factory=Usage)
+    source: str = "llm"
+    saved_tokens: int = 0
+
+    @property
+    def is_mental_health(self) -> bool:
+        return self.output.is_mental_health
+
+
+def pre_classify(
+    formatted_chat_history: List[Dict[str, str]],
+    threshold: float = config.GUARDRAIL_PRE_CLASSIFIER_THRESHOLD,
+) -> Optional[GuardrailVerdict]:
+    """Local verdict on the last user turn when the classifier is confident."""
+    if not formatted_chat_history or formatted_chat_history[-1].get("role") != "user":
+        return None
+    result = pre_classifier.classify(formatted_chat_history[-1]["content"])
+    if result is None or result.confidence < threshold:
+        return None
+    return GuardrailVerdict(
+        output=GuardrailCheckOutput(
+            is_mental_health=result.is_mental_health, reasoning=result.reasoning
+        ),
+        source=f"pre_classifier:{pre_classifier.name}",
+    )
+
+
+def _usage_of(run_result) -> Usage:
+    usage = Usage()
+    for item in run_result.raw_responses:
+        usage.add(item.usage)
+    return usage
+
+
+async def _check_guardrail(formatted_chat_history: List[Dict[str, str]]) -> GuardrailVerdict:
+    formatted_chat_history = guardrail_window(formatted_chat_history)
+    verdict = pre_classify(formatted_chat_history)
+    if verdict is not None:
+        return verdict
+
+    key = guardrail_cache_key(formatted_chat_history) if config.GUARDRAIL_CACHE else None
+    if key is not None:
+        cached = await guardrail_cache.get(key)
+        if cached is not None:
+            return GuardrailVerdict(
+                output=GuardrailCheckOutput(**cached.output),
+                source="cache",
+                saved_tokens=cached.total_tokens,
+            )
+
+    result = await Runner.run(starting_agent=guardrail_agent, input=formatted_chat_history)
+    verdict = GuardrailVerdict(
+        output=result.final_output_as(GuardrailCheckOutput), usage=_usage_of(result)
+    )
+    if key is not None:
+        await guardrail_cache.set(
+            key,
+            CachedVerdict(
+                output=verdict.output.model_dump(),
+                total_tokens=verdict.usage.total_tokens,
+            ),
+        )
+    return verdict
+
+
+def _check_guardrail_sync(formatted_chat_history: List[Dict[str, str]]) -> GuardrailVerdict:
+    formatted_chat_history = guardrail_window(formatted_chat_history)
+    verdict = pre_classify(formatted_chat_history)
+    if verdict is not None:
+        return verdict
+
+    key = guardrail_cache_key(formatted_chat_history) if config.GUARDRAIL_CACHE else None
+    if key is not None:
+        cached = guardrail_cache.get_sync(key)
+        if cached is not None:
+            return GuardrailVerdict(
+                output=GuardrailCheckOutput(**cached.output),
+                source="cache",
+                saved_tokens=cached.total_tokens,
+            )
+
+    result = Runner.run_sync(starting_agent=guardrail_agent, input=formatted_chat_history)
+    verdict = GuardrailVerdict(
+        output=result.final_output_as(GuardrailCheckOutput), usage=_usage_of(result)
+    )
+    if key is not None:
+        guardrail_cache.set_sync(
+            key,
+            CachedVerdict(
+                output=verdict.output.model_dump(),
+                total_tokens=verdict.usage.total_tokens,
+            ),
+        )
+    return verdict
+
+
+async def check_guardrail(formatted_chat_history: List[Dict[str, str]]) -> GuardrailVerdict:
+    """Guardrail verdict for the last user turn, from the local pre classifier
+    or the cache when possible. The LLM only sees the small guardrail window."""
+    started_at = time.perf_counter()
+    verdict = await _check_guardrail(formatted_chat_history)
+    GUARDRAIL_SECONDS.labels(verdict.source).observe(time.perf_counter() - started_at)
+    return verdict
+
+
+def check_guardrail_sync(formatted_chat_history: List[Dict[str, str]]) -> GuardrailVerdict:
+    """Blocking version of `check_guardrail` for the Celery worker."""
+    started_at = time.perf_counter()
+    verdict = _check_guardrail_sync(formatted_chat_history)
+    GUARDRAIL_SECONDS.labels(verdict.source).observe(time.perf_counter() - started_at)
+    return verdict
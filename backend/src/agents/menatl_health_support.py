@@ -1,7 +1,9 @@
-from agents import Agent, OpenAIResponsesModel, WebSearchTool
+from agents import Agent, WebSearchTool
 
 from src.tools.current_date_tool import fetch_current_date_time
 from src.tools.save_callback_request import SaveCallbackRequestTool
+from src.tools.timing import timed_tool
+from src.utils.llm import LazyResponsesModel
 from src import config
 from src.schemas.user import UserInfo
 from src.prompts.prompts import SYSTEM_PROMPT
@@ -10,8 +12,8 @@ from src.prompts.prompts import SYSTEM_PROMPT
 mental_health_support_agent = Agent[UserInfo](
     name="Mental Health Support Agent",
     tools=[
-        fetch_current_date_time,
-        SaveCallbackRequestTool,
+        timed_tool(fetch_current_date_time),
+        timed_tool(SaveCallbackRequestTool),
         WebSearchTool(
             user_location={
                 "country": "IN",
@@ -21,9 +23,6 @@ mental_health_support_agent = Agent[UserInfo](
             search_context_size="high",
         ),
     ],
-    model=OpenAIResponsesModel(
-        model=config.OPENAI_AGENT_MODEL,
-        openai_client=config.OPENAI_ASYNC_CLIENT,
-    ),
+    model=LazyResponsesModel(config.OPENAI_AGENT_MODEL),
     instructions=SYSTEM_PROMPT,
 )
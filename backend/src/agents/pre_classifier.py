@@ -0,0 +1,140 @@
+import importlib
+import re
+from dataclasses import dataclass
+from typing import List, Optional, Pattern, Protocol, Tuple
+
+from src import config
+from src import logging
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PreClassification:
+    is_mental_health: bool
+    confidence: float
+    reasoning: str
+
+
+class PreClassifier(Protocol):
+    name: str
+
+    def classify(self, text: str) -> Optional[PreClassification]:
+        """A verdict, or None when the classifier has no opinion."""
+        ...
+
+
+def _words(*phrases: str) -> Pattern:
+    return re.compile(r"\b(?:" + "|".join(phrases) + r")\b", re.IGNORECASE)
+
+
+GREETING = re.compile(
+    r"^\W*(?:hi+|hello+|hey+|hiya|yo|namaste|good (?:morning|afternoon|evening|night)|"
+    r"bye+|good ?bye|see (?:you|ya)(?: later| soon)?|take care|"
+    r"thanks?(?: you)?(?: so much| a lot)?|thank u|thx|ty|ok(?:ay)?(?: thanks?)?|cool)"
+    r"(?: there| bot| again)?\W*$",
+    re.IGNORECASE,
+)
+
+CRISIS = _words(
+    r"suicid\w*",
+    r"kill(?:ing)? myself",
+    r"end(?:ing)? my life",
+    r"want to die",
+    r"self[- ]?harm\w*",
+    r"hurt(?:ing)? myself",
+    r"no reason to live",
+)
+
+MENTAL_HEALTH = _words(
+    r"anxi\w+",
+    r"depress\w*",
+    r"stress\w*",
+    r"panic(?: attacks?)?",
+    r"lonel\w+",
+    r"overwhelm\w*",
+    r"burn(?:ed|t)? ?out",
+    r"grie\w+",
+    r"sad(?:ness)?",
+    r"insomnia",
+    r"can'?t sleep",
+    r"therap\w+",
+    r"counsel\w+",
+    r"mental health",
+    r"well[- ]?being",
+    r"meditat\w+",
+    r"mindful\w*",
+    r"breathing exercises?",
+    r"self[- ]?care",
+    r"trauma\w*",
+)
+
+OFF_TOPIC = _words(
+    r"python",
+    r"javascript",
+    r"code",
+    r"programming",
+    r"bitcoin",
+    r"crypto\w*",
+    r"stock(?:s| market)?",
+    r"recipe",
+    r"football",
+    r"cricket score",
+    r"weather",
+    r"translate",
+    r"homework",
+)
+
+
+class KeywordPreClassifier:
+    """Regex rules for the traffic that never needs the LLM: whole message
+    greetings and goodbyes, and crisis messages.
+
+    Mental health and off topic vocabulary match anywhere in a message, "I am
+    stressed, write me an essay" has both, so those rules stay below the
+    default threshold and only decide when it is lowered. A message matching
+    both on and off topic rules gets no verdict."""
+
+    name = "keyword"
+
+    rules: List[Tuple[Pattern, bool, float, str]] = [
+        (GREETING, True, 0.99, "General greeting or good bye message."),
+        (CRISIS, True, 0.99, "The user is in distress and needs mental health support."),
+        (MENTAL_HEALTH, True, 0.8, "The user talks about mental health and well being."),
+        (OFF_TOPIC, False, 0.85, "The query is not about mental health or well being."),
+    ]
+
+    def classify(self, text: str) -> Optional[PreClassification]:
+        matches = [rule for rule in self.rules if rule[0].search(text or "")]
+        if not matches:
+            return None
+        if len({is_mental_health for _, is_mental_health, _, _ in matches}) > 1:
+            # Crisis words always win over anything that looks off topic
+            crisis = [rule for rule in matches if rule[0] is CRISIS]
+            if not crisis:
+                return None
+            matches = crisis
+        _, is_mental_health, confidence, reasoning = max(matches, key=lambda r: r[2])
+        return PreClassification(is_mental_health, confidence, reasoning)
+
+
+class NoPreClassifier:
+    name = "none"
+
+    def classify(self, text: str) -> Optional[PreClassification]:
+        return None
+
+
+def load_pre_classifier(spec: str) -> PreClassifier:
+    """`keyword`, `none` or `package.module:ClassName` for a custom one."""
+    if spec == "keyword":
+        return KeywordPreClassifier()
+    if spec in ("", "none"):
+        return NoPreClassifier()
+    module_name, _, class_name = spec.partition(":")
+    classifier = getattr(importlib.import_module(module_name), class_name)()
+    logger.info(f"Loaded guardrail pre classifier: {spec}")
+    return classifier
+
+
+pre_classifier = load_pre_classifier(config.GUARDRAIL_PRE_CLASSIFIER)
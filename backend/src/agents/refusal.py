@@ -0,0 +1,196 @@
+import asyncio
+import random
+import re
+import time
+from typing import Dict, List, Optional, Pattern, Tuple
+
+from src.prompts.prompts import GUARDRAIL_FALSE_PROMPT, REFUSAL_POOL_PROMPT
+from src.utils.metrics import SAVED_TOKENS, TOKENS
+from src.utils.tokens import count_tokens
+from src.utils import llm
+from src import config
+from src import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _words(*phrases: str) -> Pattern:
+    return re.compile(r"\b(?:" + "|".join(phrases) + r")\b", re.IGNORECASE)
+
+
+GENERAL = "general"
+
+# Clusters of guardrail reasonings, the topic is what the pool prompt asks
+# refusals for
+CLUSTERS: List[Tuple[str, str, Pattern]] = [
+    (
+        "technology",
+        "programming, software or other technical topics",
+        _words(r"cod(?:e|ing)", r"programm\w*", r"python", r"javascript", r"software", r"computers?", r"technical"),
+    ),
+    (
+        "finance",
+        "money, investing or other financial topics",
+        _words(r"financ\w*", r"invest\w*", r"stocks?", r"crypto\w*", r"bitcoin", r"money", r"tax\w*"),
+    ),
+    (
+        "medical",
+        "physical health, medication or medical diagnosis",
+        _words(r"medic\w*", r"diagnos\w*", r"prescri\w*", r"drugs?", r"physical", r"symptoms?"),
+    ),
+    (
+        "everyday",
+        "everyday topics like cooking, sports, weather, travel or homework",
+        _words(r"recipes?", r"cook\w*", r"weather", r"sports?", r"football", r"travel\w*", r"translat\w*", r"homework"),
+    ),
+    (GENERAL, "topics unrelated to mental health", re.compile(r"$^")),
+]
+
+# Served until the first refresh, and whenever it fails
+DEFAULT_TEMPLATES: Dict[str, List[str]] = {
+    "technology": [
+        "I'm not able to help with technical questions, I'm here to support your mental health and well being. "
+        "If anything is on your mind or weighing on you, I'm happy to talk about it.",
+        "Programming and tech are outside what I can help with, sorry. "
+        "Is there anything about how you are feeling that you would like to talk about?",
+    ],
+    "finance": [
+        "I can't help with money or financial questions, I'm here for your mental health and well being. "
+        "If financial worries are stressing you out, I'm glad to talk about that.",
+        "Financial advice is outside what I can offer, sorry. "
+        "How are you feeling lately? I'm here if you want to talk.",
+    ],
+    "medical": [
+        "I'm not able to give medical advice, please reach out to a doctor for that. "
+        "I'm here to support your mental health and well being whenever you need it.",
+        "Questions about physical health and medication are best answered by a medical professional. "
+        "If you would like to talk about how you are coping, I'm here for you.",
+    ],
+    "everyday": [
+        "That's outside what I can help with, I'm here to support your mental health and well being. "
+        "Is there anything on your mind you would like to talk about?",
+        "Sorry, I can't help with that one. "
+        "I'm here for conversations about how you are feeling, stress, sleep or anything weighing on you.",
+    ],
+    GENERAL: [
+        "I'm sorry, I can't help with that, I'm here to support your mental health and well being. "
+        "Please feel free to share anything that is on your mind.",
+        "That's not something I can answer, but I'm always here to talk about how you are feeling. "
+        "Is there anything weighing on you today?",
+    ],
+}
+
+
+def cluster_of(reasoning: Optional[str]) -> str:
+    """The cluster whose words appear most often in the guardrail reasoning."""
+    counts = [
+        (len(pattern.findall(reasoning or "")), name) for name, _, pattern in CLUSTERS
+    ]
+    hits, name = max(counts, key=lambda count: count[0])
+    return name if hits else GENERAL
+
+
+def answer_chunks(text: str) -> List[str]:
+    """Word sized pieces, streamed like model deltas."""
+    return re.findall(r"\S+\s*", text)
+
+
+def llm_refusal_tokens(query: str, reasoning: str, refusal: str) -> int:
+    """Estimate of what writing this refusal with the model would have cost."""
+    prompt = GUARDRAIL_FALSE_PROMPT.format(reasoning=reasoning, query=query)
+    return count_tokens(prompt) + count_tokens(refusal)
+
+
+class RefusalPool:
+    """Pre generated refusals per reasoning cluster, so an off topic query
+    costs no second model call. `refresh` asks the model for new ones, one
+    call per cluster, and keeps the old templates of a cluster it fails for."""
+
+    def __init__(
+        self,
+        size: int = config.REFUSAL_POOL_SIZE,
+        refresh_interval: float = config.REFUSAL_POOL_REFRESH,
+    ):
+        self.size = size
+        self.refresh_interval = refresh_interval
+        self.templates: Dict[str, List[str]] = {
+            name: list(templates) for name, templates in DEFAULT_TEMPLATES.items()
+        }
+        self.served = 0
+        self.refreshed_at: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = asyncio.Event()
+
+    def pick(self, reasoning: Optional[str]) -> str:
+        templates = self.templates.get(cluster_of(reasoning)) or self.templates[GENERAL]
+        return random.choice(templates)
+
+    def refuse(self, query: str, reasoning: Optional[str]) -> str:
+        """A refusal for the query, counted as the tokens the model call saved."""
+        refusal = self.pick(reasoning)
+        self.served += 1
+        SAVED_TOKENS.labels("refusal_template").inc(
+            llm_refusal_tokens(query, reasoning or "", refusal)
+        )
+        return refusal
+
+    async def refresh(self) -> None:
+        for name, topic, _ in CLUSTERS:
+            try:
+                completion = await llm.async_client().responses.create(
+                    model=config.OPENAI_AGENT_MODEL,
+                    input=[
+                        {
+                            "role": "user",
+                            "content": REFUSAL_POOL_PROMPT.format(count=self.size, topic=topic),
+                        }
+                    ],
+                )
+            except Exception as e:
+                logger.error(f"Refreshing {name} refusals failed: {e}")
+                continue
+            usage = completion.usage
+            if usage is not None:
+                TOKENS.labels("refusal_pool", config.OPENAI_AGENT_MODEL, "input").inc(usage.input_tokens)
+                TOKENS.labels("refusal_pool", config.OPENAI_AGENT_MODEL, "output").inc(usage.output_tokens)
+            templates = [line.strip() for line in completion.output_text.splitlines() if line.strip()]
+            if templates:
+                self.templates[name] = templates[: self.size]
+        self.refreshed_at = time.time()
+        logger.info("Refusal templates refreshed")
+
+    async def start(self) -> None:
+        if config.REFUSAL_MODE != "template" or self.refresh_interval <= 0:
+            return
+        if self._task is not None and not self._task.done():
+            return
+        self._stopping.clear()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._stopping.set()
+        # A refresh in flight is not worth waiting for
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def _run(self) -> None:
+        while not self._stopping.is_set():
+            await self.refresh()
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.refresh_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def snapshot(self) -> Dict:
+        return {
+            "mode": config.REFUSAL_MODE,
+            "served": self.served,
+            "refreshed_at": self.refreshed_at,
+            "templates": {name: len(templates) for name, templates in self.templates.items()},
+        }
+
+
+refusal_pool = RefusalPool()
@@ -0,0 +1,156 @@
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Any, Deque, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from src import config
+
+
+class Turn(NamedTuple):
+    query: str
+    response: str
+
+
+@dataclass
+class ChatState:
+    is_verified: bool
+    user_info: Optional[Dict[str, Any]]
+    expires_at: float
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    expirations: int = 0
+    invalidations: int = 0
+
+
+class ConversationCache:
+    """Bounded LRU cache with TTL of the verified users, keyed by `chat_id`.
+
+    It lives in the process memory, so only verified users are kept: a
+    verification can only be granted, and an unverified user is read again on
+    every message until the registration shows up. Profile changes made
+    through another process show up once the entry expires.
+
+    The turns of a chat are read from the `messages` table every time. The
+    turns this process wrote are also kept for `recent_ttl` seconds, until the
+    write behind buffer has flushed them, see `with_recent_turns`."""
+
+    def __init__(
+        self,
+        max_chats: int = config.CONVERSATION_CACHE_SIZE,
+        ttl: float = config.CONVERSATION_CACHE_TTL,
+        max_turns: int = config.HISTORY_TURNS,
+        recent_ttl: float = config.CONVERSATION_RECENT_TTL,
+    ):
+        self.max_chats = max_chats
+        self.ttl = ttl
+        self.max_turns = max_turns
+        self.recent_ttl = recent_ttl
+        self._entries: OrderedDict[str, ChatState] = OrderedDict()
+        self._recent: OrderedDict[str, Deque[Tuple[float, Turn]]] = OrderedDict()
+        self.stats = CacheStats()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, chat_id: str) -> Optional[ChatState]:
+        state = self._entries.get(chat_id)
+        if state is None:
+            self.stats.misses += 1
+            return None
+        if state.expires_at < time.monotonic():
+            del self._entries[chat_id]
+            self.stats.expirations += 1
+            self.stats.misses += 1
+            return None
+        self._entries.move_to_end(chat_id)
+        self.stats.hits += 1
+        return state
+
+    def missing(self, chat_ids: Iterable[str]) -> List[str]:
+        """The chats without a live entry, not counted as lookups."""
+        now = time.monotonic()
+        return [
+            chat_id
+            for chat_id in chat_ids
+            if chat_id not in self._entries or self._entries[chat_id].expires_at < now
+        ]
+
+    def put_user(self, chat_id: str, user) -> ChatState:
+        """The verification state and `UserInfo` fields of a `User` row,
+        cached when the user is verified."""
+        if not user.is_verified:
+            self._entries.pop(chat_id, None)
+            return ChatState(is_verified=False, user_info=None, expires_at=0)
+        state = ChatState(
+            is_verified=True,
+            user_info={
+                "name": user.first_name,
+                "chat_id": chat_id,
+                "age": user.age,
+                "gender": user.gender,
+            },
+            expires_at=time.monotonic() + self.ttl,
+        )
+        self._entries[chat_id] = state
+        self._entries.move_to_end(chat_id)
+        while len(self._entries) > self.max_chats:
+            self._entries.popitem(last=False)
+            self.stats.evictions += 1
+        return state
+
+    def append_turn(self, chat_id: str, query: str, response: str) -> None:
+        """Called by the write path when it queues a `Message`."""
+        recent = self._recent.get(chat_id)
+        if recent is None:
+            recent = self._recent[chat_id] = deque(maxlen=self.max_turns)
+        recent.append((time.monotonic() + self.recent_ttl, Turn(query, response)))
+        self._recent.move_to_end(chat_id)
+        while len(self._recent) > self.max_chats:
+            self._recent.popitem(last=False)
+
+    def with_recent_turns(self, chat_id: str, messages: List[Any]) -> List[Turn]:
+        """The turns of `messages`, read from the database in chronological
+        order, followed by the turns this process wrote that are not in them
+        yet."""
+        turns = [Turn(m.query, m.response) for m in messages]
+        recent = self._recent.get(chat_id)
+        if not recent:
+            return turns
+        now = time.monotonic()
+        while recent and recent[0][0] <= now:
+            recent.popleft()
+        if not recent:
+            del self._recent[chat_id]
+            return turns
+        tail = turns[-len(recent) :]
+        unflushed = [turn for _, turn in recent if turn not in tail]
+        return (turns + unflushed)[-self.max_turns :]
+
+    def invalidate(self, chat_id: str) -> None:
+        self._recent.pop(chat_id, None)
+        if self._entries.pop(chat_id, None) is not None:
+            self.stats.invalidations += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._recent.clear()
+
+    def snapshot(self) -> Dict[str, int]:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_chats,
+            "recent_chats": len(self._recent),
+            "hits": self.stats.hits,
+            "misses": self.stats.misses,
+            "evictions": self.stats.evictions,
+            "expirations": self.stats.expirations,
+            "invalidations": self.stats.invalidations,
+        }
+
+
+conversation_cache = ConversationCache()
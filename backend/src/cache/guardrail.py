@@ -0,0 +1,182 @@
+import hashlib
+import json
+import re
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from src.prompts.prompts import GUARDRAIL_PROMPT
+from src import config
+from src import logging
+
+logger = logging.getLogger(__name__)
+
+# Changing the prompt or the model changes every key
+GUARDRAIL_CACHE_VERSION = hashlib.sha256(
+    f"{config.OPENAI_GUARDRAIL_MODEL}\n{GUARDRAIL_PROMPT}".encode()
+).hexdigest()[:16]
+
+_NON_WORD = re.compile(r"[^\w\s]")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """Lower case, no punctuation or emojis, single spaces."""
+    text = _NON_WORD.sub(" ", (text or "").lower())
+    return _SPACES.sub(" ", text).strip()
+
+
+def guardrail_cache_key(
+    formatted_chat_history: List[Dict[str, str]],
+    context_turns: int = config.GUARDRAIL_CACHE_CONTEXT_TURNS,
+) -> Optional[str]:
+    """Normalized last user turn plus a hash of the `context_turns` messages
+    before it, None when there is nothing to key on."""
+    messages = [m for m in formatted_chat_history if m.get("role") != "system"]
+    if not messages or messages[-1].get("role") != "user":
+        return None
+    query = normalize_text(messages[-1]["content"])
+    if not query:
+        return None
+    context = [normalize_text(m["content"]) for m in messages[:-1]]
+    context = context[-context_turns:] if context_turns else []
+    context_hash = hashlib.sha1("\n".join(context).encode()).hexdigest()[:12]
+    return hashlib.sha256(
+        f"{GUARDRAIL_CACHE_VERSION}:{context_hash}:{query}".encode()
+    ).hexdigest()
+
+
+@dataclass
+class CachedVerdict:
+    output: Dict[str, Any]
+    # Tokens the LLM guardrail spent on this verdict, saved on every hit
+    total_tokens: int
+
+
+class GuardrailCache:
+    """Two tier cache of guardrail verdicts: an in memory LRU and, when
+    `redis_url` is set, a Redis tier shared by every process."""
+
+    def __init__(
+        self,
+        max_size: int = config.GUARDRAIL_CACHE_SIZE,
+        ttl: float = config.GUARDRAIL_CACHE_TTL,
+        redis_url: Optional[str] = config.GUARDRAIL_CACHE_REDIS_URL,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.redis_url = redis_url
+        self._entries: OrderedDict[str, Tuple[float, CachedVerdict]] = OrderedDict()
+        self._redis = None
+        self._redis_sync = None
+        self.hits = 0
+        self.misses = 0
+        self.saved_tokens = 0
+
+    def _redis_key(self, key: str) -> str:
+        return f"guardrail:{GUARDRAIL_CACHE_VERSION}:{key}"
+
+    def _get_local(self, key: str) -> Optional[CachedVerdict]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, verdict = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return verdict
+
+    def _set_local(self, key: str, verdict: CachedVerdict) -> None:
+        self._entries[key] = (time.monotonic() + self.ttl, verdict)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _record(self, verdict: Optional[CachedVerdict]) -> Optional[CachedVerdict]:
+        if verdict is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.saved_tokens += verdict.total_tokens
+        return verdict
+
+    async def get(self, key: str) -> Optional[CachedVerdict]:
+        verdict = self._get_local(key)
+        if verdict is None and self.redis_url:
+            try:
+                raw = await self._async_redis().get(self._redis_key(key))
+            except Exception as e:
+                logger.error(f"Guardrail cache read failed: {e}")
+                raw = None
+            if raw is not None:
+                verdict = CachedVerdict(**json.loads(raw))
+                self._set_local(key, verdict)
+        return self._record(verdict)
+
+    async def set(self, key: str, verdict: CachedVerdict) -> None:
+        self._set_local(key, verdict)
+        if self.redis_url:
+            try:
+                await self._async_redis().set(
+                    self._redis_key(key),
+                    json.dumps(verdict.__dict__),
+                    ex=int(self.ttl),
+                )
+            except Exception as e:
+                logger.error(f"Guardrail cache write failed: {e}")
+
+    def get_sync(self, key: str) -> Optional[CachedVerdict]:
+        verdict = self._get_local(key)
+        if verdict is None and self.redis_url:
+            try:
+                raw = self._sync_redis().get(self._redis_key(key))
+            except Exception as e:
+                logger.error(f"Guardrail cache read failed: {e}")
+                raw = None
+            if raw is not None:
+                verdict = CachedVerdict(**json.loads(raw))
+                self._set_local(key, verdict)
+        return self._record(verdict)
+
+    def set_sync(self, key: str, verdict: CachedVerdict) -> None:
+        self._set_local(key, verdict)
+        if self.redis_url:
+            try:
+                self._sync_redis().set(
+                    self._redis_key(key),
+                    json.dumps(verdict.__dict__),
+                    ex=int(self.ttl),
+                )
+            except Exception as e:
+                logger.error(f"Guardrail cache write failed: {e}")
+
+    def snapshot(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "version": GUARDRAIL_CACHE_VERSION,
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0,
+            "saved_tokens": self.saved_tokens,
+        }
+
+    def _async_redis(self):
+        if self._redis is None:
+            import redis.asyncio as redis
+
+            self._redis = redis.from_url(self.redis_url)
+        return self._redis
+
+    def _sync_redis(self):
+        if self._redis_sync is None:
+            import redis
+
+            self._redis_sync = redis.from_url(self.redis_url)
+        return self._redis_sync
+
+
+guardrail_cache = GuardrailCache()
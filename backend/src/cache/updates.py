@@ -0,0 +1,38 @@
+import time
+from collections import OrderedDict
+
+from src import config
+
+
+class SeenUpdates:
+    """Bounded, time windowed set of Telegram `update_id`s seen by this process."""
+
+    def __init__(
+        self,
+        max_size: int = config.TG_UPDATE_DEDUP_SIZE,
+        ttl: float = config.TG_UPDATE_DEDUP_TTL,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict[int, float] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add(self, update_id: int) -> bool:
+        """False when the update was already seen within the window."""
+        now = time.monotonic()
+        expires_at = self._entries.get(update_id)
+        if expires_at is not None and expires_at > now:
+            return False
+        self._entries[update_id] = now + self.ttl
+        self._entries.move_to_end(update_id)
+        # Oldest first, so expired entries are at the front
+        while self._entries and (
+            len(self._entries) > self.max_size or next(iter(self._entries.values())) <= now
+        ):
+            self._entries.popitem(last=False)
+        return True
+
+    def discard(self, update_id: int) -> None:
+        self._entries.pop(update_id, None)
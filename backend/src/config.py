@@ -1,12 +1,11 @@
+import json
 import os
 
 from dotenv import load_dotenv, find_dotenv
-from agents import set_tracing_disabled
-from openai import AsyncOpenAI, OpenAI
 
-set_tracing_disabled(disabled=True)
-
-load_dotenv(find_dotenv())
+# Deployments that set the environment themselves skip searching for `.env`
+if os.getenv("LOAD_DOTENV", "true").lower() == "true":
+    load_dotenv(find_dotenv())
 
 # Database setting
 DB_USERNAME = os.getenv("DB_USERNAME")
@@ -14,27 +13,221 @@ DB_PASSWORD = os.getenv("DB_PASSWORD")
 DB_HOST = os.getenv("DB_HOST")
 DB_PORT = os.getenv("DB_PORT")
 DB_NAME = os.getenv("DB_NAME")
+# Log every SQL statement, for debugging only
+DB_ECHO = os.getenv("DB_ECHO", "false").lower() == "true"
+# Connection pool of each engine, a process holds up to size + overflow
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+# Seconds a checkout waits for a free connection before failing
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+# Costs a round trip per checkout, only for networks that drop idle connections
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "false").lower() == "true"
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "256"))
+# Create the database and the missing tables and indexes at startup, "false"
+# for databases set up beforehand, it saves the checks on every boot
+DB_INIT = os.getenv("DB_INIT", "true").lower() == "true"
 
 # Openai settings
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 SERVER_API_KEY = os.getenv("SERVER_API_KEY")
+# Another Responses API compatible endpoint, e.g. the benchmark mock
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
+
+# One client per process for every model call. Calls wait for a slot under
+# the global and the per model limit of requests in flight, instead of
+# running into the rate limits, and are retried with jittered backoff,
+# honouring `retry-after`, until their deadline
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "32"))
+LLM_MODEL_CONCURRENCY = json.loads(os.getenv("LLM_MODEL_CONCURRENCY", "{}"))
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "64"))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "32"))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "60"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+# Seconds of one attempt, and of a whole call including its wait for a slot
+# and its retries
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+LLM_DEADLINE = float(os.getenv("LLM_DEADLINE", "120"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+LLM_RETRY_BASE = float(os.getenv("LLM_RETRY_BASE", "0.5"))
+# Upper bound on one backoff, and on how long a `retry-after` is honoured
+LLM_RETRY_MAX = float(os.getenv("LLM_RETRY_MAX", "20"))
 
 OPENAI_AGENT_MODEL = "gpt-4o-mini"
 OPENAI_GUARDRAIL_MODEL = "gpt-4o-mini"
 
-OPENAI_ASYNC_CLIENT = AsyncOpenAI(api_key=OPENAI_API_KEY)
-OPENAI_SYNC_CLIENT = OpenAI(api_key=OPENAI_API_KEY)
+# Local classifier in front of the guardrail: "keyword", "none" or
+# "package.module:ClassName", used when its confidence reaches the threshold
+GUARDRAIL_PRE_CLASSIFIER = os.getenv("GUARDRAIL_PRE_CLASSIFIER", "keyword")
+GUARDRAIL_PRE_CLASSIFIER_THRESHOLD = float(
+    os.getenv("GUARDRAIL_PRE_CLASSIFIER_THRESHOLD", "0.9")
+)
+
+# Guardrail verdict cache, the Redis tier is optional
+GUARDRAIL_CACHE = os.getenv("GUARDRAIL_CACHE", "true").lower() == "true"
+GUARDRAIL_CACHE_SIZE = int(os.getenv("GUARDRAIL_CACHE_SIZE", "10000"))
+GUARDRAIL_CACHE_TTL = float(os.getenv("GUARDRAIL_CACHE_TTL", "86400"))
+GUARDRAIL_CACHE_CONTEXT_TURNS = int(os.getenv("GUARDRAIL_CACHE_CONTEXT_TURNS", "1"))
+GUARDRAIL_CACHE_REDIS_URL = os.getenv("GUARDRAIL_CACHE_REDIS_URL")
+
+# Run the guardrail and the support agent concurrently on /agent/chat and hold
+# the agent output until the guardrail verdict is known. The agent tools may
+# run before the verdict, a refused query can still register a callback
+SPECULATIVE_GUARDRAIL = os.getenv("SPECULATIVE_GUARDRAIL", "false").lower() == "true"
+
+# Refusals of off topic queries: "template" serves a pool of pre generated
+# refusals picked by the guardrail reasoning, "llm" writes each one with the
+# model. The pool is regenerated every `REFUSAL_POOL_REFRESH` seconds by the
+# API process and the async worker, Celery and 0 keep the built in templates
+REFUSAL_MODE = os.getenv("REFUSAL_MODE", "template")
+REFUSAL_POOL_SIZE = int(os.getenv("REFUSAL_POOL_SIZE", "5"))
+REFUSAL_POOL_REFRESH = float(os.getenv("REFUSAL_POOL_REFRESH", "86400"))
 
 # Server setting
-PORT = int(os.getenv("PORT"))
+PORT = int(os.getenv("PORT", "8000"))
+SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
+# `python run.py` reloads on code changes in one process when true, for
+# development. Otherwise `SERVER_WORKERS` processes share the port, each with
+# its own event loop, database pools and in process worker. One by default,
+# the conversation cache, update dedup set, `/metrics` registry and quota
+# counters live in the process memory, see `check_workers` in run.py
+SERVER_RELOAD = (
+    os.getenv("SERVER_RELOAD", str(os.getenv("ENVIRONMENT") == "Development")).lower() == "true"
+)
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", "1"))
+# "auto" takes uvloop and httptools when installed, else asyncio and h11
+SERVER_LOOP = os.getenv("SERVER_LOOP", "auto")
+SERVER_HTTP = os.getenv("SERVER_HTTP", "auto")
+SERVER_BACKLOG = int(os.getenv("SERVER_BACKLOG", "2048"))
+# Longer than the idle timeout of the load balancer in front, so the server
+# never closes a connection the balancer is about to reuse
+SERVER_KEEPALIVE = int(os.getenv("SERVER_KEEPALIVE", "75"))
+# On SIGTERM, seconds the requests in flight, like streamed chat replies,
+# get to finish before they are cancelled
+SERVER_GRACEFUL_TIMEOUT = int(os.getenv("SERVER_GRACEFUL_TIMEOUT", "60"))
 
 API_VERSION = "v0"
 
 # Telegram setting
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-TELEGRAM_API_BASE = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}"
+# Another Bot API server, e.g. a local one or the benchmark mock
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
+TELEGRAM_API_BASE = f"{TELEGRAM_API_URL}/bot{TELEGRAM_BOT_TOKEN}"
+TELEGRAM_TIMEOUT = float(os.getenv("TELEGRAM_TIMEOUT", "10"))
+TELEGRAM_CONNECT_TIMEOUT = float(os.getenv("TELEGRAM_CONNECT_TIMEOUT", "5"))
+TELEGRAM_MAX_CONNECTIONS = int(os.getenv("TELEGRAM_MAX_CONNECTIONS", "100"))
+TELEGRAM_MAX_KEEPALIVE_CONNECTIONS = int(
+    os.getenv("TELEGRAM_MAX_KEEPALIVE_CONNECTIONS", "20")
+)
+TELEGRAM_KEEPALIVE_EXPIRY = float(os.getenv("TELEGRAM_KEEPALIVE_EXPIRY", "60"))
+TELEGRAM_HTTP2 = os.getenv("TELEGRAM_HTTP2", "true").lower() == "true"
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "3"))
+# Upper bound on how long a single 429 `retry_after` is honoured
+TELEGRAM_MAX_RETRY_AFTER = float(os.getenv("TELEGRAM_MAX_RETRY_AFTER", "30"))
+# Outbound rate limits, Telegram allows about 30 msg/s per bot and 1 msg/s per chat
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_CHAT_BURST = float(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+TELEGRAM_SEND_QUEUE_SIZE = int(os.getenv("TELEGRAM_SEND_QUEUE_SIZE", "1000"))
+# How replies are formatted: "markdown" converts the model's Markdown to
+# MarkdownV2, "entities" sends plain text with `entities`, "escape" shows
+# the Markdown literally
+TELEGRAM_FORMAT = os.getenv("TELEGRAM_FORMAT", "markdown")
+# Stream replies with `editMessageText`, only used by the async worker
+TELEGRAM_STREAMING = os.getenv("TELEGRAM_STREAMING", "false").lower() == "true"
+TELEGRAM_EDIT_INTERVAL = float(os.getenv("TELEGRAM_EDIT_INTERVAL", "1.0"))
+TELEGRAM_STREAM_PLACEHOLDER = os.getenv("TELEGRAM_STREAM_PLACEHOLDER", "✍️")
+
+# Conversation history fetched per chat, the context builder then trims it
+# to the token budget of each model
+HISTORY_TURNS = int(os.getenv("HISTORY_TURNS", "20"))
+# `/agent/chat` sessions: the stored conversation of `user_id` is used and
+# the new turn stored, the client sends only its query. The default of
+# requests that do not set `server_history`
+AGENT_CHAT_SERVER_HISTORY = os.getenv("AGENT_CHAT_SERVER_HISTORY", "false").lower() == "true"
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "8000"))
+
+# Largest page of the messages API, also the page size of NDJSON exports
+MESSAGES_PAGE_MAX = int(os.getenv("MESSAGES_PAGE_MAX", "500"))
+
+# Prompt token budgets, turns that do not fit are folded into a rolling summary
+AGENT_CONTEXT_TOKENS = int(os.getenv("AGENT_CONTEXT_TOKENS", "3000"))
+CONTEXT_TOKEN_BUDGETS = json.loads(os.getenv("CONTEXT_TOKEN_BUDGETS", "{}"))
+GUARDRAIL_CONTEXT_TOKENS = int(os.getenv("GUARDRAIL_CONTEXT_TOKENS", "400"))
+CONTEXT_SUMMARIES = os.getenv("CONTEXT_SUMMARIES", "true").lower() == "true"
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", OPENAI_AGENT_MODEL)
+
+# In process per chat cache of verified users, turns are read from the
+# database, the ones this process wrote are kept until they are surely flushed
+CONVERSATION_CACHE_SIZE = int(os.getenv("CONVERSATION_CACHE_SIZE", "10000"))
+CONVERSATION_CACHE_TTL = float(os.getenv("CONVERSATION_CACHE_TTL", "900"))
+CONVERSATION_RECENT_TTL = float(os.getenv("CONVERSATION_RECENT_TTL", "30"))
+
+# Webhook ingestion, updates are acknowledged at once and processed from a
+# queue. Redelivered `update_id`s are dropped within the dedup window, by this
+# process in memory and by every process through the database
+TG_INGEST_CONCURRENCY = int(os.getenv("TG_INGEST_CONCURRENCY", "32"))
+TG_INGEST_QUEUE_SIZE = int(os.getenv("TG_INGEST_QUEUE_SIZE", "10000"))
+TG_UPDATE_DEDUP_TTL = float(os.getenv("TG_UPDATE_DEDUP_TTL", "86400"))
+TG_UPDATE_DEDUP_SIZE = int(os.getenv("TG_UPDATE_DEDUP_SIZE", "50000"))
+# "webhook" or "polling", polling long polls `getUpdates` instead, for
+# deployments Telegram cannot reach. The offset is kept in the database
+TG_INGEST_MODE = os.getenv("TG_INGEST_MODE", "webhook")
+TG_POLL_TIMEOUT = int(os.getenv("TG_POLL_TIMEOUT", "30"))
+TG_POLL_LIMIT = int(os.getenv("TG_POLL_LIMIT", "100"))
+
+# Telegram worker setting, "celery" or "async"
+TG_WORKER_BACKEND = os.getenv("TG_WORKER_BACKEND", "celery")
+# "memory://" runs the async worker inside the API process
+TG_WORKER_BROKER_URL = os.getenv("TG_WORKER_BROKER_URL", "memory://")
+TG_WORKER_MAX_IN_FLIGHT = int(os.getenv("TG_WORKER_MAX_IN_FLIGHT", "32"))
+# A job that fails before the user got a reply is retried after
+# TG_WORKER_RETRY_DELAY seconds, doubled every attempt, the last failure goes
+# to the dead letter queue
+TG_WORKER_MAX_ATTEMPTS = int(os.getenv("TG_WORKER_MAX_ATTEMPTS", "3"))
+TG_WORKER_RETRY_DELAY = float(os.getenv("TG_WORKER_RETRY_DELAY", "1.0"))
+# A Redis worker renews its lease every third of TG_WORKER_LEASE_TTL seconds,
+# the jobs a worker held when its lease expired are queued again
+TG_WORKER_LEASE_TTL = float(os.getenv("TG_WORKER_LEASE_TTL", "30"))
+# Merge a burst of messages from one chat into a single agent turn, a burst
+# ends `TG_COALESCE_WINDOW` seconds after its last message, 0 disables it
+TG_COALESCE_WINDOW = float(os.getenv("TG_COALESCE_WINDOW", "1.0"))
+TG_COALESCE_MAX_WAIT = float(os.getenv("TG_COALESCE_MAX_WAIT", "5"))
+# Mailboxes and per chat leases shared across processes, defaults to the
+# async worker broker when it is Redis. Needed to coalesce with Celery
+TG_COALESCE_REDIS_URL = os.getenv("TG_COALESCE_REDIS_URL")
+TG_CHAT_LEASE_TTL = float(os.getenv("TG_CHAT_LEASE_TTL", "300"))
+
+# Write behind persistence of messages, "insert" or "copy" (asyncpg COPY)
+MESSAGE_WRITER_METHOD = os.getenv("MESSAGE_WRITER_METHOD", "insert")
+MESSAGE_WRITER_BATCH_SIZE = int(os.getenv("MESSAGE_WRITER_BATCH_SIZE", "200"))
+MESSAGE_WRITER_FLUSH_INTERVAL = float(os.getenv("MESSAGE_WRITER_FLUSH_INTERVAL", "0.5"))
+MESSAGE_WRITER_QUEUE_SIZE = int(os.getenv("MESSAGE_WRITER_QUEUE_SIZE", "10000"))
+# Batches that fail to insert are appended here and replayed on the next start
+MESSAGE_WRITER_SPILL_PATH = os.getenv(
+    "MESSAGE_WRITER_SPILL_PATH", "data/message_writer.spill.jsonl"
+)
+
+# Statement timing of the database engines, the other metrics are always on
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+
+# Usage ledger, rollups are flushed to the database every interval
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "5"))
+# Daily token quota per chat, 0 disables it. The counter of a chat is read
+# again from the rollups after USAGE_QUOTA_REFRESH seconds, to include the
+# usage the other processes flushed
+DAILY_TOKEN_QUOTA = int(os.getenv("DAILY_TOKEN_QUOTA", "0"))
+USAGE_QUOTA_REFRESH = float(os.getenv("USAGE_QUOTA_REFRESH", "10"))
+# USD per million input and output tokens
+MODEL_PRICES = json.loads(
+    os.getenv(
+        "MODEL_PRICES",
+        '{"gpt-4o-mini": [0.15, 0.6], "gpt-4o": [2.5, 10.0], "gpt-4.1-mini": [0.4, 1.6]}',
+    )
+)
 
 ERROR_MESSAGE = "We are facing an issue, please try after sometimes."
+QUOTA_MESSAGE = "You have reached today's message limit, please come back tomorrow."
 
 if os.getenv("ENVIRONMENT") == "Development":
     FRONTEND_URL = os.getenv("FRONTEND_URL_DEVELOPMENT")
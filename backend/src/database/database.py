@@ -1,11 +1,16 @@
 import logging
+from typing import Any, Callable, Dict, Optional
 
 import asyncpg
-from sqlalchemy import create_engine
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy import Engine, create_engine, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 
 from src import config
+from src.database.pool_metrics import InstrumentedAsyncQueuePool, InstrumentedQueuePool
+from src.utils.metrics import instrument_engine
+from src.utils.resources import resources
 from src.models.base import Base
 
 logger = logging.getLogger(__name__)
@@ -19,20 +24,100 @@ DB_PORT = config.DB_PORT
 SQLALCHEMY_DATABASE_URL = (
     f"postgresql+asyncpg://{DB_USERNAME}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 )
-logger.info(
-    f"Connecting to database: postgresql+asyncpg://{DB_USERNAME}:********@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+SQLALCHEMY_DATABASE_URL_SYNC = (
+    f"postgresql+psycopg2://{DB_USERNAME}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 )
 
-engine = create_async_engine(SQLALCHEMY_DATABASE_URL, echo=False)
-
-AsyncSessionLocal = sessionmaker(
-    engine,
+POOL_SETTINGS = {
+    "pool_size": config.DB_POOL_SIZE,
+    "max_overflow": config.DB_MAX_OVERFLOW,
+    "pool_timeout": config.DB_POOL_TIMEOUT,
+    "pool_recycle": config.DB_POOL_RECYCLE,
+}
+
+
+def _create_engine() -> AsyncEngine:
+    logger.info(
+        f"Connecting to database: postgresql+asyncpg://{DB_USERNAME}:********@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+    )
+    db_engine = create_async_engine(
+        SQLALCHEMY_DATABASE_URL,
+        echo=config.DB_ECHO,
+        poolclass=InstrumentedAsyncQueuePool,
+        pool_pre_ping=config.DB_POOL_PRE_PING,
+        # Per connection LRU of prepared statements, the ORM compiles the hot
+        # `SELECT User` / `SELECT Message` to the same SQL every time so they are
+        # parsed and planned once per connection
+        connect_args={"prepared_statement_cache_size": config.DB_STATEMENT_CACHE_SIZE},
+        **POOL_SETTINGS,
+    )
+    instrument_engine(db_engine.sync_engine, "async")
+    return db_engine
+
+
+def _create_sync_engine() -> Engine:
+    db_engine = create_engine(
+        url=SQLALCHEMY_DATABASE_URL_SYNC,
+        echo=config.DB_ECHO,
+        pool_pre_ping=True,
+        poolclass=InstrumentedQueuePool,
+        **POOL_SETTINGS,
+    )
+    instrument_engine(db_engine, "sync")
+    return db_engine
+
+
+resources.register("db_engine", _create_engine, close=AsyncEngine.dispose)
+resources.register("db_engine_sync", _create_sync_engine, close=Engine.dispose)
+
+
+def get_engine() -> AsyncEngine:
+    """The async engine, of the API process and the async worker."""
+    return resources.get("db_engine")
+
+
+def get_sync_engine() -> Engine:
+    """The sync engine, of the Celery worker."""
+    return resources.get("db_engine_sync")
+
+
+def created_engines() -> Dict[str, Engine]:
+    """The engines this process created, by metrics label, the sync ones of
+    async engines."""
+    engines = {}
+    db_engine = resources.peek("db_engine")
+    if db_engine is not None:
+        engines["async"] = db_engine.sync_engine
+    db_engine = resources.peek("db_engine_sync")
+    if db_engine is not None:
+        engines["sync"] = db_engine
+    return engines
+
+
+class LazySessionmaker:
+    """A `sessionmaker` bound to its engine on the first session."""
+
+    def __init__(self, get_bind: Callable[[], Any], **kwargs):
+        self._get_bind = get_bind
+        self._kwargs = kwargs
+        self._maker: Optional[sessionmaker] = None
+
+    def __call__(self, **kwargs):
+        if self._maker is None:
+            self._maker = sessionmaker(self._get_bind(), **self._kwargs)
+        return self._maker(**kwargs)
+
+
+AsyncSessionLocal = LazySessionmaker(
+    get_engine,
     class_=AsyncSession,
     expire_on_commit=False,
     autocommit=False,
     autoflush=False,
 )
 
+SessionLocal = LazySessionmaker(get_sync_engine)
+
 
 async def get_db():
     logger.debug("Creating new database session")
@@ -45,20 +130,25 @@ async def get_db():
         raise
 
 
-SQLALCHEMY_DATABASE_URL_SYNC = (
-    f"postgresql+psycopg2://{DB_USERNAME}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
-)
+def pool_snapshot():
+    return {name: db_engine.pool.snapshot() for name, db_engine in created_engines().items()}
 
-engine_sync = create_engine(
-    url=SQLALCHEMY_DATABASE_URL_SYNC, echo=True, pool_pre_ping=True
-)
 
-SessionLocal = sessionmaker(
-    engine_sync,
-)
+def create_missing_indexes(conn):
+    from src.models.message import SUPERSEDED_INDEXES
 
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+    for index_name in SUPERSEDED_INDEXES:
+        conn.execute(text(f'DROP INDEX IF EXISTS "{index_name}"'))
 
-async def init_db():
+
+# Postgres "invalid_catalog_name", the database does not exist
+INVALID_CATALOG_NAME = "3D000"
+
+
+async def create_database():
     try:
         logger.info("Checking if database exists")
         dsn = f"postgresql://{config.DB_USERNAME}:{config.DB_PASSWORD}@{config.DB_HOST}:{config.DB_PORT}/postgres"
@@ -93,11 +183,33 @@ async def init_db():
     except Exception as e:
         logger.error(f"Unexpected error during database initialization: {e}")
         raise
+
+
+async def create_tables():
+    async with get_engine().begin() as conn:
+        logger.info("Creating database tables if they don't exist")
+        await conn.run_sync(Base.metadata.create_all)
+        logger.info("Database tables created or already exist")
+        # `create_all` skips the indexes of tables that already exist
+        await conn.run_sync(create_missing_indexes)
+
+
+async def init_db():
+    if not config.DB_INIT:
+        logger.info("Skipping database initialization, DB_INIT is false")
+        return
+    # The database almost always exists, so the tables are created first and
+    # the `postgres` database only connected to when they cannot be
+    try:
+        await create_tables()
+        return
+    except DBAPIError as e:
+        if getattr(e.orig, "sqlstate", None) != INVALID_CATALOG_NAME:
+            logger.error(f"Error creating database tables: {str(e)}")
+            raise
+    await create_database()
     try:
-        async with engine.begin() as conn:
-            logger.info("Creating database tables if they don't exist")
-            await conn.run_sync(Base.metadata.create_all)
-            logger.info("Database tables created or already exist")
+        await create_tables()
     except Exception as e:
         logger.error(f"Error creating database tables: {str(e)}")
         raise
@@ -0,0 +1,380 @@
+import asyncio
+import fcntl
+import glob
+import json
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import asyncpg
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import DataError, DBAPIError, IntegrityError, StatementError
+
+from src.database.database import get_engine, get_sync_engine
+from src.models.base import generate_uuid
+from src.models.message import Message
+from src import config
+from src import logging
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_COLUMNS = [column.name for column in Message.__table__.columns]
+
+
+def message_record(**fields: Any) -> Dict[str, Any]:
+    """Row for the `messages` table, with the defaults the ORM would set."""
+    now = datetime.now()
+    record = {
+        "id": generate_uuid(),
+        "is_deleted": False,
+        "created_at": now,
+        "updated_at": now,
+    }
+    record.update(fields)
+    return record
+
+
+@contextmanager
+def spill_lock(path: str):
+    """Exclusive across processes, held to append to the spill file or to
+    claim it for a replay."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(f"{path}.lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def spill_records(records: List[Dict[str, Any]], error: Exception, path: str) -> None:
+    """Append records that could not be inserted to a JSONL file, they are
+    replayed on the next start."""
+    with spill_lock(path), open(path, "a") as spill_file:
+        for record in records:
+            spill_file.write(json.dumps(record, default=str) + "\n")
+        spill_file.flush()
+        os.fsync(spill_file.fileno())
+    logger.error(f"Spilled {len(records)} messages to {path}: {error}")
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def claim_spill(path: str) -> List[str]:
+    """Move the spill file, and the ones of replays that died midway, to names
+    of this process. Every process replays at startup, each record is
+    claimed by exactly one of them."""
+    prefix = f"{path}.replaying."
+    stale = [
+        claimed
+        for claimed in glob.glob(f"{glob.escape(prefix)}*")
+        if not _process_alive(int(claimed[len(prefix) :].split(".")[0]))
+    ]
+    if not os.path.exists(path) and not stale:
+        return []
+    claimed = []
+    with spill_lock(path):
+        for source in [path] + stale:
+            target = f"{prefix}{os.getpid()}.{len(claimed)}"
+            try:
+                os.rename(source, target)
+            except FileNotFoundError:
+                # Claimed by another process in the meantime
+                continue
+            claimed.append(target)
+    return claimed
+
+
+def read_spill(path: str) -> List[Dict[str, Any]]:
+    if not os.path.exists(path):
+        return []
+    records = []
+    with open(path) as spill_file:
+        for line in spill_file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            for key in ("created_at", "updated_at"):
+                if record.get(key):
+                    record[key] = datetime.fromisoformat(record[key])
+            records.append(record)
+    return records
+
+
+def is_row_error(error: Exception) -> bool:
+    """Raised because of the rows, a constraint or a bad value, the other rows
+    of the batch can still be inserted one by one. False for an unreachable
+    database, every row would fail the same way."""
+    if isinstance(error, (IntegrityError, DataError)):
+        return True
+    if isinstance(error, DBAPIError):
+        return False
+    # Bind parameters SQLAlchemy could not convert, and asyncpg COPY errors,
+    # which are not wrapped
+    return isinstance(
+        error,
+        (
+            StatementError,
+            ValueError,
+            TypeError,
+            asyncpg.DataError,
+            asyncpg.IntegrityConstraintViolationError,
+        ),
+    )
+
+
+class WriterStats:
+    def __init__(self):
+        self.written = 0
+        self.batches = 0
+        self.spilled = 0
+        self.last_flush_ms = 0.0
+
+    def snapshot(self, queue_depth: int) -> Dict[str, Any]:
+        return {
+            "queue_depth": queue_depth,
+            "written": self.written,
+            "batches": self.batches,
+            "spilled": self.spilled,
+            "last_flush_ms": self.last_flush_ms,
+        }
+
+
+class MessageWriter:
+    """Write behind buffer for `Message` rows on the async engine.
+
+    Records go into a bounded queue and are flushed in batches, with a multi
+    row INSERT or asyncpg COPY, when `batch_size` records are waiting or
+    `flush_interval` seconds passed. A batch that fails because of its rows
+    is inserted again one row at a time, the rows that still fail, or the
+    whole batch when the database is unreachable, are spilled to
+    `spill_path` and replayed on the next start."""
+
+    def __init__(
+        self,
+        max_queue: int = config.MESSAGE_WRITER_QUEUE_SIZE,
+        batch_size: int = config.MESSAGE_WRITER_BATCH_SIZE,
+        flush_interval: float = config.MESSAGE_WRITER_FLUSH_INTERVAL,
+        method: str = config.MESSAGE_WRITER_METHOD,
+        spill_path: str = config.MESSAGE_WRITER_SPILL_PATH,
+        db_engine=None,
+    ):
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.method = method
+        self.spill_path = spill_path
+        self._engine = db_engine
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = asyncio.Event()
+        self.stats = WriterStats()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def start(self) -> None:
+        if self._task is not None and not self._task.done():
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._stopping.clear()
+        self._task = asyncio.create_task(self._run())
+        await self.replay_spill()
+
+    async def stop(self) -> None:
+        """Flush everything that is queued and stop."""
+        if self._task is None:
+            return
+        # Not cancelled, a cancelled `wait_for` can drop the record it just got
+        self._stopping.set()
+        await self._task
+        self._task = None
+        records = []
+        while not self._queue.empty():
+            records.append(self._queue.get_nowait())
+        for start in range(0, len(records), self.batch_size):
+            await self._flush(records[start : start + self.batch_size])
+
+    async def write(self, record: Dict[str, Any]) -> None:
+        """Queue a record, waits while the queue is full."""
+        if self._task is None or self._task.done():
+            await self.start()
+        await self._queue.put(record)
+
+    async def replay_spill(self) -> None:
+        for claimed in claim_spill(self.spill_path):
+            try:
+                records = read_spill(claimed)
+                logger.info(f"Replaying {len(records)} spilled messages")
+                for start in range(0, len(records), self.batch_size):
+                    await self._flush(records[start : start + self.batch_size], replay=True)
+            except Exception as e:
+                # Claimed again by the next start, once this process is gone
+                logger.error(f"Replaying {claimed} failed: {e}")
+                continue
+            # The records that failed again are back in the spill file
+            os.remove(claimed)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return self.stats.snapshot(self.queue_depth)
+
+    async def _run(self) -> None:
+        while not (self._stopping.is_set() and self._queue.empty()):
+            try:
+                records = [await asyncio.wait_for(self._queue.get(), self.flush_interval)]
+            except asyncio.TimeoutError:
+                continue
+            deadline = time.monotonic() + self.flush_interval
+            while len(records) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    records.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._flush(records)
+
+    async def _flush(self, records: List[Dict[str, Any]], replay: bool = False) -> None:
+        started_at = time.perf_counter()
+        try:
+            await self._insert(records, replay)
+        except Exception as e:
+            if len(records) > 1 and is_row_error(e):
+                logger.warning(f"Batch of {len(records)} messages failed, inserting one by one: {e}")
+                for record in records:
+                    await self._flush([record], replay)
+                return
+            self.stats.spilled += len(records)
+            spill_records(records, e, self.spill_path)
+            return
+        self.stats.written += len(records)
+        self.stats.batches += 1
+        self.stats.last_flush_ms = round((time.perf_counter() - started_at) * 1000, 2)
+
+    async def _insert(self, records: List[Dict[str, Any]], replay: bool) -> None:
+        async with (self._engine or get_engine()).begin() as conn:
+            # A replay can repeat rows an interrupted one inserted, COPY has no
+            # ON CONFLICT
+            if self.method == "copy" and not replay:
+                raw_connection = await conn.get_raw_connection()
+                await raw_connection.driver_connection.copy_records_to_table(
+                    Message.__tablename__,
+                    records=[
+                        tuple(record.get(column) for column in MESSAGE_COLUMNS)
+                        for record in records
+                    ],
+                    columns=MESSAGE_COLUMNS,
+                )
+            else:
+                await conn.execute(insert(Message).on_conflict_do_nothing(index_elements=["id"]), records)
+
+
+class ThreadedMessageWriter:
+    """Same write behind buffer for the synchronous Celery worker, flushed by a
+    background thread on the sync engine, which replays the spill first."""
+
+    def __init__(
+        self,
+        max_queue: int = config.MESSAGE_WRITER_QUEUE_SIZE,
+        batch_size: int = config.MESSAGE_WRITER_BATCH_SIZE,
+        flush_interval: float = config.MESSAGE_WRITER_FLUSH_INTERVAL,
+        spill_path: str = config.MESSAGE_WRITER_SPILL_PATH,
+        db_engine=None,
+    ):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spill_path = spill_path
+        self._engine = db_engine
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+        self.stats = WriterStats()
+
+    def start(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="message-writer", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def write(self, record: Dict[str, Any]) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self.start()
+        self._queue.put(record)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return self.stats.snapshot(self._queue.qsize())
+
+    def _run(self) -> None:
+        self.replay_spill()
+        while not (self._stopping.is_set() and self._queue.empty()):
+            try:
+                records = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            deadline = time.monotonic() + self.flush_interval
+            while len(records) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    records.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._flush(records)
+
+    def replay_spill(self) -> None:
+        for claimed in claim_spill(self.spill_path):
+            try:
+                records = read_spill(claimed)
+                logger.info(f"Replaying {len(records)} spilled messages")
+                for start in range(0, len(records), self.batch_size):
+                    self._flush(records[start : start + self.batch_size])
+            except Exception as e:
+                logger.error(f"Replaying {claimed} failed: {e}")
+                continue
+            os.remove(claimed)
+
+    def _flush(self, records: List[Dict[str, Any]]) -> None:
+        started_at = time.perf_counter()
+        try:
+            with (self._engine or get_sync_engine()).begin() as conn:
+                conn.execute(insert(Message).on_conflict_do_nothing(index_elements=["id"]), records)
+        except Exception as e:
+            if len(records) > 1 and is_row_error(e):
+                logger.warning(f"Batch of {len(records)} messages failed, inserting one by one: {e}")
+                for record in records:
+                    self._flush([record])
+                return
+            self.stats.spilled += len(records)
+            spill_records(records, e, self.spill_path)
+            return
+        self.stats.written += len(records)
+        self.stats.batches += 1
+        self.stats.last_flush_ms = round((time.perf_counter() - started_at) * 1000, 2)
+
+
+message_writer = MessageWriter()
+threaded_message_writer = ThreadedMessageWriter()
@@ -0,0 +1,59 @@
+import time
+from typing import Any, Dict
+
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+from src.utils.rate_limit import LatencyStats
+
+
+class PoolStats:
+    def __init__(self):
+        self.checkouts = 0
+        # Checkouts served by a connection above `pool_size`
+        self.overflow_checkouts = 0
+        self.timeouts = 0
+        self.wait = LatencyStats()
+
+
+class InstrumentedPoolMixin:
+    """Times every checkout, including the wait for a free connection, and
+    counts overflow connections and checkout timeouts."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def _do_get(self):
+        started_at = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            self.stats.timeouts += 1
+            raise
+        self.stats.wait.add(time.perf_counter() - started_at)
+        self.stats.checkouts += 1
+        if self.overflow() > 0 and self.checkedout() > self.size():
+            self.stats.overflow_checkouts += 1
+        return connection
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "size": self.size(),
+            "checked_out": self.checkedout(),
+            "checked_in": self.checkedin(),
+            "overflow": max(self.overflow(), 0),
+            "max_overflow": self._max_overflow,
+            "checkouts": self.stats.checkouts,
+            "overflow_checkouts": self.stats.overflow_checkouts,
+            "timeouts": self.stats.timeouts,
+            "wait": self.stats.wait.snapshot(),
+        }
+
+
+class InstrumentedQueuePool(InstrumentedPoolMixin, QueuePool):
+    pass
+
+
+class InstrumentedAsyncQueuePool(InstrumentedPoolMixin, AsyncAdaptedQueuePool):
+    pass
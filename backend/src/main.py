@@ -1,13 +1,23 @@
+import asyncio
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 from src.database.database import init_db
+from src.agents.refusal import refusal_pool
+from src.database.message_writer import message_writer
+from src.tasks.async_worker import AsyncWorker, get_broker
+from src.tasks.polling import UpdatePoller
+from src.utils.telegram import send_scheduler, telegram_client
+from src.utils.resources import resources
+from src.utils.usage import usage_ledger
 from src.routes.health import router as health_route
 from src.routes.agent import router as agent_router
-from src.routes.telegram import router as telegram_router
+from src.routes.telegram import router as telegram_router, update_ingestor
 from src.routes.user import router as user_router
+from src.routes.usage import router as usage_router
+from src.routes.metrics import router as metrics_router
 from src import config
 from src import logging
 
@@ -19,12 +29,51 @@ async def lifespan(app: FastAPI):
     logger.info(f"Starting application: {app.title} {app.version}")
 
     await init_db()
+    await telegram_client.start()
+    send_scheduler.start()
+    await message_writer.start()
+    await usage_ledger.start()
+    await refusal_pool.start()
+
+    worker = None
+    worker_task = None
+    if config.TG_WORKER_BACKEND == "async" and config.TG_WORKER_BROKER_URL.startswith(
+        "memory://"
+    ):
+        worker = AsyncWorker(get_broker())
+        worker_task = asyncio.create_task(worker.run())
+    await update_ingestor.start()
+
+    poller = None
+    poller_task = None
+    if config.TG_INGEST_MODE == "polling":
+        poller = UpdatePoller(update_ingestor)
+        poller_task = asyncio.create_task(poller.run())
+
     logger.info("Application startup complete")
 
     yield
 
     logger.info("Application shutdown initiated")
 
+    # Before the worker, the updates still queued publish jobs to it
+    if poller is not None:
+        poller.stop()
+        await poller_task
+    await update_ingestor.stop()
+    if worker is not None:
+        worker.stop()
+        await worker_task
+
+    # After the worker, so the messages of its last jobs are flushed
+    await message_writer.stop()
+    await usage_ledger.stop()
+    await refusal_pool.stop()
+    await send_scheduler.stop()
+    await telegram_client.aclose()
+    # The clients and engines created while serving
+    await resources.aclose()
+
 
 app = FastAPI(
     title="Mental Health Support Agent",
@@ -45,3 +94,5 @@ app.include_router(health_route)
 app.include_router(agent_router)
 app.include_router(telegram_router)
 app.include_router(user_router)
+app.include_router(usage_router)
+app.include_router(metrics_router)
@@ -0,0 +1,30 @@
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, String, Integer, Text
+
+from src.models.base import Base
+
+
+class ChatSummary(Base):
+    """Rolling summary of the turns that fell out of a chat's context window."""
+
+    __tablename__ = "chat_summaries"
+
+    # Telegram chat id or `/agent/chat` user id
+    chat_id = Column(String(512), primary_key=True)
+    summary = Column(Text, default="")
+    # JSON list of the fingerprints of the turns already folded in
+    folded_turns = Column(Text, default="[]")
+    input_tokens = Column(Integer, default=0)
+    output_tokens = Column(Integer, default=0)
+    total_tokens = Column(Integer, default=0)
+    model = Column(String(64))
+    created_at = Column(DateTime, default=datetime.now)
+    updated_at = Column(
+        DateTime,
+        default=datetime.now,
+        onupdate=datetime.now,
+    )
+
+    def __repr__(self) -> str:
+        return f"ChatSummary chat: {self.chat_id}"
@@ -1,7 +1,16 @@
 from datetime import datetime
 from typing import Literal
 
-from sqlalchemy import Column, DateTime, String, Boolean, Integer, Text, ForeignKey
+from sqlalchemy import (
+    Column,
+    DateTime,
+    String,
+    Boolean,
+    Integer,
+    Text,
+    ForeignKey,
+    Index,
+)
 
 from src.models.base import generate_uuid
 from src.models.base import Base
@@ -33,3 +42,19 @@ class Message(Base):
 
     def __repr__(self) -> str:
         return f"Message id: {self.id} Chat: {self.chat_id}"
+
+
+# Serves the "latest N turns of a chat" window and the keyset pages of the
+# messages API, `id` breaks ties between messages with the same `created_at`.
+# `query` and `response` are not included, long texts would exceed the btree
+# row size limit, so each page reads only its own heap rows.
+Index(
+    "ix_messages_chat_id_is_deleted_created_at_id",
+    Message.chat_id,
+    Message.is_deleted,
+    Message.created_at,
+    Message.id,
+)
+
+# Replaced by the index above, dropped by `init_db`
+SUPERSEDED_INDEXES = ["ix_messages_chat_id_is_deleted_created_at"]
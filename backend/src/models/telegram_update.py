@@ -0,0 +1,33 @@
+from datetime import datetime
+
+from sqlalchemy import BigInteger, Column, DateTime
+
+from src.models.base import Base
+
+
+class TelegramUpdate(Base):
+    """Telegram `update_id`s already taken for processing, shared by every
+    API process so a redelivered update runs once. Rows older than the
+    dedup window are pruned."""
+
+    __tablename__ = "telegram_updates"
+
+    update_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    received_at = Column(DateTime, default=datetime.now, index=True)
+
+    def __repr__(self) -> str:
+        return f"TelegramUpdate id: {self.update_id}"
+
+
+class TelegramPollState(Base):
+    """The `getUpdates` offset of a bot, so a restarted poller neither skips
+    nor replays updates."""
+
+    __tablename__ = "telegram_poll_state"
+
+    bot_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    next_offset = Column(BigInteger, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+    def __repr__(self) -> str:
+        return f"TelegramPollState bot: {self.bot_id} offset: {self.next_offset}"
@@ -0,0 +1,32 @@
+from datetime import datetime
+
+from sqlalchemy import Column, Date, DateTime, Float, Integer, String
+
+from src.models.base import Base
+
+
+class UsageRollup(Base):
+    """Tokens and cost per chat, model, day and stage, maintained incrementally
+    by the usage ledger."""
+
+    __tablename__ = "usage_rollups"
+
+    # Telegram chat id or `/agent/chat` user id
+    chat_id = Column(String(512), primary_key=True)
+    day = Column(Date, primary_key=True)
+    model = Column(String(64), primary_key=True)
+    # "guardrail", "agent", "refusal", "summary" or "cancelled"
+    stage = Column(String(32), primary_key=True)
+    requests = Column(Integer, default=0)
+    input_tokens = Column(Integer, default=0)
+    output_tokens = Column(Integer, default=0)
+    total_tokens = Column(Integer, default=0)
+    cost_usd = Column(Float, default=0.0)
+    updated_at = Column(
+        DateTime,
+        default=datetime.now,
+        onupdate=datetime.now,
+    )
+
+    def __repr__(self) -> str:
+        return f"UsageRollup chat: {self.chat_id} day: {self.day} model: {self.model}"
@@ -25,3 +25,19 @@ GUARDRAIL_PROMPT = """Check if the user is asking about one the following things
 
 GUARDRAIL_FALSE_PROMPT = """You are a helpful assistant, polietly say that you can't answer user's query: {query} 
 because of {reasoning}. Ask user to stick to mental health being questions."""
+
+REFUSAL_POOL_PROMPT = """Write {count} different short replies a mental health support assistant sends
+when a user asks about {topic}. Each reply politely says it can't help with that and
+invites the user to talk about their mental health and well being instead.
+Do not quote the user's question. Two sentences at most, no markdown.
+Write one reply per line, no numbering."""
+
+SUMMARY_PROMPT = """Update the summary of an ongoing conversation between a user and a mental health support assistant.
+Keep the facts about the user, their feelings, concerns, goals and any advice or exercises already given.
+Write at most 150 words in the third person, no greetings, no markdown.
+
+Current summary:
+{summary}
+
+New turns to fold in:
+{turns}"""
@@ -1,20 +1,42 @@
+import asyncio
 import json
-from typing import List
+import time
+from functools import lru_cache
+from typing import Any, AsyncIterator, Dict, List, Optional
 
 from fastapi import APIRouter, Depends
 from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from agents import (
     ItemHelpers,
     Runner,
-    AsyncOpenAI,
+    RunResultStreaming,
 )
+from agents.usage import Usage
 from openai.types.responses import ResponseTextDeltaEvent
 
 from src.schemas.agent import AgentChatRequest, ChatHistory
 from src import config
 from src.agents.menatl_health_support import mental_health_support_agent
-from src.agents.guard_rail import GuardrailCheckOutput, guardrail_agent
+from src.agents.guard_rail import GuardrailCheckOutput
+from src.agents.guardrail_pipeline import GuardrailVerdict, check_guardrail
+from src.agents.refusal import answer_chunks, refusal_pool
 from src.utils.utils import verify_api_key
+from src.utils import llm
+from src.utils.context import build_context
+from src.utils.history import fetch_history_window
+from src.utils.tokens import count_agent_prompt_tokens, count_message_tokens
+from src.cache.conversation import Turn, conversation_cache
+from src.database.database import AsyncSessionLocal
+from src.database.message_writer import message_record, message_writer
+from src.utils.usage import UsageCollector, usage_ledger
+from src.utils.metrics import (
+    AGENT_SECONDS,
+    AGENT_TTFT_SECONDS,
+    ERRORS,
+    IN_FLIGHT,
+    TOOL_SECONDS,
+)
 from src.prompts.prompts import GUARDRAIL_FALSE_PROMPT
 from src import logging
 
@@ -24,150 +46,354 @@ router = APIRouter(prefix=f"/api/{config.API_VERSION}/agent", tags=["AGENT"])
 logger = logging.getLogger(__name__)
 
 
-client = AsyncOpenAI(api_key=config.OPENAI_API_KEY)
+def to_ndjson(payload: Dict) -> str:
+    return json.dumps(payload) + "\n"
 
 
-def format_chat_history(
-    agent_chat_request: AgentChatRequest,
-) -> List[ChatHistory]:
-    formatted_messages = []
-    for ch in agent_chat_request.chat_history:
-        formatted_messages.append({"role": "user", "content": ch.query})
-        formatted_messages.append({"role": "assistant", "content": ch.response})
-    formatted_messages.append({"role": "user", "content": agent_chat_request.query})
-    return formatted_messages
+async def stream_agent_events(
+    result: RunResultStreaming, pending: Optional[Dict[str, int]] = None
+) -> AsyncIterator[str]:
+    """Convert the support agent stream events into NDJSON lines.
 
+    `pending` tracks whether a model response is in flight and counts its
+    text deltas, it is used to account for a run that gets cancelled mid
+    response."""
+    # Hosted web search runs inside the model response, it is timed from its
+    # progress events
+    web_searches: Dict[str, float] = {}
+    async for event in result.stream_events():
+        # When you receive delta of the final answer
+        if event.type == "raw_response_event":
+            if event.data.type == "response.web_search_call.in_progress":
+                web_searches[event.data.item_id] = time.perf_counter()
+            elif event.data.type == "response.web_search_call.completed":
+                started_at = web_searches.pop(event.data.item_id, None)
+                if started_at is not None:
+                    TOOL_SECONDS.labels("web_search").observe(time.perf_counter() - started_at)
+            elif isinstance(event.data, ResponseTextDeltaEvent):
+                if pending is not None:
+                    pending["deltas"] += 1
+                yield to_ndjson({"type": "answer", "content": event.data.delta})
+            elif event.data.type == "response.completed" and pending is not None:
+                pending["deltas"] = 0
+                pending["in_flight"] = 0
 
-@router.post("/chat", response_model=None)
-async def post_chat(
-    agent_chat_request: AgentChatRequest, is_varified: bool = Depends(verify_api_key)
+        # When the agent updates
+        elif event.type == "agent_updated_stream_event":
+            continue
+
+        # When items are generated
+        elif event.type == "run_item_stream_event":
+            if event.item.type == "tool_call_item":
+                if event.item.raw_item.type == "function_call":
+                    yield to_ndjson(
+                        {"type": "tool_name", "content": event.item.raw_item.name}
+                    )
+                    yield to_ndjson(
+                        {"type": "tool_args", "content": event.item.raw_item.arguments}
+                    )
+            elif event.item.type == "tool_call_output_item":
+                if pending is not None:
+                    # The next model response starts with the tool output
+                    pending["in_flight"] = 1
+                yield to_ndjson({"type": "tool_content", "content": event.item.output})
+            # When final answer
+            elif event.item.type == "message_output_item":
+                yield to_ndjson(
+                    {
+                        "type": "final_answer",
+                        "content": ItemHelpers.text_message_output(event.item),
+                    }
+                )
+            else:
+                # Ignore other event types
+                pass
+
+
+async def stream_refusal(
+    query: str,
+    guardrail_output: GuardrailCheckOutput,
+    usage: UsageCollector,
+    meta: Dict[str, Any],
+) -> AsyncIterator[str]:
+    if config.REFUSAL_MODE == "template":
+        refusal = refusal_pool.refuse(query, guardrail_output.reasoning)
+        for chunk in answer_chunks(refusal):
+            yield to_ndjson({"type": "answer", "content": chunk})
+        meta["response"] = refusal
+        return
+
+    deltas = []
+    completion = await llm.async_client().responses.create(
+        model=config.OPENAI_AGENT_MODEL,
+        input=[
+            {
+                "role": "user",
+                "content": GUARDRAIL_FALSE_PROMPT.format(
+                    **{
+                        "reasoning": guardrail_output.reasoning,
+                        "query": query,
+                    }
+                ),
+            },
+        ],
+        stream=True,
+    )
+    async for chunk in completion:
+        if chunk.type == "response.output_text.delta":
+            deltas.append(chunk.delta)
+            yield to_ndjson({"type": "answer", "content": chunk.delta})
+        elif chunk.type == "response.completed":
+            usage.add_response_usage(
+                "refusal", config.OPENAI_AGENT_MODEL, chunk.response.usage
+            )
+    meta["response"] = "".join(deltas)
+
+
+def record_guardrail(
+    verdict: GuardrailVerdict, usage: UsageCollector, meta: Dict[str, Any]
 ):
-    formatted_chat_history = format_chat_history(agent_chat_request=agent_chat_request)
+    usage.add("guardrail", config.OPENAI_GUARDRAIL_MODEL, verdict.usage)
+    meta["branch"] = "agent" if verdict.is_mental_health else "refusal"
+    meta["guardrail_source"] = verdict.source
+    meta["saved_tokens"] = verdict.saved_tokens
 
-    async def generate():
-        input_checks = await Runner.run(
-            starting_agent=guardrail_agent, input=formatted_chat_history
+
+async def generate_sequential(
+    formatted_chat_history: List[ChatHistory],
+    query: str,
+    usage: UsageCollector,
+    meta: Dict[str, Any],
+) -> AsyncIterator[str]:
+    verdict = await check_guardrail(formatted_chat_history)
+    record_guardrail(verdict, usage, meta)
+
+    final_output = verdict.output
+
+    if final_output.is_mental_health:
+        result = Runner.run_streamed(
+            starting_agent=mental_health_support_agent, input=formatted_chat_history
         )
+        async for line in stream_agent_events(result):
+            yield line
+        usage.add_raw_responses("agent", config.OPENAI_AGENT_MODEL, result.raw_responses)
+        meta["response"] = result.final_output
+    else:
+        async for line in stream_refusal(query, final_output, usage, meta):
+            yield line
+
+
+@lru_cache(maxsize=1)
+def support_agent_prompt_tokens() -> int:
+    return count_agent_prompt_tokens(mental_health_support_agent)
+
 
-        input_tokens = 0
-        output_tokens = 0
-        total_tokens = 0
+async def generate_speculative(
+    formatted_chat_history: List[ChatHistory],
+    query: str,
+    usage: UsageCollector,
+    meta: Dict[str, Any],
+    wasted: Usage,
+) -> AsyncIterator[str]:
+    """Start the guardrail and the support agent together, the agent output is
+    buffered until the guardrail passes. When it fails the agent run is cancelled
+    and its tokens are recorded in `wasted` and as the "cancelled" stage of
+    `usage`.
 
-        for item in input_checks.raw_responses:
-            input_tokens += item.usage.input_tokens
-            output_tokens += item.usage.output_tokens
-            total_tokens += item.usage.total_tokens
+    Only the text is held back: the agent may call its tools before the
+    verdict arrives, so a callback request it registers is stored even when
+    the run is then cancelled."""
+    guardrail_task = asyncio.create_task(check_guardrail(formatted_chat_history))
+    result = Runner.run_streamed(
+        starting_agent=mental_health_support_agent, input=formatted_chat_history
+    )
+    buffer: asyncio.Queue[Optional[str]] = asyncio.Queue()
+    pending = {"deltas": 0, "in_flight": 1}
 
-        final_output = input_checks.final_output_as(GuardrailCheckOutput)
+    async def pump():
+        # The only await point here is inside `stream_events`, which stops the
+        # run and cleans up its tasks when the pump gets cancelled
+        try:
+            async for line in stream_agent_events(result, pending):
+                buffer.put_nowait(line)
+        finally:
+            buffer.put_nowait(None)
+
+    pump_task = asyncio.create_task(pump())
+
+    try:
+        verdict = await guardrail_task
+        record_guardrail(verdict, usage, meta)
+        final_output = verdict.output
 
         if final_output.is_mental_health:
-            result = Runner.run_streamed(
-                starting_agent=mental_health_support_agent, input=formatted_chat_history
+            while (line := await buffer.get()) is not None:
+                yield line
+            # Raise the agent error, if any
+            await pump_task
+            usage.add_raw_responses("agent", config.OPENAI_AGENT_MODEL, result.raw_responses)
+            meta["response"] = result.final_output
+        else:
+            pump_task.cancel()
+            await asyncio.gather(pump_task, return_exceptions=True)
+
+            for item in result.raw_responses:
+                wasted.add(item.usage)
+            # The cancelled response never reports usage, its prompt is billed
+            # all the same and one text delta is roughly one output token
+            if pending["in_flight"]:
+                prompt_tokens = support_agent_prompt_tokens() + count_message_tokens(
+                    formatted_chat_history
+                )
+                wasted.input_tokens += prompt_tokens
+                wasted.total_tokens += prompt_tokens
+            wasted.output_tokens += pending["deltas"]
+            wasted.total_tokens += pending["deltas"]
+            usage.add("cancelled", config.OPENAI_AGENT_MODEL, wasted)
+            logger.info(
+                f"Speculative agent run cancelled, wasted tokens: {wasted.total_tokens}"
             )
 
-            async for event in result.stream_events():
-                """We'll ignore the raw responses event deltas
-                If you want to stream the information use this."""
-
-                # When you receive delta of the final answer
-                if event.type == "raw_response_event" and isinstance(
-                    event.data, ResponseTextDeltaEvent
-                ):
-                    yield (
-                        json.dumps({"type": "answer", "content": event.data.delta})
-                        + "\n"
-                    )
+            async for line in stream_refusal(query, final_output, usage, meta):
+                yield line
+    finally:
+        for task in (guardrail_task, pump_task):
+            if not task.done():
+                task.cancel()
+
 
-                # When the agent updates
-                elif event.type == "agent_updated_stream_event":
-                    continue
-
-                # When items are generated
-                elif event.type == "run_item_stream_event":
-                    if event.item.type == "tool_call_item":
-                        if event.item.raw_item.type == "function_call":
-                            yield (
-                                json.dumps(
-                                    {
-                                        "type": "tool_name",
-                                        "content": event.item.raw_item.name,
-                                    }
-                                )
-                                + "\n"
-                            )
-                            yield (
-                                json.dumps(
-                                    {
-                                        "type": "tool_args",
-                                        "content": event.item.raw_item.arguments,
-                                    }
-                                )
-                                + "\n"
-                            )
-                    elif event.item.type == "tool_call_output_item":
-                        yield (
-                            json.dumps(
-                                {"type": "tool_content", "content": event.item.output}
-                            )
-                            + "\n"
-                        )
-                    # When final answer
-                    elif event.item.type == "message_output_item":
-                        yield (
-                            json.dumps(
-                                {
-                                    "type": "final_answer",
-                                    "content": ItemHelpers.text_message_output(
-                                        event.item
-                                    ),
-                                }
-                            )
-                            + "\n"
-                        )
-                    else:
-                        # Ignore other event types
-                        pass
+async def load_server_history(user_id: str) -> List[Turn]:
+    """The stored turns of a client, with the ones this process has not
+    flushed yet, none for a new client."""
+    async with AsyncSessionLocal() as session:
+        db_messages = await fetch_history_window(db=session, chat_id=user_id)
+    return conversation_cache.with_recent_turns(user_id, db_messages)
+
+
+async def save_server_turn(user_id: str, query: str, session_turn: Dict[str, Any]) -> None:
+    """Queue the `Message` of a session turn, once the reply is sent."""
+    usage: Optional[Usage] = session_turn.get("usage")
+    if usage is None:
+        # The stream did not complete, nothing to store
+        return
+    await message_writer.write(
+        message_record(
+            query=query,
+            response=session_turn["response"],
+            input_tokens=usage.input_tokens,
+            output_tokens=usage.output_tokens,
+            total_tokens=usage.total_tokens,
+            model=config.OPENAI_AGENT_MODEL,
+            provider="Openai",
+            chat_id=user_id,
+        )
+    )
+
+
+@router.post("/chat", response_model=None)
+async def post_chat(
+    agent_chat_request: AgentChatRequest, is_varified: bool = Depends(verify_api_key)
+):
+    if not await usage_ledger.within_quota(agent_chat_request.user_id):
+
+        async def generate_quota_message():
+            yield to_ndjson({"type": "answer", "content": config.QUOTA_MESSAGE})
+            yield to_ndjson(
+                {
+                    "input_tokens": 0,
+                    "output_tokens": 0,
+                    "total_tokens": 0,
+                    "quota_exceeded": True,
+                }
+            )
+
+        return StreamingResponse(generate_quota_message(), media_type="application/json")
+
+    server_history = agent_chat_request.server_history
+    if server_history is None:
+        server_history = config.AGENT_CHAT_SERVER_HISTORY
+    turns = agent_chat_request.chat_history
+    if server_history:
+        turns = await load_server_history(agent_chat_request.user_id)
+    session_turn: Dict[str, Any] = {}
+
+    formatted_chat_history = await build_context(
+        chat_id=agent_chat_request.user_id,
+        system_messages=[],
+        turns=turns,
+        query=agent_chat_request.query,
+        # The summary is of the stored conversation, not of the client's own
+        summaries=server_history and config.CONTEXT_SUMMARIES,
+    )
+
+    async def generate():
+        started_at = time.perf_counter()
+        ttfb_ms = None
+
+        usage = UsageCollector()
+        wasted = Usage()
+        meta = {}
+
+        if config.SPECULATIVE_GUARDRAIL:
+            lines = generate_speculative(
+                formatted_chat_history, agent_chat_request.query, usage, meta, wasted
+            )
         else:
-            completion = await client.responses.create(
-                model=config.OPENAI_AGENT_MODEL,
-                input=[
-                    {
-                        "role": "user",
-                        "content": GUARDRAIL_FALSE_PROMPT.format(
-                            **{
-                                "reasoning": final_output.reasoning,
-                                "query": agent_chat_request.query,
-                            }
-                        ),
-                    },
-                ],
-                stream=True,
+            lines = generate_sequential(
+                formatted_chat_history, agent_chat_request.query, usage, meta
             )
-            async for chunk in completion:
-                if chunk.type == "response.output_text.delta":
-                    yield (
-                        json.dumps(
-                            {
-                                "type": "answer",
-                                "content": chunk.delta,
-                            }
-                        )
-                        + "\n"
+
+        IN_FLIGHT.labels("agent_chat").inc()
+        try:
+            async for line in lines:
+                if ttfb_ms is None:
+                    ttfb_ms = round((time.perf_counter() - started_at) * 1000, 2)
+                    AGENT_TTFT_SECONDS.labels("agent_chat").observe(ttfb_ms / 1000)
+                    logger.info(
+                        f"post_chat ttfb_ms: {ttfb_ms} speculative: {config.SPECULATIVE_GUARDRAIL}"
                     )
-                elif chunk.type == "response.completed":
-                    input_tokens += chunk.response.usage.input_tokens
-                    output_tokens += chunk.response.usage.output_tokens
-                    total_tokens += chunk.response.usage.total_tokens
+                yield line
+        except Exception:
+            ERRORS.labels("agent_chat").inc()
+            raise
+        finally:
+            IN_FLIGHT.labels("agent_chat").dec()
+            AGENT_SECONDS.labels("agent_chat", meta.get("branch", "unknown")).observe(
+                time.perf_counter() - started_at
+            )
+            # Also when the client disconnects mid stream
+            usage_ledger.record(agent_chat_request.user_id, usage)
 
-        yield (
-            json.dumps(
-                {
-                    "input_tokens": input_tokens,
-                    "output_tokens": output_tokens,
-                    "total_tokens": total_tokens,
-                }
+        total = usage.total()
+        if server_history and meta.get("response"):
+            # The row is written after the reply is sent, the next turn
+            # finds it in the cache until then
+            conversation_cache.append_turn(
+                agent_chat_request.user_id, agent_chat_request.query, meta["response"]
             )
-            + "\n"
+            session_turn.update(response=meta["response"], usage=total)
+        yield to_ndjson(
+            {
+                "input_tokens": total.input_tokens,
+                "output_tokens": total.output_tokens,
+                "total_tokens": total.total_tokens,
+                "cancelled_tokens": wasted.total_tokens,
+                "guardrail_source": meta.get("guardrail_source"),
+                "saved_tokens": meta.get("saved_tokens", 0),
+                "speculative": config.SPECULATIVE_GUARDRAIL,
+                "ttfb_ms": ttfb_ms,
+            }
         )
 
-    return StreamingResponse(generate(), media_type="application/json")
+    return StreamingResponse(
+        generate(),
+        media_type="application/json",
+        background=BackgroundTask(
+            save_server_turn,
+            agent_chat_request.user_id,
+            agent_chat_request.query,
+            session_turn,
+        )
+        if server_history
+        else None,
+    )
@@ -1,6 +1,13 @@
-from fastapi import APIRouter, status
+from fastapi import APIRouter, Depends, status
 
 from src.schemas.health import HealthResponse
+from src.cache.conversation import conversation_cache
+from src.cache.guardrail import guardrail_cache
+from src.database.database import pool_snapshot
+from src.database.message_writer import message_writer
+from src.utils.llm import llm_limits
+from src.utils.resources import resources
+from src.utils.utils import verify_api_key
 from src import config
 
 router = APIRouter(prefix=f"/api/{config.API_VERSION}", tags=["HOME"])
@@ -9,3 +16,34 @@ router = APIRouter(prefix=f"/api/{config.API_VERSION}", tags=["HOME"])
 @router.get("/health", response_model=HealthResponse, status_code=status.HTTP_200_OK)
 async def get_health():
     return HealthResponse(message="ALL IS WELL", status=status.HTTP_200_OK)
+
+
+@router.get("/cache", status_code=status.HTTP_200_OK)
+async def get_cache_stats(is_verified: bool = Depends(verify_api_key)):
+    return {
+        "conversation": conversation_cache.snapshot(),
+        "guardrail": guardrail_cache.snapshot(),
+    }
+
+
+@router.get("/message-writer", status_code=status.HTTP_200_OK)
+async def get_message_writer_stats(is_verified: bool = Depends(verify_api_key)):
+    return message_writer.snapshot()
+
+
+@router.get("/db/pool", status_code=status.HTTP_200_OK)
+async def get_db_pool_stats(is_verified: bool = Depends(verify_api_key)):
+    """Checked out connections, overflow and checkout wait of the engines in use"""
+    return pool_snapshot()
+
+
+@router.get("/resources", status_code=status.HTTP_200_OK)
+async def get_resources(is_verified: bool = Depends(verify_api_key)):
+    """Clients and engines this process created, and how long each took"""
+    return resources.snapshot()
+
+
+@router.get("/llm", status_code=status.HTTP_200_OK)
+async def get_llm_stats(is_verified: bool = Depends(verify_api_key)):
+    """Model calls in flight and queued, in total and per model"""
+    return llm_limits.snapshot()
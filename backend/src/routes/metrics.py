@@ -0,0 +1,51 @@
+from fastapi import APIRouter, Depends
+from fastapi.responses import PlainTextResponse
+
+from src.database.database import created_engines
+from src.database.message_writer import message_writer
+from src.routes.telegram import update_ingestor
+from src.utils.metrics import Gauge, registry
+from src.utils.telegram import send_scheduler
+from src.utils.utils import verify_api_key
+
+
+router = APIRouter(tags=["METRICS"])
+
+
+def queue_depths():
+    return {
+        ("telegram_send",): send_scheduler.snapshot()["queue_depth"],
+        ("message_writer",): message_writer.queue_depth,
+        ("telegram_updates",): update_ingestor.queue_depth,
+    }
+
+
+def pool_connections():
+    connections = {}
+    for engine_name, db_engine in created_engines().items():
+        pool = db_engine.pool
+        connections[(engine_name, "checked_out")] = pool.checkedout()
+        connections[(engine_name, "overflow")] = max(pool.overflow(), 0)
+    return connections
+
+
+registry.register(
+    Gauge("queue_depth", "Items waiting in in process queues.", ["queue"], callback=queue_depths)
+)
+registry.register(
+    Gauge(
+        "db_pool_connections",
+        "Pooled database connections by state.",
+        ["engine", "state"],
+        callback=pool_connections,
+    )
+)
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics(is_verified: bool = Depends(verify_api_key)):
+    """Prometheus text exposition format, scraped with the API key as bearer
+    token"""
+    return PlainTextResponse(
+        registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
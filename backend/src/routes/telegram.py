@@ -1,13 +1,24 @@
+import time
+from typing import List
+
 from fastapi import APIRouter, Depends, HTTPException
-import httpx
-from sqlalchemy import select, asc
+from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from src.tasks.tasks import handle_tg_message
-from src.utils.telegram import send_telegram_message
-from src.database.database import get_db
+from src.tasks.async_worker import dispatch_tg_message
+from src.tasks.coalesce import coalesce_stats, coalescing_enabled
+from src.tasks.ingest import REJECTED, UpdateIngestor
+from src.utils.telegram import (
+    send_scheduler,
+    send_telegram_message,
+    telegram_client,
+)
+from src.utils.history import fetch_history_window
+from src.utils.context import build_context
+from src.cache.conversation import conversation_cache
+from src.utils.metrics import WEBHOOK_SECONDS
+from src.utils.utils import verify_api_key
 from src.models.user import User
-from src.models.message import Message
 from src import config
 from src.schemas.telegram import WebhookResponse, SetWebhookRequest, Update
 from src import logging
@@ -22,25 +33,26 @@ logger = logging.getLogger(__name__)
 @router.post("/set-webhook", response_model=WebhookResponse)
 async def set_webhook(webhook_data: SetWebhookRequest):
     """Set webhook URL for the Telegram bot"""
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            f"{config.TELEGRAM_API_BASE}/setWebhook",
-            params={"url": str(webhook_data.url)},
+    data = await telegram_client.call("setWebhook", {"url": str(webhook_data.url)})
+    if not data.get("ok"):
+        raise HTTPException(
+            status_code=400, detail=data.get("description", "Failed to set webhook")
         )
-        data = response.json()
-        if not data.get("ok"):
-            raise HTTPException(
-                status_code=400, detail=data.get("description", "Failed to set webhook")
-            )
-        return data
+    return data
 
 
 @router.post("/webhook")
-async def telegram_webhook(
-    update: Update,
-    db: AsyncSession = Depends(get_db),
-):
-    """Receive updates from Telegram"""
+async def telegram_webhook(update: Update):
+    """Receive updates from Telegram, acknowledged before any processing"""
+    started_at = time.perf_counter()
+    outcome = update_ingestor.submit(update)
+    WEBHOOK_SECONDS.labels().observe(time.perf_counter() - started_at)
+    if outcome == REJECTED:
+        raise HTTPException(status_code=503, detail="Too many pending updates")
+    return {"status": outcome}
+
+
+async def handle_update(update: Update, db: AsyncSession):
     if not update.has_text_message:
         # Ignore non-text messages
         return {"status": "ignored"}
@@ -50,13 +62,14 @@ async def telegram_webhook(
     chat_id = update.message.chat.id
     first_name = update.message.from_user.first_name
 
-    result = await db.execute(
-        statement=select(User).filter(User.chat_id == str(chat_id))
-    )
-
-    db_user = result.scalars().first()
-
-    formatted_chat_history = []
+    state = conversation_cache.get(str(chat_id))
+    if state is None:
+        result = await db.execute(
+            statement=select(User).filter(User.chat_id == str(chat_id))
+        )
+        db_user = result.scalars().first()
+        if db_user:
+            state = conversation_cache.put_user(str(chat_id), db_user)
 
     raw_verify_message = (
         "To get started and unlock all the features, you need to **register** first 📝 👉 "
@@ -64,29 +77,24 @@ async def telegram_webhook(
         "Once you're done, come back and start chatting with the bot! 💬✨"
     )
 
-    if db_user:
-        if db_user.is_verified:
-            formatted_chat_history.append({"role": "system", "content": SYSTEM_PROMPT})
-            result = await db.execute(
-                statement=select(Message)
-                .filter(Message.chat_id == str(chat_id), Message.is_deleted.is_(False))
-                .order_by(asc(Message.created_at))
-                .limit(8)
+    if state:
+        if state.is_verified:
+            db_messages = await fetch_history_window(db=db, chat_id=str(chat_id))
+            # Give the connection back before `build_context` checks out its
+            # own, holding both under a burst deadlocks the pool
+            await db.close()
+            formatted_chat_history = await build_context(
+                chat_id=str(chat_id),
+                system_messages=[{"role": "system", "content": SYSTEM_PROMPT}],
+                turns=conversation_cache.with_recent_turns(str(chat_id), db_messages),
+                query=text,
             )
-            db_messages = result.scalars().all()
-            for message in db_messages:
-                formatted_chat_history.append(
-                    {"role": "user", "content": message.query}
-                )
-                formatted_chat_history.append(
-                    {"role": "assistant", "content": message.response}
-                )
-            formatted_chat_history.append({"role": "user", "content": text})
-
-            handle_tg_message.delay(
+
+            await dispatch_tg_message(
                 chat_id=chat_id,
                 text=text,
                 formatted_chat_history=formatted_chat_history,
+                user_info=state.user_info,
             )
         else:
             await send_telegram_message(
@@ -108,3 +116,40 @@ async def telegram_webhook(
         )
 
     return {"status": "processing"}
+
+
+async def prefetch_users(updates: List[Update], db: AsyncSession) -> None:
+    """Cache the verified users of a batch of updates with one query,
+    `handle_update` then only queries for the other chats."""
+    chat_ids = conversation_cache.missing({str(update.message.chat.id) for update in updates})
+    if not chat_ids:
+        return
+    result = await db.execute(select(User).filter(User.chat_id.in_(chat_ids)))
+    for db_user in result.scalars():
+        conversation_cache.put_user(db_user.chat_id, db_user)
+
+
+update_ingestor = UpdateIngestor(handle_update, prefetch=prefetch_users)
+
+
+@router.get("/ingest")
+async def get_ingest_stats(is_verified: bool = Depends(verify_api_key)):
+    """Updates acknowledged, processed and dropped as duplicates"""
+    return update_ingestor.snapshot()
+
+
+@router.get("/scheduler")
+async def get_scheduler_stats(is_verified: bool = Depends(verify_api_key)):
+    """Outbound send queue depth and latency"""
+    return send_scheduler.snapshot()
+
+
+@router.get("/coalescing")
+async def get_coalescing_stats(is_verified: bool = Depends(verify_api_key)):
+    """Bursts merged into one agent turn and the tokens they saved"""
+    return {
+        "enabled": coalescing_enabled(),
+        "window": config.TG_COALESCE_WINDOW,
+        "max_wait": config.TG_COALESCE_MAX_WAIT,
+        **coalesce_stats.__dict__,
+    }
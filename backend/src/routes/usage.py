@@ -0,0 +1,55 @@
+from collections import OrderedDict
+
+from fastapi import APIRouter, Depends, Query, status
+
+from src.schemas.usage import DailyUsage, UsageResponse, UsageTotals
+from src.utils.usage import read_rollups, usage_ledger
+from src.utils.utils import verify_api_key
+from src import config
+from src import logging
+
+
+router = APIRouter(prefix=f"/api/{config.API_VERSION}/usage", tags=["USAGE"])
+
+logger = logging.getLogger(__name__)
+
+
+def add_totals(totals: UsageTotals, delta) -> None:
+    totals.requests += delta.requests
+    totals.input_tokens += delta.input_tokens
+    totals.output_tokens += delta.output_tokens
+    totals.total_tokens += delta.total_tokens
+    totals.cost_usd += delta.cost_usd
+
+
+@router.get("/{chat_id}", response_model=UsageResponse, status_code=status.HTTP_200_OK)
+async def get_usage(
+    chat_id: str,
+    days: int = Query(default=30, ge=1, le=366),
+    is_verified: bool = Depends(verify_api_key),
+):
+    """Tokens and cost per day for a chat, from the rollups plus what this
+    process has not flushed yet. The usage of the other processes shows up
+    once they flush it, within `USAGE_FLUSH_INTERVAL` seconds."""
+    rows = [
+        ((row.day, row.model, row.stage), row) for row in await read_rollups(chat_id, days)
+    ]
+    rows += [
+        ((day, model, stage), delta)
+        for (_, day, model, stage), delta in usage_ledger.pending_for(chat_id).items()
+    ]
+
+    by_day: "OrderedDict" = OrderedDict()
+    total = UsageTotals()
+    for (day, model, stage), delta in sorted(rows, key=lambda item: item[0]):
+        daily = by_day.setdefault(day, DailyUsage(day=day))
+        add_totals(daily, delta)
+        add_totals(daily.breakdown.setdefault(f"{stage}:{model}", UsageTotals()), delta)
+        add_totals(total, delta)
+
+    return UsageResponse(
+        chat_id=chat_id,
+        days=list(by_day.values()),
+        total=total,
+        daily_token_quota=usage_ledger.daily_token_quota,
+    )
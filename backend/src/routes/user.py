@@ -1,10 +1,16 @@
-from fastapi import APIRouter, Depends, status
+from typing import Literal, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from src.database.database import get_db
+from src.database.database import AsyncSessionLocal, get_db
 from src.models.user import User
+from src.cache.conversation import conversation_cache
+from src.schemas.user import MessageOut, MessagePage
+from src.utils.history import decode_cursor, fetch_message_page
 from src import config
 from src.utils.utils import verify_api_key
 from src import logging
@@ -63,6 +69,7 @@ async def handle_post_register(
 
     try:
         await db.commit()
+        conversation_cache.invalidate(register_request.chatId)
         logger.info("User updated successfully.")
         return RegisterResponse(status=True, message="User registration successfull.")
     except Exception as e:
@@ -70,3 +77,52 @@ async def handle_post_register(
         return RegisterResponse(
             status=False, message="Server error, contact the admin of the Telegram Bot."
         )
+
+
+async def export_messages(
+    chat_id: str, cursor: Optional[str], newest_first: bool, page_size: int
+):
+    """Every message after `cursor` as NDJSON, one keyset page per query so no
+    transaction stays open for the whole export."""
+    while True:
+        async with AsyncSessionLocal() as session:
+            messages, cursor = await fetch_message_page(
+                session, chat_id, page_size, cursor, newest_first
+            )
+        for message in messages:
+            yield MessageOut.model_validate(message).model_dump_json() + "\n"
+        if cursor is None:
+            break
+
+
+@router.get("/{chat_id}/messages", response_model=MessagePage)
+async def get_messages(
+    chat_id: str,
+    cursor: Optional[str] = None,
+    limit: int = Query(default=50, ge=1, le=config.MESSAGES_PAGE_MAX),
+    order: Literal["asc", "desc"] = "asc",
+    format: Literal["json", "ndjson"] = "json",
+    db: AsyncSession = Depends(get_db),
+    is_verified: bool = Depends(verify_api_key),
+):
+    """Stored messages of a chat, paginated on `(created_at, id)`.
+
+    `format=ndjson` streams every message after `cursor` instead of one page."""
+    if cursor is not None:
+        try:
+            decode_cursor(cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+    newest_first = order == "desc"
+    if format == "ndjson":
+        return StreamingResponse(
+            export_messages(chat_id, cursor, newest_first, config.MESSAGES_PAGE_MAX),
+            media_type="application/x-ndjson",
+        )
+
+    messages, next_cursor = await fetch_message_page(db, chat_id, limit, cursor, newest_first)
+    return MessagePage(
+        messages=[MessageOut.model_validate(message) for message in messages],
+        next_cursor=next_cursor,
+    )
@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Optional
 
 from pydantic import BaseModel
 
@@ -12,6 +12,9 @@ class AgentChatRequest(BaseModel):
     query: str
     chat_history: List[ChatHistory] = []
     user_id: str
+    # Use the stored conversation of `user_id` instead of `chat_history`, the
+    # new turn is stored as well. `AGENT_CHAT_SERVER_HISTORY` when not set
+    server_history: Optional[bool] = None
 
 
 class AgentChatResponse(BaseModel):
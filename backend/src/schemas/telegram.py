@@ -34,7 +34,8 @@ class TelegramMessage(BaseModel):
     from_user: TelegramMessageFrom = Field(..., alias="from")
     chat: TelegramChat
     date: int
-    text: str
+    # Missing for photos, stickers and other non text messages
+    text: Optional[str] = None
 
     class Config:
         populate_by_name = True
@@ -46,4 +47,4 @@ class Update(BaseModel):
 
     @property
     def has_text_message(self) -> bool:
-        return self.message is not None and hasattr(self.message, "text")
+        return self.message is not None and self.message.text is not None
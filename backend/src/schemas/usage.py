@@ -0,0 +1,25 @@
+from datetime import date
+from typing import Dict, List
+
+from pydantic import BaseModel
+
+
+class UsageTotals(BaseModel):
+    requests: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    total_tokens: int = 0
+    cost_usd: float = 0.0
+
+
+class DailyUsage(UsageTotals):
+    day: date
+    # Keyed by "stage:model"
+    breakdown: Dict[str, UsageTotals] = {}
+
+
+class UsageResponse(BaseModel):
+    chat_id: str
+    days: List[DailyUsage]
+    total: UsageTotals
+    daily_token_quota: int
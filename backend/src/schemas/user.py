@@ -1,4 +1,7 @@
-from pydantic import BaseModel
+from datetime import datetime
+from typing import List, Optional
+
+from pydantic import BaseModel, ConfigDict
 
 
 class UserInfo(BaseModel):
@@ -6,3 +9,22 @@ class UserInfo(BaseModel):
     chat_id: str
     age: int
     gender: str
+
+
+class MessageOut(BaseModel):
+    id: str
+    query: Optional[str] = None
+    response: Optional[str] = None
+    input_tokens: Optional[int] = None
+    output_tokens: Optional[int] = None
+    total_tokens: Optional[int] = None
+    model: Optional[str] = None
+    created_at: datetime
+
+    model_config = ConfigDict(from_attributes=True, protected_namespaces=())
+
+
+class MessagePage(BaseModel):
+    messages: List[MessageOut]
+    # Pass back as `cursor` for the next page, None on the last page
+    next_cursor: Optional[str] = None
@@ -0,0 +1,517 @@
+import asyncio
+import json
+import os
+import signal
+import socket
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from agents import Runner
+from openai.types.responses import ResponseTextDeltaEvent
+from sqlalchemy import select
+
+from src.prompts.prompts import GUARDRAIL_FALSE_PROMPT
+from src.schemas.user import UserInfo
+from src.schemas.agent import ChatHistory
+from src.utils.telegram import send_telegram_message, telegram_client
+from src.utils.telegram_stream import TelegramStreamWriter
+from src.agents.refusal import refusal_pool
+from src.agents.guardrail_pipeline import check_guardrail
+from src.agents.menatl_health_support import mental_health_support_agent
+from src.tasks.tasks import handle_tg_chat, handle_tg_message
+from src.tasks.coalesce import (
+    TurnResult,
+    coalescing_enabled,
+    get_chat_mailbox,
+    mailbox_entry,
+    run_chat_mailbox,
+)
+from src.database.database import AsyncSessionLocal
+from src.database.message_writer import message_record, message_writer
+from src.utils.usage import UsageCollector, usage_ledger
+from src.utils.metrics import (
+    AGENT_SECONDS,
+    AGENT_TTFT_SECONDS,
+    ERRORS,
+    IN_FLIGHT,
+    TG_TASK_SECONDS,
+    TG_WORKER_JOBS,
+)
+from src.models.user import User
+from src.cache.conversation import conversation_cache
+from src.utils import llm
+from src.utils.resources import resources
+from src import config
+from src import logging
+
+logger = logging.getLogger(__name__)
+
+TG_MESSAGE_QUEUE = "handle_tg_message"
+
+
+class InMemoryBroker:
+    """Process local broker, the worker has to run in the same event loop.
+
+    Consumed jobs are held until `ack`, dead lettered jobs are kept in
+    `dead_letters`."""
+
+    def __init__(self):
+        self._queue: asyncio.Queue[Dict[str, Any]] = asyncio.Queue()
+        self._unacked: Dict[int, Dict[str, Any]] = {}
+        self.dead_letters: List[Dict[str, Any]] = []
+
+    @property
+    def unacked(self) -> int:
+        return len(self._unacked)
+
+    async def publish(self, job: Dict[str, Any]) -> None:
+        await self._queue.put(job)
+
+    async def consume(self, timeout: float) -> Optional[Dict[str, Any]]:
+        try:
+            job = await asyncio.wait_for(self._queue.get(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return None
+        self._unacked[id(job)] = job
+        return job
+
+    async def ack(self, job: Dict[str, Any]) -> None:
+        self._unacked.pop(id(job), None)
+
+    async def dead_letter(self, job: Dict[str, Any]) -> None:
+        self.dead_letters.append(job)
+
+    async def recover(self) -> int:
+        # The unacked jobs die with the process
+        return 0
+
+    async def qsize(self) -> int:
+        return self._queue.qsize()
+
+    async def close(self) -> None:
+        pass
+
+
+class RedisBroker:
+    """Redis list based broker, shared by the API and any number of workers.
+
+    A consumed job is moved to the processing list of this consumer until it
+    is acked, dead lettered jobs are pushed to `<queue>:dead`. Each consumer
+    holds a lease key of `lease_ttl` seconds, renewed by `recover`, which
+    also queues again the jobs of the consumers whose lease expired."""
+
+    def __init__(
+        self,
+        url: str,
+        queue_name: str = TG_MESSAGE_QUEUE,
+        lease_ttl: float = config.TG_WORKER_LEASE_TTL,
+    ):
+        import redis.asyncio as redis
+
+        self._redis = redis.from_url(url)
+        self._queue_name = queue_name
+        self.lease_ttl = lease_ttl
+        consumer = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._processing_prefix = f"{queue_name}:processing:"
+        self._processing_name = f"{self._processing_prefix}{consumer}"
+        self._lease_name = self._lease_key(consumer)
+        self._dead_name = f"{queue_name}:dead"
+        # Raw payloads of the jobs in flight, `ack` removes exactly those
+        self._raw: Dict[int, bytes] = {}
+
+    def _lease_key(self, consumer: str) -> str:
+        return f"{self._queue_name}:consumer:{consumer}"
+
+    async def publish(self, job: Dict[str, Any]) -> None:
+        await self._redis.lpush(self._queue_name, json.dumps(job))
+
+    async def consume(self, timeout: float) -> Optional[Dict[str, Any]]:
+        raw = await self._redis.blmove(
+            self._queue_name, self._processing_name, timeout, src="RIGHT", dest="LEFT"
+        )
+        if raw is None:
+            return None
+        job = json.loads(raw)
+        self._raw[id(job)] = raw
+        return job
+
+    async def ack(self, job: Dict[str, Any]) -> None:
+        raw = self._raw.pop(id(job), None)
+        if raw is not None:
+            await self._redis.lrem(self._processing_name, 1, raw)
+
+    async def dead_letter(self, job: Dict[str, Any]) -> None:
+        await self._redis.lpush(self._dead_name, json.dumps(job))
+
+    async def recover(self) -> int:
+        """Renew the lease of this consumer and queue again the jobs of the
+        consumers without one, returns how many."""
+        await self._redis.set(self._lease_name, 1, px=int(self.lease_ttl * 1000))
+        requeued = 0
+        async for key in self._redis.scan_iter(match=f"{self._processing_prefix}*"):
+            consumer = key.decode()[len(self._processing_prefix) :]
+            if await self._redis.exists(self._lease_key(consumer)):
+                continue
+            # Oldest job last, the next one consumed. LMOVE is atomic, two
+            # consumers recovering the same list move each job once
+            while await self._redis.lmove(key, self._queue_name, "LEFT", "RIGHT") is not None:
+                requeued += 1
+        if requeued:
+            logger.warning(f"Queued again {requeued} jobs of workers that stopped")
+        return requeued
+
+    async def qsize(self) -> int:
+        return await self._redis.llen(self._queue_name)
+
+    async def close(self) -> None:
+        # The jobs still unacked are recovered at once by the other workers
+        await self._redis.delete(self._lease_name)
+        await self._redis.aclose()
+
+
+_broker = None
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        if config.TG_WORKER_BROKER_URL.startswith("memory://"):
+            _broker = InMemoryBroker()
+        else:
+            _broker = RedisBroker(config.TG_WORKER_BROKER_URL)
+    return _broker
+
+
+async def handle_tg_message_async(
+    chat_id: int,
+    text: str,
+    formatted_chat_history: List[ChatHistory],
+    user_info: Optional[Dict[str, Any]] = None,
+    notify_errors: bool = True,
+):
+    """Async version of `handle_tg_message`, same inputs, persistence and result.
+
+    Without `notify_errors`, a failure before the user got any message is
+    raised for the worker to retry instead of answered with the error message."""
+    logger.info("Running handle_tg_message_async function")
+    started_at = time.perf_counter()
+    IN_FLIGHT.labels("telegram_worker").inc()
+    # Anything shown to the user, and the whole reply
+    replied = False
+    is_delivered = False
+    writer = None
+    try:
+        if not await usage_ledger.within_quota(str(chat_id)):
+            await send_telegram_message(chat_id, config.QUOTA_MESSAGE)
+            return
+
+        guardrail_check = await check_guardrail(formatted_chat_history)
+        logger.info(
+            f"Guardrail verdict from {guardrail_check.source}, saved tokens: {guardrail_check.saved_tokens}"
+        )
+
+        usage = UsageCollector()
+        usage.add("guardrail", config.OPENAI_GUARDRAIL_MODEL, guardrail_check.usage)
+
+        guardrail_reault = guardrail_check.output
+        branch = "agent" if guardrail_reault.is_mental_health else "refusal"
+        agent_started_at = time.perf_counter()
+
+        response = ""
+
+        if guardrail_reault.is_mental_health:
+            if user_info is None:
+                async with AsyncSessionLocal() as session:
+                    result = await session.execute(
+                        statement=select(User).filter(User.chat_id == str(chat_id))
+                    )
+                    db_user = result.scalars().first()
+                user_info = {
+                    "age": db_user.age,
+                    "gender": db_user.gender,
+                    "chat_id": str(chat_id),
+                    "name": db_user.first_name,
+                }
+
+            if config.TELEGRAM_STREAMING:
+                result = Runner.run_streamed(
+                    starting_agent=mental_health_support_agent,
+                    input=formatted_chat_history,
+                    context=UserInfo(**user_info),
+                )
+                writer = TelegramStreamWriter(chat_id)
+                await writer.start()
+                replied = True
+                first_token = True
+                async for event in result.stream_events():
+                    if event.type == "raw_response_event" and isinstance(
+                        event.data, ResponseTextDeltaEvent
+                    ):
+                        if first_token:
+                            first_token = False
+                            AGENT_TTFT_SECONDS.labels("telegram").observe(
+                                time.perf_counter() - started_at
+                            )
+                        await writer.feed(event.data.delta)
+                await writer.finish(result.final_output)
+                is_delivered = True
+            else:
+                result = await Runner.run(
+                    starting_agent=mental_health_support_agent,
+                    input=formatted_chat_history,
+                    context=UserInfo(**user_info),
+                )
+
+            response = result.final_output
+            usage.add_raw_responses("agent", config.OPENAI_AGENT_MODEL, result.raw_responses)
+        elif config.REFUSAL_MODE == "template":
+            response = refusal_pool.refuse(text, guardrail_reault.reasoning)
+        else:
+            completion = await llm.async_client().responses.create(
+                model=config.OPENAI_AGENT_MODEL,
+                input=[
+                    {
+                        "role": "user",
+                        "content": GUARDRAIL_FALSE_PROMPT.format(
+                            **{
+                                "reasoning": guardrail_reault.reasoning,
+                                "query": text,
+                            }
+                        ),
+                    },
+                ],
+            )
+            response += completion.output_text
+            usage.add_response_usage("refusal", config.OPENAI_AGENT_MODEL, completion.usage)
+
+        AGENT_SECONDS.labels("telegram", branch).observe(time.perf_counter() - agent_started_at)
+        # Spent even when the reply cannot be delivered
+        usage_ledger.record(str(chat_id), usage)
+
+        if not is_delivered:
+            await send_telegram_message(chat_id, response)
+            replied = is_delivered = True
+
+        total = usage.total()
+        await message_writer.write(
+            message_record(
+                query=text,
+                response=response,
+                input_tokens=total.input_tokens,
+                output_tokens=total.output_tokens,
+                total_tokens=total.total_tokens,
+                model=config.OPENAI_AGENT_MODEL,
+                provider="Openai",
+                chat_id=str(chat_id),
+            )
+        )
+        # The writer flushes in the background, the next turn of this
+        # process finds it in the cache until then
+        conversation_cache.append_turn(str(chat_id), text, response)
+        return TurnResult(response, total.total_tokens)
+    except Exception as e:
+        ERRORS.labels("telegram_worker").inc()
+        logger.info(f"First error at handle_tg_message_async: {str(e)}")
+        if not notify_errors and not replied:
+            raise
+        if is_delivered:
+            # The user has the reply, only storing it failed
+            return
+        try:
+            if writer is not None:
+                # Not a partial reply and a separate error message
+                await writer.fail(config.ERROR_MESSAGE)
+            else:
+                await send_telegram_message(chat_id, config.ERROR_MESSAGE)
+        except Exception as e:
+            logger.info(
+                f"Failed to process message and notify user. handle_tg_message_async: {str(e)}"
+            )
+    finally:
+        TG_TASK_SECONDS.labels("async").observe(time.perf_counter() - started_at)
+        IN_FLIGHT.labels("telegram_worker").dec()
+
+
+async def run_tg_job(job: Dict[str, Any], final_attempt: bool) -> None:
+    """Run one broker job, raises when it should be retried or dead lettered."""
+    if job.get("coalesce"):
+        await run_chat_mailbox(job["chat_id"], handle_tg_message_async)
+        return
+    arguments = {key: value for key, value in job.items() if key != "attempts"}
+    try:
+        await handle_tg_message_async(**arguments, notify_errors=False)
+    except Exception:
+        if final_attempt:
+            try:
+                await send_telegram_message(job["chat_id"], config.ERROR_MESSAGE)
+            except Exception as e:
+                logger.info(f"Failed to notify user of a dead lettered job: {str(e)}")
+        raise
+
+
+class AsyncWorker:
+    """Consume Telegram jobs from a broker and run up to `max_in_flight` of them
+    concurrently on one event loop.
+
+    A job is acked once it is done, retried or dead lettered. A job that
+    raises is published again with its `attempts` count after an exponential
+    delay, the failure of its last attempt goes to the dead letter queue.
+    The broker lease is renewed every `lease_interval` seconds."""
+
+    def __init__(
+        self,
+        broker,
+        max_in_flight: int = config.TG_WORKER_MAX_IN_FLIGHT,
+        handler: Callable[[Dict[str, Any], bool], Awaitable[None]] = run_tg_job,
+        max_attempts: int = config.TG_WORKER_MAX_ATTEMPTS,
+        retry_delay: float = config.TG_WORKER_RETRY_DELAY,
+        lease_interval: float = config.TG_WORKER_LEASE_TTL / 3,
+    ):
+        self.broker = broker
+        self.max_in_flight = max_in_flight
+        self.handler = handler
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lease_interval = lease_interval
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._tasks: set[asyncio.Task] = set()
+        self._stopping = asyncio.Event()
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._tasks)
+
+    async def _run_job(self, job: Dict[str, Any]) -> None:
+        attempts = job.get("attempts", 0) + 1
+        released = False
+        try:
+            try:
+                await self.handler(job, attempts >= self.max_attempts)
+            except Exception as e:
+                # The retry delay does not hold a slot
+                self._semaphore.release()
+                released = True
+                if attempts < self.max_attempts:
+                    delay = self.retry_delay * 2 ** (attempts - 1)
+                    logger.warning(
+                        f"Job for chat {job.get('chat_id')} failed, attempt {attempts}/{self.max_attempts}, "
+                        f"retrying in {delay}s: {str(e)}"
+                    )
+                    # Published at once when the worker stops
+                    try:
+                        await asyncio.wait_for(self._stopping.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    await self.broker.publish({**job, "attempts": attempts})
+                    TG_WORKER_JOBS.labels("retried").inc()
+                else:
+                    logger.error(
+                        f"Job for chat {job.get('chat_id')} failed {attempts} times, dead lettered: {str(e)}"
+                    )
+                    await self.broker.dead_letter({**job, "attempts": attempts, "error": str(e)})
+                    TG_WORKER_JOBS.labels("dead_letter").inc()
+            else:
+                TG_WORKER_JOBS.labels("done").inc()
+            await self.broker.ack(job)
+        finally:
+            # Also when cancelled, the job stays unacked and is recovered
+            if not released:
+                self._semaphore.release()
+
+    async def _keep_lease(self) -> None:
+        while True:
+            await asyncio.sleep(self.lease_interval)
+            try:
+                await self.broker.recover()
+            except Exception as e:
+                logger.error(f"Worker lease renewal failed: {str(e)}")
+
+    async def run(self) -> None:
+        logger.info(f"Async worker started, max in flight: {self.max_in_flight}")
+        await self.broker.recover()
+        lease_task = asyncio.create_task(self._keep_lease())
+        try:
+            while not self._stopping.is_set():
+                await self._semaphore.acquire()
+                job = await self.broker.consume(timeout=1.0)
+                if job is None:
+                    self._semaphore.release()
+                    continue
+                task = asyncio.create_task(self._run_job(job))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+        finally:
+            if self._tasks:
+                logger.info(f"Waiting for {len(self._tasks)} in flight jobs")
+                await asyncio.gather(*self._tasks, return_exceptions=True)
+            lease_task.cancel()
+            logger.info("Async worker stopped")
+
+    def stop(self) -> None:
+        self._stopping.set()
+
+
+async def dispatch_tg_message(
+    chat_id: int,
+    text: str,
+    formatted_chat_history: List[ChatHistory],
+    user_info: Optional[Dict[str, Any]] = None,
+):
+    """Hand a Telegram message to the configured worker backend.
+
+    When coalescing, the message goes to the chat mailbox and the job only
+    tells a worker to look at it."""
+    if coalescing_enabled():
+        await get_chat_mailbox().push(
+            str(chat_id), mailbox_entry(text, formatted_chat_history, user_info)
+        )
+        if config.TG_WORKER_BACKEND == "async":
+            await get_broker().publish({"chat_id": chat_id, "coalesce": True})
+        else:
+            handle_tg_chat.delay(chat_id=chat_id)
+    elif config.TG_WORKER_BACKEND == "async":
+        await get_broker().publish(
+            {
+                "chat_id": chat_id,
+                "text": text,
+                "formatted_chat_history": formatted_chat_history,
+                "user_info": user_info,
+            }
+        )
+    else:
+        handle_tg_message.delay(
+            chat_id=chat_id,
+            text=text,
+            formatted_chat_history=formatted_chat_history,
+            user_info=user_info,
+        )
+
+
+async def main():
+    if config.TG_WORKER_BROKER_URL.startswith("memory://"):
+        logger.warning(
+            "In memory broker only works inside the API process, set TG_WORKER_BROKER_URL"
+        )
+    broker = get_broker()
+    worker = AsyncWorker(broker)
+    await telegram_client.start()
+    await message_writer.start()
+    await usage_ledger.start()
+    await refusal_pool.start()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, worker.stop)
+    try:
+        await worker.run()
+    finally:
+        await broker.close()
+        await message_writer.stop()
+        await usage_ledger.stop()
+        await refusal_pool.stop()
+        await telegram_client.aclose()
+        await resources.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,373 @@
+import asyncio
+import json
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional
+
+from src.utils.metrics import COALESCED_MESSAGES, SAVED_TOKENS
+from src import config
+from src import logging
+
+logger = logging.getLogger(__name__)
+
+
+class TurnResult(NamedTuple):
+    response: str
+    total_tokens: int
+
+
+@dataclass
+class CoalesceStats:
+    # Agent turns run from a mailbox and the messages merged into them
+    turns: int = 0
+    messages: int = 0
+    # Estimated, every merged message would have run its own turn
+    saved_tokens: int = 0
+
+
+def mailbox_entry(
+    text: str,
+    formatted_chat_history: List[Dict[str, str]],
+    user_info: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    return {
+        "text": text,
+        "formatted_chat_history": formatted_chat_history,
+        "user_info": user_info,
+        "at": time.time(),
+    }
+
+
+def debounce_deadline(
+    entries: List[Dict[str, Any]],
+    window: float = config.TG_COALESCE_WINDOW,
+    max_wait: float = config.TG_COALESCE_MAX_WAIT,
+) -> float:
+    """When a burst is complete: `window` after its last message, but no
+    later than `max_wait` after its first."""
+    return min(entries[-1]["at"] + window, entries[0]["at"] + max_wait)
+
+
+def merge_entries(
+    entries: List[Dict[str, Any]],
+    previous: Optional[TurnResult] = None,
+    previous_at: float = 0,
+    previous_query: str = "",
+) -> Dict[str, Any]:
+    """One job for a burst of messages, oldest first.
+
+    The context of the newest message is used with its query replaced by all
+    the texts. The turn that ran while the burst was waiting is not in that
+    context yet, it is added back when `previous` is given."""
+    text = "\n".join(entry["text"] for entry in entries)
+    latest = entries[-1]
+    history = list(latest["formatted_chat_history"][:-1])
+    if previous is not None and latest["at"] < previous_at:
+        history.append({"role": "user", "content": previous_query})
+        history.append({"role": "assistant", "content": previous.response})
+    history.append({"role": "user", "content": text})
+    return {
+        "text": text,
+        "formatted_chat_history": history,
+        "user_info": latest["user_info"],
+    }
+
+
+class InMemoryChatMailbox:
+    """Per chat mailboxes and leases of this process, for the in process worker."""
+
+    def __init__(self):
+        self._entries: Dict[str, List[Dict[str, Any]]] = {}
+        self._leases: Dict[str, tuple] = {}
+
+    async def push(self, chat_id: str, entry: Dict[str, Any]) -> None:
+        self._entries.setdefault(chat_id, []).append(entry)
+
+    async def peek(self, chat_id: str) -> List[Dict[str, Any]]:
+        return list(self._entries.get(chat_id, ()))
+
+    async def drain(self, chat_id: str) -> List[Dict[str, Any]]:
+        return self._entries.pop(chat_id, [])
+
+    async def acquire(self, chat_id: str, ttl: float) -> Optional[str]:
+        lease = self._leases.get(chat_id)
+        if lease is not None and lease[1] > time.monotonic():
+            return None
+        token = uuid.uuid4().hex
+        self._leases[chat_id] = (token, time.monotonic() + ttl)
+        return token
+
+    async def renew(self, chat_id: str, token: str, ttl: float) -> bool:
+        lease = self._leases.get(chat_id)
+        if lease is None or lease[0] != token:
+            return False
+        self._leases[chat_id] = (token, time.monotonic() + ttl)
+        return True
+
+    async def release(self, chat_id: str, token: str) -> None:
+        lease = self._leases.get(chat_id)
+        if lease is not None and lease[0] == token:
+            del self._leases[chat_id]
+
+
+# Only delete or extend the lease when it is still ours
+RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+RENEW_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("pexpire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class RedisChatMailbox:
+    """Per chat mailboxes (lists) and leases (`SET NX PX` keys) in Redis, shared
+    by the API and every worker process. The sync methods are for Celery."""
+
+    def __init__(self, url: str):
+        self.url = url
+        self._redis = None
+        self._redis_sync = None
+
+    def _mailbox_key(self, chat_id: str) -> str:
+        return f"tg:mailbox:{chat_id}"
+
+    def _lease_key(self, chat_id: str) -> str:
+        return f"tg:lease:{chat_id}"
+
+    async def push(self, chat_id: str, entry: Dict[str, Any]) -> None:
+        key = self._mailbox_key(chat_id)
+        async with self._async_redis().pipeline(transaction=True) as pipe:
+            pipe.rpush(key, json.dumps(entry))
+            # A mailbox nobody drains must not live forever
+            pipe.expire(key, int(config.TG_CHAT_LEASE_TTL))
+            await pipe.execute()
+
+    async def peek(self, chat_id: str) -> List[Dict[str, Any]]:
+        raw = await self._async_redis().lrange(self._mailbox_key(chat_id), 0, -1)
+        return [json.loads(item) for item in raw]
+
+    async def drain(self, chat_id: str) -> List[Dict[str, Any]]:
+        key = self._mailbox_key(chat_id)
+        async with self._async_redis().pipeline(transaction=True) as pipe:
+            pipe.lrange(key, 0, -1)
+            pipe.delete(key)
+            raw, _ = await pipe.execute()
+        return [json.loads(item) for item in raw]
+
+    async def acquire(self, chat_id: str, ttl: float) -> Optional[str]:
+        token = uuid.uuid4().hex
+        acquired = await self._async_redis().set(
+            self._lease_key(chat_id), token, nx=True, px=int(ttl * 1000)
+        )
+        return token if acquired else None
+
+    async def renew(self, chat_id: str, token: str, ttl: float) -> bool:
+        renewed = await self._async_redis().eval(
+            RENEW_SCRIPT, 1, self._lease_key(chat_id), token, int(ttl * 1000)
+        )
+        return bool(renewed)
+
+    async def release(self, chat_id: str, token: str) -> None:
+        await self._async_redis().eval(RELEASE_SCRIPT, 1, self._lease_key(chat_id), token)
+
+    def peek_sync(self, chat_id: str) -> List[Dict[str, Any]]:
+        raw = self._sync_redis().lrange(self._mailbox_key(chat_id), 0, -1)
+        return [json.loads(item) for item in raw]
+
+    def drain_sync(self, chat_id: str) -> List[Dict[str, Any]]:
+        key = self._mailbox_key(chat_id)
+        with self._sync_redis().pipeline(transaction=True) as pipe:
+            pipe.lrange(key, 0, -1)
+            pipe.delete(key)
+            raw, _ = pipe.execute()
+        return [json.loads(item) for item in raw]
+
+    def acquire_sync(self, chat_id: str, ttl: float) -> Optional[str]:
+        token = uuid.uuid4().hex
+        acquired = self._sync_redis().set(
+            self._lease_key(chat_id), token, nx=True, px=int(ttl * 1000)
+        )
+        return token if acquired else None
+
+    def renew_sync(self, chat_id: str, token: str, ttl: float) -> bool:
+        renewed = self._sync_redis().eval(
+            RENEW_SCRIPT, 1, self._lease_key(chat_id), token, int(ttl * 1000)
+        )
+        return bool(renewed)
+
+    def release_sync(self, chat_id: str, token: str) -> None:
+        self._sync_redis().eval(RELEASE_SCRIPT, 1, self._lease_key(chat_id), token)
+
+    def _async_redis(self):
+        if self._redis is None:
+            import redis.asyncio as redis
+
+            self._redis = redis.from_url(self.url)
+        return self._redis
+
+    def _sync_redis(self):
+        if self._redis_sync is None:
+            import redis
+
+            self._redis_sync = redis.from_url(self.url)
+        return self._redis_sync
+
+
+def coalesce_redis_url() -> Optional[str]:
+    if config.TG_COALESCE_REDIS_URL:
+        return config.TG_COALESCE_REDIS_URL
+    if config.TG_WORKER_BACKEND == "async" and config.TG_WORKER_BROKER_URL.startswith("redis"):
+        return config.TG_WORKER_BROKER_URL
+    return None
+
+
+def coalescing_enabled() -> bool:
+    """Mailboxes must be visible to the worker, so without Redis only the in
+    process async worker coalesces."""
+    if config.TG_COALESCE_WINDOW <= 0:
+        return False
+    if coalesce_redis_url():
+        return True
+    return config.TG_WORKER_BACKEND == "async" and config.TG_WORKER_BROKER_URL.startswith(
+        "memory://"
+    )
+
+
+_mailbox = None
+
+
+def get_chat_mailbox():
+    global _mailbox
+    if _mailbox is None:
+        url = coalesce_redis_url()
+        _mailbox = RedisChatMailbox(url) if url else InMemoryChatMailbox()
+    return _mailbox
+
+
+coalesce_stats = CoalesceStats()
+
+
+def record_merge(entries: List[Dict[str, Any]], result: Optional[TurnResult]) -> None:
+    coalesce_stats.turns += 1
+    coalesce_stats.messages += len(entries)
+    if len(entries) < 2:
+        return
+    COALESCED_MESSAGES.labels().inc(len(entries) - 1)
+    if result is not None:
+        saved_tokens = result.total_tokens * (len(entries) - 1)
+        coalesce_stats.saved_tokens += saved_tokens
+        SAVED_TOKENS.labels("coalesce").inc(saved_tokens)
+    logger.info(f"Merged {len(entries)} messages into one turn")
+
+
+async def run_chat_mailbox(
+    chat_id: int,
+    handler: Callable[..., Awaitable[Optional[TurnResult]]],
+    mailbox=None,
+    ttl: float = config.TG_CHAT_LEASE_TTL,
+) -> None:
+    """Run the pending messages of a chat, one turn per burst, while holding
+    the chat lease so only one turn of a chat runs at a time, in order.
+
+    Every message publishes a job, the jobs that find the lease taken return
+    at once, the holder picks up their messages."""
+    mailbox = mailbox or get_chat_mailbox()
+    key = str(chat_id)
+    while True:
+        token = await mailbox.acquire(key, ttl)
+        if token is None:
+            return
+        previous, previous_at, previous_query = None, 0.0, ""
+        try:
+            while True:
+                entries = await mailbox.peek(key)
+                if not entries:
+                    break
+                delay = debounce_deadline(entries) - time.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+                entries = await mailbox.drain(key)
+                if not entries:
+                    break
+                job = merge_entries(entries, previous, previous_at, previous_query)
+                job["chat_id"] = chat_id
+                previous = await handler(**job)
+                previous_at, previous_query = time.time(), job["text"]
+                record_merge(entries, previous)
+                await mailbox.renew(key, token, ttl)
+        finally:
+            await mailbox.release(key, token)
+        # A message may have arrived after the last peek, its job found the
+        # lease taken and returned
+        if not await mailbox.peek(key):
+            return
+
+
+def run_chat_mailbox_sync(
+    chat_id: int,
+    handler: Callable[..., Optional[TurnResult]],
+    reschedule: Callable[[float, Dict[str, Any]], None],
+    mailbox: Optional[RedisChatMailbox] = None,
+    ttl: float = config.TG_CHAT_LEASE_TTL,
+    token: Optional[str] = None,
+    previous: Optional[TurnResult] = None,
+    previous_at: float = 0,
+    previous_query: str = "",
+) -> None:
+    """Blocking version of `run_chat_mailbox` for Celery, Redis only.
+
+    A Celery worker slot must not sleep through the debounce window, so the
+    run is handed to `reschedule` with the delay and the state to resume
+    with, still holding the chat lease, and resumes from there."""
+    mailbox = mailbox or get_chat_mailbox()
+    key = str(chat_id)
+    while True:
+        if token is None:
+            token = mailbox.acquire_sync(key, ttl)
+            if token is None:
+                return
+        elif not mailbox.renew_sync(key, token, ttl):
+            # The lease expired while the run was scheduled, another job holds it
+            return
+        handed_over = False
+        try:
+            while True:
+                entries = mailbox.peek_sync(key)
+                if not entries:
+                    break
+                delay = debounce_deadline(entries) - time.time()
+                if delay > 0:
+                    reschedule(
+                        delay,
+                        {
+                            "token": token,
+                            "previous": previous,
+                            "previous_at": previous_at,
+                            "previous_query": previous_query,
+                        },
+                    )
+                    handed_over = True
+                    return
+                entries = mailbox.drain_sync(key)
+                if not entries:
+                    break
+                job = merge_entries(entries, previous, previous_at, previous_query)
+                job["chat_id"] = chat_id
+                previous = handler(**job)
+                previous_at, previous_query = time.time(), job["text"]
+                record_merge(entries, previous)
+                mailbox.renew_sync(key, token, ttl)
+        finally:
+            if not handed_over:
+                mailbox.release_sync(key, token)
+        if not mailbox.peek_sync(key):
+            return
+        token, previous, previous_at, previous_query = None, None, 0.0, ""
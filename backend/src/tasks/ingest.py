@@ -0,0 +1,250 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+from sqlalchemy import delete
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.cache.updates import SeenUpdates
+from src.database.database import AsyncSessionLocal
+from src.models.telegram_update import TelegramUpdate
+from src.schemas.telegram import Update
+from src.utils.metrics import ERRORS, IN_FLIGHT, TG_UPDATE_SECONDS, TG_UPDATES
+from src import config
+from src import logging
+
+logger = logging.getLogger(__name__)
+
+# Outcomes of `UpdateIngestor.submit`
+ACCEPTED = "accepted"
+DUPLICATE = "duplicate"
+IGNORED = "ignored"
+REJECTED = "rejected"
+
+
+async def claim_updates(db: AsyncSession, update_ids: List[int]) -> Set[int]:
+    """Record the updates in the database, returns the ids no other process
+    recorded before."""
+    received_at = datetime.now()
+    result = await db.execute(
+        insert(TelegramUpdate)
+        .values([{"update_id": update_id, "received_at": received_at} for update_id in update_ids])
+        .on_conflict_do_nothing(index_elements=[TelegramUpdate.update_id])
+        .returning(TelegramUpdate.update_id)
+    )
+    await db.commit()
+    return set(result.scalars())
+
+
+class UpdateIngestor:
+    """Acknowledge Telegram updates at once and process them off the request path.
+
+    `submit` drops the updates already seen by this process and queues the
+    others, `concurrency` consumers then claim each update in the database,
+    which drops the ones another process took, and run `handler`.
+
+    `process_batch` is the same pipeline for a batch of polled updates, with
+    one claim for the batch and `prefetch` run once before the handlers."""
+
+    def __init__(
+        self,
+        handler: Callable[[Update, AsyncSession], Awaitable[Any]],
+        prefetch: Optional[Callable[[List[Update], AsyncSession], Awaitable[Any]]] = None,
+        concurrency: int = config.TG_INGEST_CONCURRENCY,
+        max_queue: int = config.TG_INGEST_QUEUE_SIZE,
+        dedup_ttl: float = config.TG_UPDATE_DEDUP_TTL,
+        prune_interval: float = 600,
+    ):
+        self.handler = handler
+        self.prefetch = prefetch
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.dedup_ttl = dedup_ttl
+        self.prune_interval = prune_interval
+        self.seen = SeenUpdates(ttl=dedup_ttl)
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._stopping = asyncio.Event()
+        self.counts: Dict[str, int] = {
+            ACCEPTED: 0,
+            IGNORED: 0,
+            REJECTED: 0,
+            "duplicate_memory": 0,
+            "duplicate_db": 0,
+            "processed": 0,
+            "failed": 0,
+        }
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def _count(self, outcome: str) -> None:
+        self.counts[outcome] += 1
+        TG_UPDATES.labels(outcome).inc()
+
+    def submit(self, update: Update) -> str:
+        """Never waits, an update that does not fit in the queue is rejected
+        so Telegram delivers it again later."""
+        if not self.seen.add(update.update_id):
+            self._count("duplicate_memory")
+            return DUPLICATE
+        if not update.has_text_message:
+            self._count(IGNORED)
+            return IGNORED
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queue)
+        try:
+            self._queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.seen.discard(update.update_id)
+            self._count(REJECTED)
+            return REJECTED
+        self._count(ACCEPTED)
+        return ACCEPTED
+
+    async def start(self) -> None:
+        if self._tasks:
+            return
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._stopping.clear()
+        self._tasks = [asyncio.create_task(self._consume()) for _ in range(self.concurrency)]
+        self._tasks.append(asyncio.create_task(self._prune_loop()))
+        logger.info(f"Update ingestor started, concurrency: {self.concurrency}")
+
+    async def stop(self) -> None:
+        """Process what is queued and stop."""
+        if not self._tasks:
+            return
+        self._stopping.set()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def join(self) -> None:
+        """Wait until every queued update has been processed."""
+        if self._queue is not None:
+            await self._queue.join()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "queue_depth": self.queue_depth,
+            "seen": len(self.seen),
+            "dedup_ttl": self.dedup_ttl,
+            **self.counts,
+        }
+
+    async def _consume(self) -> None:
+        while not (self._stopping.is_set() and self._queue.empty()):
+            try:
+                # Not cancelled on stop, a cancelled `wait_for` can drop the
+                # update it just got
+                update = await asyncio.wait_for(self._queue.get(), 1.0)
+            except asyncio.TimeoutError:
+                continue
+            try:
+                await self._process(update)
+            finally:
+                self._queue.task_done()
+
+    async def _claim(self, db: AsyncSession, updates: List[Update]) -> List[Update]:
+        try:
+            claimed = await claim_updates(db, [update.update_id for update in updates])
+        except Exception as e:
+            # Without the database the in memory check still applies
+            logger.error(f"Claiming {len(updates)} updates failed: {e}")
+            await db.rollback()
+            return updates
+        for _ in range(len(updates) - len(claimed)):
+            self._count("duplicate_db")
+        return [update for update in updates if update.update_id in claimed]
+
+    async def _handle(self, update: Update, db: Optional[AsyncSession] = None) -> None:
+        started_at = time.perf_counter()
+        IN_FLIGHT.labels("webhook").inc()
+        try:
+            if db is None:
+                async with AsyncSessionLocal() as db:
+                    await self.handler(update, db)
+            else:
+                await self.handler(update, db)
+            self.counts["processed"] += 1
+        except Exception as e:
+            self.counts["failed"] += 1
+            ERRORS.labels("webhook").inc()
+            logger.error(f"Processing update {update.update_id} failed: {e}")
+        finally:
+            IN_FLIGHT.labels("webhook").dec()
+            TG_UPDATE_SECONDS.labels().observe(time.perf_counter() - started_at)
+
+    async def _process(self, update: Update) -> None:
+        try:
+            async with AsyncSessionLocal() as db:
+                if await self._claim(db, [update]):
+                    await self._handle(update, db)
+        except Exception as e:
+            self.counts["failed"] += 1
+            ERRORS.labels("webhook").inc()
+            logger.error(f"Processing update {update.update_id} failed: {e}")
+
+    async def process_batch(self, updates: List[Update]) -> None:
+        """Process polled updates, the chats concurrently and the updates of a
+        chat in order."""
+        fresh = []
+        for update in updates:
+            if not self.seen.add(update.update_id):
+                self._count("duplicate_memory")
+            elif not update.has_text_message:
+                self._count(IGNORED)
+            else:
+                self._count(ACCEPTED)
+                fresh.append(update)
+        if not fresh:
+            return
+
+        async with AsyncSessionLocal() as db:
+            claimed = await self._claim(db, fresh)
+            if claimed and self.prefetch is not None:
+                try:
+                    await self.prefetch(claimed, db)
+                except Exception as e:
+                    # The handlers look up what is missing themselves
+                    logger.error(f"Prefetching {len(claimed)} updates failed: {e}")
+
+        by_chat: Dict[int, List[Update]] = {}
+        for update in claimed:
+            by_chat.setdefault(update.message.chat.id, []).append(update)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def handle_chat(chat_updates: List[Update]) -> None:
+            async with semaphore:
+                for update in chat_updates:
+                    await self._handle(update)
+
+        await asyncio.gather(*(handle_chat(chat_updates) for chat_updates in by_chat.values()))
+
+    async def _prune_loop(self) -> None:
+        next_prune = time.monotonic()
+        while not self._stopping.is_set():
+            if time.monotonic() >= next_prune:
+                next_prune = time.monotonic() + self.prune_interval
+                try:
+                    await self.prune()
+                except Exception as e:
+                    logger.error(f"Pruning Telegram updates failed: {e}")
+            try:
+                await asyncio.wait_for(self._stopping.wait(), 1.0)
+            except asyncio.TimeoutError:
+                pass
+
+    async def prune(self) -> int:
+        """Forget the updates older than the dedup window."""
+        cutoff = datetime.now() - timedelta(seconds=self.dedup_ttl)
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                delete(TelegramUpdate).filter(TelegramUpdate.received_at < cutoff)
+            )
+            await db.commit()
+        return result.rowcount
@@ -0,0 +1,197 @@
+import asyncio
+import signal
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from pydantic import ValidationError
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+
+from src.database.database import AsyncSessionLocal
+from src.models.telegram_update import TelegramPollState
+from src.schemas.telegram import Update
+from src.tasks.ingest import UpdateIngestor
+from src.utils.metrics import ERRORS
+from src.utils.telegram import TelegramClient, telegram_client
+from src import config
+from src import logging
+
+logger = logging.getLogger(__name__)
+
+MAX_BACKOFF = 30.0
+
+
+def bot_id_of(token: Optional[str]) -> int:
+    """The numeric bot id the token starts with, the key of the stored offset."""
+    prefix = (token or "").split(":", 1)[0]
+    return int(prefix) if prefix.isdigit() else 0
+
+
+async def load_offset(bot_id: int) -> int:
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            select(TelegramPollState.next_offset).filter(TelegramPollState.bot_id == bot_id)
+        )
+        return result.scalar() or 0
+
+
+async def save_offset(bot_id: int, offset: int) -> None:
+    now = datetime.now()
+    async with AsyncSessionLocal() as db:
+        await db.execute(
+            insert(TelegramPollState)
+            .values(bot_id=bot_id, next_offset=offset, updated_at=now)
+            .on_conflict_do_update(
+                index_elements=[TelegramPollState.bot_id],
+                set_={"next_offset": offset, "updated_at": now},
+            )
+        )
+        await db.commit()
+
+
+class UpdatePoller:
+    """Long poll `getUpdates` and feed each batch to the ingestor, for
+    deployments Telegram cannot reach with a webhook.
+
+    The offset is saved after every batch, a batch that was processed but not
+    saved before a crash is fetched again and dropped by the ingestor dedup."""
+
+    def __init__(
+        self,
+        ingestor: UpdateIngestor,
+        client: TelegramClient = telegram_client,
+        bot_id: int = bot_id_of(config.TELEGRAM_BOT_TOKEN),
+        limit: int = config.TG_POLL_LIMIT,
+        timeout: int = config.TG_POLL_TIMEOUT,
+    ):
+        self.ingestor = ingestor
+        self.client = client
+        self.bot_id = bot_id
+        self.limit = limit
+        self.timeout = timeout
+        self.offset = 0
+        self.counts: Dict[str, int] = {"polls": 0, "updates": 0, "invalid": 0, "errors": 0}
+        self._stopping = asyncio.Event()
+
+    async def get_updates(self) -> Optional[List[Dict[str, Any]]]:
+        """One long poll, None when it failed."""
+        data = await self.client.call(
+            "getUpdates",
+            {
+                "offset": self.offset,
+                "limit": self.limit,
+                "timeout": self.timeout,
+                "allowed_updates": '["message"]',
+            },
+            # Telegram holds the request up to `timeout` seconds
+            timeout=self.timeout + config.TELEGRAM_TIMEOUT,
+        )
+        self.counts["polls"] += 1
+        if not data.get("ok"):
+            if data.get("error_code") == 409:
+                logger.error("getUpdates conflicts with a webhook or another poller")
+            return None
+        return data.get("result") or []
+
+    async def process(self, raw_updates: List[Dict[str, Any]]) -> None:
+        updates = []
+        for raw in raw_updates:
+            try:
+                updates.append(Update.model_validate(raw))
+            except ValidationError as e:
+                # Skipped, the offset still moves past it
+                self.counts["invalid"] += 1
+                logger.error(f"Invalid update {raw.get('update_id')}: {e}")
+        self.counts["updates"] += len(raw_updates)
+        if updates:
+            await self.ingestor.process_batch(updates)
+        self.offset = max(raw["update_id"] for raw in raw_updates) + 1
+        await save_offset(self.bot_id, self.offset)
+
+    async def run(self) -> None:
+        # Telegram refuses `getUpdates` while a webhook is set
+        try:
+            await self.client.call("deleteWebhook", {"drop_pending_updates": "false"})
+        except Exception as e:
+            logger.error(f"Deleting the webhook failed: {e}")
+        self.offset = await load_offset(self.bot_id)
+        logger.info(f"Update poller started, offset: {self.offset}")
+        backoff = 1.0
+        while not self._stopping.is_set():
+            poll = asyncio.create_task(self.get_updates())
+            stopping = asyncio.create_task(self._stopping.wait())
+            # An unconfirmed long poll can be dropped, its updates come again
+            await asyncio.wait({poll, stopping}, return_when=asyncio.FIRST_COMPLETED)
+            stopping.cancel()
+            if not poll.done():
+                poll.cancel()
+                break
+            try:
+                raw_updates = poll.result()
+                if raw_updates is None:
+                    raise RuntimeError("getUpdates failed")
+                if raw_updates:
+                    await self.process(raw_updates)
+                backoff = 1.0
+            except Exception as e:
+                self.counts["errors"] += 1
+                ERRORS.labels("telegram").inc()
+                logger.error(f"Polling updates failed: {e}, retry in {backoff}s")
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), backoff)
+                except asyncio.TimeoutError:
+                    pass
+                backoff = min(backoff * 2, MAX_BACKOFF)
+        logger.info("Update poller stopped")
+
+    def stop(self) -> None:
+        self._stopping.set()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"offset": self.offset, **self.counts}
+
+
+async def main():
+    from src.agents.refusal import refusal_pool
+    from src.database.database import init_db
+    from src.database.message_writer import message_writer
+    from src.routes.telegram import update_ingestor
+    from src.tasks.async_worker import AsyncWorker, get_broker
+    from src.utils.resources import resources
+    from src.utils.usage import usage_ledger
+
+    await init_db()
+    await telegram_client.start()
+    await message_writer.start()
+    await usage_ledger.start()
+    await refusal_pool.start()
+    # Batches do not use the ingestor queue, started for the pruning
+    await update_ingestor.start()
+    poller = UpdatePoller(update_ingestor)
+    # The agent turns run in this process unless a shared broker is set
+    worker = None
+    worker_task = None
+    if config.TG_WORKER_BACKEND == "async" and config.TG_WORKER_BROKER_URL.startswith(
+        "memory://"
+    ):
+        worker = AsyncWorker(get_broker())
+        worker_task = asyncio.create_task(worker.run())
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, poller.stop)
+    try:
+        await poller.run()
+    finally:
+        await update_ingestor.stop()
+        if worker is not None:
+            worker.stop()
+            await worker_task
+        await message_writer.stop()
+        await usage_ledger.stop()
+        await refusal_pool.stop()
+        await telegram_client.aclose()
+        await resources.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
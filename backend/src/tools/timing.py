@@ -0,0 +1,23 @@
+import dataclasses
+import time
+
+from agents import FunctionTool
+
+from src.utils.metrics import ERRORS, TOOL_SECONDS
+
+
+def timed_tool(tool: FunctionTool) -> FunctionTool:
+    """Same tool, with its calls recorded in `tool_call_seconds`."""
+    on_invoke_tool = tool.on_invoke_tool
+
+    async def timed_on_invoke_tool(ctx, args: str):
+        started_at = time.perf_counter()
+        try:
+            return await on_invoke_tool(ctx, args)
+        except Exception:
+            ERRORS.labels("tool").inc()
+            raise
+        finally:
+            TOOL_SECONDS.labels(tool.name).observe(time.perf_counter() - started_at)
+
+    return dataclasses.replace(tool, on_invoke_tool=timed_on_invoke_tool)
@@ -0,0 +1,199 @@
+import asyncio
+import hashlib
+import json
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List
+
+from src.database.database import AsyncSessionLocal
+from src.models.chat_summary import ChatSummary
+from src.prompts.prompts import SUMMARY_PROMPT
+from src.utils.tokens import count_message_tokens
+from src.utils.usage import UsageCollector, usage_ledger
+from src.utils import llm
+from src import config
+from src import logging
+
+logger = logging.getLogger(__name__)
+
+
+def turn_fingerprint(turn: Any) -> str:
+    return hashlib.sha1(f"{turn.query}\n{turn.response}".encode()).hexdigest()[:16]
+
+
+def context_budget(model: str) -> int:
+    return config.CONTEXT_TOKEN_BUDGETS.get(model, config.AGENT_CONTEXT_TOKENS)
+
+
+@dataclass
+class SummaryState:
+    summary: str = ""
+    folded_turns: List[str] = field(default_factory=list)
+
+
+class SummaryStore:
+    """Rolling per chat summaries, an in memory LRU in front of the
+    `chat_summaries` table. Folding runs in the background, one fold per chat
+    at a time, so the request that triggers it uses the previous summary."""
+
+    def __init__(self, max_size: int = config.CONVERSATION_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries: OrderedDict[str, SummaryState] = OrderedDict()
+        self._folding: set = set()
+        self._tasks: set = set()
+
+    async def get(self, chat_id: str) -> SummaryState:
+        state = self._entries.get(chat_id)
+        if state is None:
+            async with AsyncSessionLocal() as session:
+                row = await session.get(ChatSummary, chat_id)
+            state = SummaryState()
+            if row is not None:
+                state = SummaryState(row.summary or "", json.loads(row.folded_turns))
+            self._set(chat_id, state)
+        self._entries.move_to_end(chat_id)
+        return state
+
+    def schedule_fold(self, chat_id: str, turns: List[Any]) -> None:
+        if chat_id in self._folding or not turns:
+            return
+        self._folding.add(chat_id)
+        task = asyncio.create_task(self._fold(chat_id, turns))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _fold(self, chat_id: str, turns: List[Any]) -> None:
+        try:
+            state = await self.get(chat_id)
+            formatted_turns = "\n".join(
+                f"User: {turn.query}\nAssistant: {turn.response}" for turn in turns
+            )
+            completion = await llm.async_client().responses.create(
+                model=config.SUMMARY_MODEL,
+                input=[
+                    {
+                        "role": "user",
+                        "content": SUMMARY_PROMPT.format(
+                            summary=state.summary or "None yet.", turns=formatted_turns
+                        ),
+                    }
+                ],
+            )
+            usage = UsageCollector()
+            usage.add_response_usage("summary", config.SUMMARY_MODEL, completion.usage)
+            usage_ledger.record(chat_id, usage)
+
+            folded_turns = state.folded_turns + [turn_fingerprint(t) for t in turns]
+            # Enough to recognise every turn that can still be in a history window
+            folded_turns = folded_turns[-config.HISTORY_TURNS * 2 :]
+            new_state = SummaryState(completion.output_text.strip(), folded_turns)
+
+            async with AsyncSessionLocal() as session:
+                row = await session.get(ChatSummary, chat_id)
+                if row is None:
+                    row = ChatSummary(chat_id=chat_id, input_tokens=0, output_tokens=0, total_tokens=0)
+                    session.add(row)
+                row.summary = new_state.summary
+                row.folded_turns = json.dumps(new_state.folded_turns)
+                row.model = config.SUMMARY_MODEL
+                row.input_tokens += completion.usage.input_tokens
+                row.output_tokens += completion.usage.output_tokens
+                row.total_tokens += completion.usage.total_tokens
+                await session.commit()
+            self._set(chat_id, new_state)
+            logger.info(
+                f"Folded {len(turns)} turns into the summary of {chat_id}, tokens: {completion.usage.total_tokens}"
+            )
+        except Exception as e:
+            logger.error(f"Summary fold failed for {chat_id}: {e}")
+        finally:
+            self._folding.discard(chat_id)
+
+    def _set(self, chat_id: str, state: SummaryState) -> None:
+        self._entries[chat_id] = state
+        self._entries.move_to_end(chat_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+summary_store = SummaryStore()
+
+
+async def build_context(
+    chat_id: str,
+    system_messages: List[Dict[str, str]],
+    turns: List[Any],
+    query: str,
+    model: str = config.OPENAI_AGENT_MODEL,
+    summaries: bool = config.CONTEXT_SUMMARIES,
+) -> List[Dict[str, str]]:
+    """Agent input for `query` within the token budget of `model`.
+
+    `turns` (objects with `query` and `response`, oldest first) are kept newest
+    first while they fit, the older ones are folded into the chat summary,
+    which is sent as a system message. Without `summaries` the older turns
+    are dropped, for turns that are not the stored conversation of the chat."""
+    budget = context_budget(model)
+    state = await summary_store.get(chat_id) if summaries else SummaryState()
+
+    head = list(system_messages)
+    if state.summary:
+        head.append(
+            {
+                "role": "system",
+                "content": f"Summary of the earlier conversation: {state.summary}",
+            }
+        )
+    query_message = {"role": "user", "content": query}
+    used_tokens = count_message_tokens(head + [query_message], model)
+
+    kept = []
+    for turn in reversed(turns):
+        turn_tokens = count_message_tokens(
+            [{"content": turn.query}, {"content": turn.response}], model
+        )
+        if used_tokens + turn_tokens > budget:
+            break
+        used_tokens += turn_tokens
+        kept.append(turn)
+    kept.reverse()
+
+    dropped = turns[: len(turns) - len(kept)]
+    if summaries:
+        folded = set(state.folded_turns)
+        unfolded = [turn for turn in dropped if turn_fingerprint(turn) not in folded]
+        summary_store.schedule_fold(chat_id, unfolded)
+
+    messages = list(head)
+    for turn in kept:
+        messages.append({"role": "user", "content": turn.query})
+        messages.append({"role": "assistant", "content": turn.response})
+    messages.append(query_message)
+
+    logger.info(
+        f"Context for {chat_id}: {len(kept)}/{len(turns)} turns, {used_tokens}/{budget} tokens"
+    )
+    return messages
+
+
+def guardrail_window(
+    formatted_chat_history: List[Dict[str, str]],
+    token_budget: int = config.GUARDRAIL_CONTEXT_TOKENS,
+    model: str = config.OPENAI_GUARDRAIL_MODEL,
+) -> List[Dict[str, str]]:
+    """The last user turn and as much of the conversation before it as fits in
+    `token_budget`, without system messages, the guardrail has its own."""
+    messages = [m for m in formatted_chat_history if m.get("role") != "system"]
+    window = []
+    used_tokens = 0
+    for message in reversed(messages):
+        message_tokens = count_message_tokens([message], model)
+        if window and used_tokens + message_tokens > token_budget:
+            break
+        used_tokens += message_tokens
+        window.append(message)
+    window.reverse()
+    # Never start the window with an assistant message
+    while len(window) > 1 and window[0]["role"] != "user":
+        window.pop(0)
+    return window
@@ -0,0 +1,101 @@
+import base64
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from sqlalchemy import select, desc, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.models.message import Message
+from src.utils.tokens import count_tokens
+from src import config
+
+
+def history_window_statement(chat_id: str, turns: int):
+    """Newest first, so the database can stop after `turns` rows of a backward
+    scan of the `(chat_id, is_deleted, created_at, id)` index."""
+    return (
+        select(Message)
+        .filter(Message.chat_id == chat_id, Message.is_deleted.is_(False))
+        .order_by(desc(Message.created_at), desc(Message.id))
+        .limit(turns)
+    )
+
+
+def apply_token_budget(messages: List[Message], token_budget: int) -> List[Message]:
+    """Keep the most recent messages that fit in `token_budget`, oldest first.
+
+    `messages` must be ordered newest first."""
+    window = []
+    used_tokens = 0
+    for message in messages:
+        used_tokens += count_tokens(message.query) + count_tokens(message.response)
+        if used_tokens > token_budget and window:
+            break
+        window.append(message)
+    window.reverse()
+    return window
+
+
+async def fetch_history_window(
+    db: AsyncSession,
+    chat_id: str,
+    turns: int = config.HISTORY_TURNS,
+    token_budget: int = config.HISTORY_TOKEN_BUDGET,
+) -> List[Message]:
+    """Fetch the latest `turns` messages of a chat that fit in `token_budget`,
+    in chronological order."""
+    result = await db.execute(statement=history_window_statement(chat_id, turns))
+    return apply_token_budget(result.scalars().all(), token_budget)
+
+
+def encode_cursor(message: Message) -> str:
+    raw = f"{message.created_at.isoformat()}|{message.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, str]:
+    """Raises `ValueError` for a cursor that was not made by `encode_cursor`."""
+    try:
+        created_at, message_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+        return datetime.fromisoformat(created_at), message_id
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+def message_page_statement(
+    chat_id: str, limit: int, cursor: Optional[str] = None, newest_first: bool = False
+):
+    """One keyset page of a chat's messages after `cursor`, ordered on
+    `(created_at, id)`. It starts with an index seek at any depth, unlike
+    OFFSET which reads and discards every row before the page."""
+    statement = select(Message).filter(
+        Message.chat_id == chat_id, Message.is_deleted.is_(False)
+    )
+    position = tuple_(Message.created_at, Message.id)
+    if cursor is not None:
+        created_at, message_id = decode_cursor(cursor)
+        if newest_first:
+            statement = statement.filter(position < tuple_(created_at, message_id))
+        else:
+            statement = statement.filter(position > tuple_(created_at, message_id))
+    if newest_first:
+        statement = statement.order_by(desc(Message.created_at), desc(Message.id))
+    else:
+        statement = statement.order_by(Message.created_at, Message.id)
+    return statement.limit(limit)
+
+
+async def fetch_message_page(
+    db: AsyncSession,
+    chat_id: str,
+    limit: int,
+    cursor: Optional[str] = None,
+    newest_first: bool = False,
+) -> Tuple[List[Message], Optional[str]]:
+    """A page of messages and the cursor of the next one, None on the last page."""
+    result = await db.execute(
+        statement=message_page_statement(chat_id, limit + 1, cursor, newest_first)
+    )
+    messages = result.scalars().all()
+    next_cursor = encode_cursor(messages[limit - 1]) if len(messages) > limit else None
+    return messages[:limit], next_cursor
@@ -0,0 +1,471 @@
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Deque, Dict, Optional
+
+import httpx
+import openai
+from agents import OpenAIResponsesModel, set_tracing_disabled
+from openai import AsyncOpenAI, OpenAI
+
+from src.utils.metrics import LLM_QUEUE_SECONDS, LLM_RETRIES, Gauge, registry
+from src.utils.resources import resources
+from src import config
+from src import logging
+
+logger = logging.getLogger(__name__)
+
+set_tracing_disabled(disabled=True)
+
+
+class LLMDeadlineExceeded(TimeoutError):
+    """A model call did not get a slot, or an answer, before its deadline."""
+
+
+class _AsyncWaiter:
+    def __init__(self, limit: "ConcurrencyLimit"):
+        self.limit = limit
+        self.loop = asyncio.get_running_loop()
+        self.future = self.loop.create_future()
+
+    def grant(self) -> None:
+        self.loop.call_soon_threadsafe(self._set)
+
+    def _set(self) -> None:
+        # Gave up in the meantime, the slot goes to the next one
+        if self.future.done():
+            self.limit.release()
+        else:
+            self.future.set_result(None)
+
+
+class _SyncWaiter:
+    def __init__(self):
+        self.event = threading.Event()
+
+    def grant(self) -> None:
+        self.event.set()
+
+
+class ConcurrencyLimit:
+    """At most `limit` holders at a time, the others wait first come first
+    served. Thread safe and not bound to an event loop, the Celery pool
+    threads and their loops share one per process."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self._waiters: Deque[Any] = deque()
+        self._lock = threading.Lock()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def _try_acquire(self) -> bool:
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return True
+        return False
+
+    async def acquire(self, timeout: float) -> None:
+        with self._lock:
+            if self._try_acquire():
+                return
+            waiter = _AsyncWaiter(self)
+            self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), max(timeout, 0))
+        except BaseException:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    waiter.future.cancel()
+                    granted = False
+                else:
+                    granted = True
+            if granted:
+                # Granted, `_set` releases it if it has not run yet
+                if not waiter.future.done():
+                    waiter.future.cancel()
+                else:
+                    self.release()
+            raise
+
+    def acquire_sync(self, timeout: float) -> bool:
+        with self._lock:
+            if self._try_acquire():
+                return True
+            waiter = _SyncWaiter()
+            self._waiters.append(waiter)
+        if waiter.event.wait(max(timeout, 0)):
+            return True
+        with self._lock:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+                return False
+        # Granted just as the wait timed out
+        self.release()
+        return False
+
+    def release(self) -> None:
+        with self._lock:
+            if self._waiters:
+                # The slot passes to the next waiter, `active` stays the same
+                self._waiters.popleft().grant()
+                return
+            self.active -= 1
+
+
+class LLMLimits:
+    """Global and per model limits of the model calls in flight."""
+
+    def __init__(
+        self,
+        limit: int = config.LLM_CONCURRENCY,
+        model_limits: Optional[Dict[str, int]] = None,
+    ):
+        self.limit = ConcurrencyLimit(limit)
+        self.model_limits = dict(config.LLM_MODEL_CONCURRENCY if model_limits is None else model_limits)
+        self._models: Dict[str, ConcurrencyLimit] = {}
+        self._lock = threading.Lock()
+
+    def of(self, model: str) -> ConcurrencyLimit:
+        model_limit = self._models.get(model)
+        if model_limit is None:
+            with self._lock:
+                model_limit = self._models.setdefault(
+                    model, ConcurrencyLimit(self.model_limits.get(model, self.limit.limit))
+                )
+        return model_limit
+
+    def _releaser(self, model_limit: ConcurrencyLimit) -> Callable[[], None]:
+        released = False
+
+        def release() -> None:
+            nonlocal released
+            if not released:
+                released = True
+                self.limit.release()
+                model_limit.release()
+
+        return release
+
+    async def acquire(self, model: str, deadline_at: float) -> Callable[[], None]:
+        """Wait for a slot of the model, then of the process, so a model at
+        its limit does not hold slots the others could use."""
+        model_limit = self.of(model)
+        started_at = time.perf_counter()
+        try:
+            await model_limit.acquire(deadline_at - time.monotonic())
+        except asyncio.TimeoutError:
+            raise LLMDeadlineExceeded(f"No {model} slot before the deadline") from None
+        try:
+            await self.limit.acquire(deadline_at - time.monotonic())
+        except asyncio.TimeoutError:
+            model_limit.release()
+            raise LLMDeadlineExceeded("No model call slot before the deadline") from None
+        except BaseException:
+            model_limit.release()
+            raise
+        LLM_QUEUE_SECONDS.labels(model).observe(time.perf_counter() - started_at)
+        return self._releaser(model_limit)
+
+    def acquire_sync(self, model: str, deadline_at: float) -> Callable[[], None]:
+        model_limit = self.of(model)
+        started_at = time.perf_counter()
+        if not model_limit.acquire_sync(deadline_at - time.monotonic()):
+            raise LLMDeadlineExceeded(f"No {model} slot before the deadline")
+        if not self.limit.acquire_sync(deadline_at - time.monotonic()):
+            model_limit.release()
+            raise LLMDeadlineExceeded("No model call slot before the deadline")
+        LLM_QUEUE_SECONDS.labels(model).observe(time.perf_counter() - started_at)
+        return self._releaser(model_limit)
+
+    def gauges(self) -> Dict:
+        values = {}
+        for model, model_limit in list(self._models.items()):
+            values[(model, "in_flight")] = model_limit.active
+            values[(model, "queued")] = model_limit.waiting
+        return values
+
+    def snapshot(self) -> Dict:
+        return {
+            "limit": self.limit.limit,
+            "in_flight": self.limit.active,
+            "queued": self.limit.waiting,
+            "models": {
+                model: {
+                    "limit": model_limit.limit,
+                    "in_flight": model_limit.active,
+                    "queued": model_limit.waiting,
+                }
+                for model, model_limit in list(self._models.items())
+            },
+        }
+
+
+def retry_reason(error: Exception) -> Optional[str]:
+    """Metrics label of a retryable error, None for the others."""
+    if isinstance(error, openai.APITimeoutError):
+        return "timeout"
+    if isinstance(error, openai.APIConnectionError):
+        return "connection"
+    if isinstance(error, openai.APIStatusError):
+        if error.status_code == 429:
+            # An exhausted quota does not come back with a retry
+            return None if error.code == "insufficient_quota" else "rate_limit"
+        if error.status_code in (408, 409) or error.status_code >= 500:
+            return "server"
+    return None
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Seconds the API asked to wait, from `retry-after-ms` or `retry-after`."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return parsedate_to_datetime(value).timestamp() - time.time()
+    except (TypeError, ValueError):
+        return None
+
+
+class _Retrying:
+    """What the async and the sync client share: the limits and how long to
+    wait before the next attempt."""
+
+    def __init__(
+        self,
+        limits: LLMLimits,
+        timeout: float = config.LLM_TIMEOUT,
+        deadline: float = config.LLM_DEADLINE,
+        max_retries: int = config.LLM_MAX_RETRIES,
+        retry_base: float = config.LLM_RETRY_BASE,
+        retry_max: float = config.LLM_RETRY_MAX,
+    ):
+        self.limits = limits
+        self.timeout = timeout
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+
+    @staticmethod
+    def _attempt_timeout(timeout: float, deadline_at: float) -> float:
+        remaining = deadline_at - time.monotonic()
+        if remaining <= 0:
+            raise LLMDeadlineExceeded("Model call deadline passed")
+        return min(timeout, remaining)
+
+    def _backoff(self, model: str, attempt: int, error: Exception, deadline_at: float) -> Optional[float]:
+        """Seconds before the next attempt, None when the error is final."""
+        reason = retry_reason(error)
+        if reason is None or attempt >= self.max_retries:
+            return None
+        # Full jitter, the calls failed by the same burst do not retry together
+        delay = random.uniform(0, min(self.retry_max, self.retry_base * 2**attempt))
+        after = retry_after(error)
+        if after is not None:
+            # Never sooner than asked, later when the backoff has grown past it
+            delay = max(delay, min(max(after, 0), self.retry_max) + random.uniform(0, self.retry_base))
+        if time.monotonic() + delay >= deadline_at:
+            return None
+        LLM_RETRIES.labels(model, reason).inc()
+        logger.warning(f"Retrying {model} call in {delay:.2f}s after {reason}: {error}")
+        return delay
+
+
+class ManagedStream:
+    """A streamed response, its slots are held until it ends."""
+
+    def __init__(self, stream, release: Callable[[], None]):
+        self._stream = stream
+        self._release = release
+
+    async def __aiter__(self):
+        try:
+            async for event in self._stream:
+                yield event
+        finally:
+            self._release()
+
+    async def close(self) -> None:
+        try:
+            await self._stream.close()
+        finally:
+            self._release()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    def __getattr__(self, name: str):
+        return getattr(self._stream, name)
+
+
+class AsyncResponses(_Retrying):
+    def __init__(self, client: AsyncOpenAI, limits: LLMLimits, **kwargs):
+        super().__init__(limits, **kwargs)
+        self._client = client
+
+    async def create(self, *, model: str, deadline: Optional[float] = None, **kwargs):
+        """`responses.create` of the OpenAI client, queued, retried and
+        bounded by `deadline` seconds."""
+        deadline_at = time.monotonic() + (deadline or self.deadline)
+        timeout = kwargs.pop("timeout", None) or self.timeout
+        release = await self.limits.acquire(model, deadline_at)
+        try:
+            attempt = 0
+            while True:
+                kwargs["timeout"] = self._attempt_timeout(timeout, deadline_at)
+                try:
+                    response = await self._client.responses.create(model=model, **kwargs)
+                except Exception as e:
+                    delay = self._backoff(model, attempt, e, deadline_at)
+                    if delay is None:
+                        raise
+                    attempt += 1
+                    await asyncio.sleep(delay)
+                    continue
+                if kwargs.get("stream"):
+                    stream = ManagedStream(response, release)
+                    release = None
+                    return stream
+                return response
+        finally:
+            if release is not None:
+                release()
+
+
+class SyncResponses(_Retrying):
+    def __init__(self, client: OpenAI, limits: LLMLimits, **kwargs):
+        super().__init__(limits, **kwargs)
+        self._client = client
+
+    def create(self, *, model: str, deadline: Optional[float] = None, **kwargs):
+        """Blocking `AsyncResponses.create`, streams are not supported."""
+        deadline_at = time.monotonic() + (deadline or self.deadline)
+        timeout = kwargs.pop("timeout", None) or self.timeout
+        release = self.limits.acquire_sync(model, deadline_at)
+        try:
+            attempt = 0
+            while True:
+                kwargs["timeout"] = self._attempt_timeout(timeout, deadline_at)
+                try:
+                    return self._client.responses.create(model=model, **kwargs)
+                except Exception as e:
+                    delay = self._backoff(model, attempt, e, deadline_at)
+                    if delay is None:
+                        raise
+                    attempt += 1
+                    time.sleep(delay)
+        finally:
+            release()
+
+
+class LLMClient:
+    """The OpenAI client of every model call of the process, on one tuned
+    connection pool. `responses.create` waits for a concurrency slot, retries
+    and respects its deadline; the SDK's own retries are off."""
+
+    def __init__(self, client, responses):
+        self.client = client
+        self.responses = responses
+
+    async def close(self) -> None:
+        await self.client.close()
+
+    def close_sync(self) -> None:
+        self.client.close()
+
+
+llm_limits = LLMLimits()
+
+registry.register(
+    Gauge(
+        "llm_requests",
+        "Model calls in flight and queued for a slot.",
+        ["model", "state"],
+        callback=llm_limits.gauges,
+    )
+)
+
+
+def _pool_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=config.LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=config.LLM_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=config.LLM_KEEPALIVE_EXPIRY,
+    )
+
+
+def _timeout() -> httpx.Timeout:
+    return httpx.Timeout(config.LLM_TIMEOUT, connect=config.LLM_CONNECT_TIMEOUT)
+
+
+def _create_async_client() -> LLMClient:
+    client = AsyncOpenAI(
+        api_key=config.OPENAI_API_KEY,
+        base_url=config.OPENAI_BASE_URL,
+        max_retries=0,
+        timeout=_timeout(),
+        http_client=openai.DefaultAsyncHttpxClient(limits=_pool_limits(), timeout=_timeout()),
+    )
+    return LLMClient(client, AsyncResponses(client, llm_limits))
+
+
+def _create_sync_client() -> LLMClient:
+    client = OpenAI(
+        api_key=config.OPENAI_API_KEY,
+        base_url=config.OPENAI_BASE_URL,
+        max_retries=0,
+        timeout=_timeout(),
+        http_client=openai.DefaultHttpxClient(limits=_pool_limits(), timeout=_timeout()),
+    )
+    return LLMClient(client, SyncResponses(client, llm_limits))
+
+
+resources.register("openai_async", _create_async_client, close=LLMClient.close)
+resources.register("openai_sync", _create_sync_client, close=LLMClient.close_sync)
+
+
+def async_client() -> LLMClient:
+    """The process wide client, the agents share it."""
+    return resources.get("openai_async")
+
+
+def sync_client() -> LLMClient:
+    return resources.get("openai_sync")
+
+
+class LazyResponsesModel(OpenAIResponsesModel):
+    """`OpenAIResponsesModel` on the shared client, created at the first
+    model call instead of when the agent is defined."""
+
+    def __init__(self, model: str):
+        super().__init__(model=model, openai_client=None)
+
+    @property
+    def _client(self) -> LLMClient:
+        return async_client()
+
+    @_client.setter
+    def _client(self, value) -> None:
+        # Set by `OpenAIResponsesModel.__init__`, the client is always the
+        # shared one
+        pass
@@ -0,0 +1,274 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from src import config
+
+# Seconds, from a cache hit to a long agent run
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values: str):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in sorted(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+    def _render_child(self, values, child) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}"]
+
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+
+class Gauge(_Metric):
+    """A gauge set by the code, or read from `callback` at scrape time when
+    the value already lives somewhere else (queue sizes, pool stats)."""
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        callback: Optional[Callable[[], Dict[Tuple[str, ...], float]]] = None,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def _new_child(self):
+        return _Value()
+
+    @contextmanager
+    def track_in_flight(self, *values: str) -> Iterator[None]:
+        child = self.labels(*values)
+        child.inc()
+        try:
+            yield
+        finally:
+            child.dec()
+
+    def render(self) -> List[str]:
+        if self.callback is not None:
+            try:
+                for values, value in self.callback().items():
+                    self.labels(*values).set(value)
+            except Exception:
+                # A broken callback must not break the whole scrape
+                pass
+        return super().render()
+
+
+class _HistogramValue:
+    __slots__ = ("bucket_counts", "sum", "count", "upper_bounds")
+
+    def __init__(self, upper_bounds: Tuple[float, ...]):
+        self.upper_bounds = upper_bounds
+        self.bucket_counts = [0] * (len(upper_bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float) -> None:
+        self.bucket_counts[bisect.bisect_left(self.upper_bounds, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.upper_bounds = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramValue(self.upper_bounds)
+
+    def _render_child(self, values, child) -> List[str]:
+        lines = []
+        cumulative = 0
+        for upper_bound, bucket_count in zip(
+            self.upper_bounds + (float("inf"),), child.bucket_counts
+        ):
+            cumulative += bucket_count
+            labels = _format_labels(
+                self.labelnames, values, f'le="{_format_value(float(upper_bound))}"'
+            )
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, values)
+        lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+        lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+WEBHOOK_SECONDS = registry.register(
+    Histogram("tg_webhook_seconds", "Telegram webhook handling time.")
+)
+TG_UPDATES = registry.register(
+    Counter("tg_updates_total", "Telegram updates by ingestion outcome.", ["outcome"])
+)
+TG_UPDATE_SECONDS = registry.register(
+    Histogram("tg_update_seconds", "Telegram update processing time, after the ack.")
+)
+DB_QUERY_SECONDS = registry.register(
+    Histogram("db_query_seconds", "Database statement execution time.", ["engine", "operation"])
+)
+GUARDRAIL_SECONDS = registry.register(
+    Histogram("guardrail_seconds", "Guardrail verdict time by source.", ["source"])
+)
+AGENT_TTFT_SECONDS = registry.register(
+    Histogram("agent_ttft_seconds", "Time to the first answer token.", ["entry"])
+)
+AGENT_SECONDS = registry.register(
+    Histogram("agent_seconds", "Support agent or refusal run time.", ["entry", "branch"])
+)
+TG_TASK_SECONDS = registry.register(
+    Histogram("tg_task_seconds", "Telegram reply task time, from start to reply.", ["worker"])
+)
+TOOL_SECONDS = registry.register(
+    Histogram("tool_call_seconds", "Tool call duration.", ["tool"])
+)
+TELEGRAM_SEND_SECONDS = registry.register(
+    Histogram("telegram_api_seconds", "Telegram Bot API call time.", ["method"])
+)
+TOKENS = registry.register(
+    Counter("llm_tokens_total", "Tokens spent.", ["stage", "model", "kind"])
+)
+LLM_QUEUE_SECONDS = registry.register(
+    Histogram("llm_queue_seconds", "Time a model call waited for a concurrency slot.", ["model"])
+)
+LLM_RETRIES = registry.register(
+    Counter("llm_retries_total", "Retried model calls by reason.", ["model", "reason"])
+)
+SAVED_TOKENS = registry.register(
+    Counter("llm_saved_tokens_total", "Estimated tokens not spent.", ["reason"])
+)
+COALESCED_MESSAGES = registry.register(
+    Counter("tg_coalesced_messages_total", "Telegram messages merged into another turn.")
+)
+TG_WORKER_JOBS = registry.register(
+    Counter("tg_worker_jobs_total", "Async worker jobs by outcome.", ["outcome"])
+)
+ERRORS = registry.register(Counter("errors_total", "Errors by stage.", ["stage"]))
+IN_FLIGHT = registry.register(
+    Gauge("requests_in_flight", "Requests being processed.", ["entry"])
+)
+
+
+def operation_of(statement: str) -> str:
+    """SQL verb, a bounded label value unlike the statement itself."""
+    return statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "UNKNOWN"
+
+
+def instrument_engine(sync_engine, engine_name: str) -> None:
+    """Time every statement of an engine, `engine.sync_engine` for async ones."""
+    if not config.METRICS_ENABLED:
+        return
+    from sqlalchemy import event
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context._query_started_at = time.perf_counter()
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        DB_QUERY_SECONDS.labels(engine_name, operation_of(statement)).observe(
+            time.perf_counter() - context._query_started_at
+        )
+
+    @event.listens_for(sync_engine, "handle_error")
+    def handle_error(exception_context):
+        ERRORS.labels("db").inc()
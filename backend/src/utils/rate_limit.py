@@ -0,0 +1,341 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from src import config
+from src import logging
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Preferred split points, best first
+SPLIT_BOUNDARIES = ("\n\n", "\n", ". ", "! ", "? ", " ")
+
+
+class TokenBucket:
+    """Classic token bucket, `rate` tokens per second up to `capacity`.
+
+    Thread safe so the Celery workers can share one per process."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated_at) * self.rate
+        )
+        self._updated_at = now
+
+    def delay(self) -> float:
+        """Seconds until a token is available, without taking it."""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= 1:
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def reserve(self) -> float:
+        """Take a token, going into debt if needed, and return how long the
+        caller has to wait before using it."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+
+def split_message(
+    text: str,
+    limit: int = TELEGRAM_MESSAGE_LIMIT,
+    cost: Callable[[str], int] = len,
+) -> List[str]:
+    """Split `text` in chunks whose `cost` fits in `limit`.
+
+    Chunks end on a paragraph, line, sentence or word boundary, in that order
+    of preference, and never inside a ``` code block when a boundary before it
+    exists. `cost` lets the caller account for escaping added later."""
+    chunks = []
+    while text:
+        if cost(text) <= limit:
+            chunks.append(text)
+            break
+
+        # Longest prefix that fits
+        size = 0
+        end = 0
+        for char in text:
+            size += cost(char)
+            if size > limit:
+                break
+            end += 1
+
+        window = text[:end]
+        cut = 0
+        for boundary in SPLIT_BOUNDARIES:
+            index = window.rfind(boundary)
+            if index > 0:
+                cut = index + len(boundary)
+                break
+        if cut == 0:
+            cut = end
+
+        # Do not leave a code block open, cut before it starts instead
+        if window[:cut].count("```") % 2 == 1:
+            fence = window.rfind("```", 0, cut)
+            if fence > 0:
+                cut = fence
+
+        chunks.append(text[:cut].rstrip())
+        text = text[cut:].lstrip("\n ")
+    return [chunk for chunk in chunks if chunk]
+
+
+class LatencyStats:
+    """Send latency of the last `window` messages."""
+
+    def __init__(self, window: int = 1000):
+        self._samples: Deque[float] = deque(maxlen=window)
+        self.count = 0
+
+    def add(self, seconds: float) -> None:
+        self._samples.append(seconds)
+        self.count += 1
+
+    def snapshot(self) -> Dict[str, float]:
+        samples = sorted(self._samples)
+        if not samples:
+            return {"count": self.count, "avg_ms": 0, "p50_ms": 0, "p95_ms": 0, "max_ms": 0}
+        return {
+            "count": self.count,
+            "avg_ms": round(sum(samples) / len(samples) * 1000, 2),
+            "p50_ms": round(samples[len(samples) // 2] * 1000, 2),
+            "p95_ms": round(samples[int(len(samples) * 0.95) - 1] * 1000, 2),
+            "max_ms": round(samples[-1] * 1000, 2),
+        }
+
+
+class _Outgoing:
+    __slots__ = ("chat_id", "chunk", "enqueued_at", "future", "is_last")
+
+    def __init__(self, chat_id, chunk, future, is_last):
+        self.chat_id = chat_id
+        self.chunk = chunk
+        self.enqueued_at = time.monotonic()
+        self.future = future
+        self.is_last = is_last
+
+
+class SendScheduler:
+    """Outbound Telegram send queue.
+
+    Every chat has its own FIFO queue and token bucket, the dispatcher serves
+    the chats round robin and takes a token from the global bucket for every
+    send. One send per chat is in flight at a time so chunks keep their order.
+    `send` waits while more than `max_queue` chunks are queued."""
+
+    def __init__(
+        self,
+        send_fn: Callable[[Any, str], Awaitable[Any]],
+        global_rate: float = config.TELEGRAM_GLOBAL_RATE,
+        chat_rate: float = config.TELEGRAM_CHAT_RATE,
+        chat_burst: float = config.TELEGRAM_CHAT_BURST,
+        max_queue: int = config.TELEGRAM_SEND_QUEUE_SIZE,
+        max_in_flight: int = config.TELEGRAM_MAX_CONNECTIONS,
+        split: Callable[[str], List[str]] = split_message,
+    ):
+        self._send_fn = send_fn
+        self._split = split
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_queue = max_queue
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+
+        self._queues: Dict[Any, Deque[_Outgoing]] = {}
+        self._rotation: Deque[Any] = deque()
+        self._busy: set = set()
+        self._chat_buckets: OrderedDict[Any, TokenBucket] = OrderedDict()
+        self._depth = 0
+
+        self._wakeup: Optional[asyncio.Event] = None
+        self._space: Optional[asyncio.Condition] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._tasks: set = set()
+
+        self.sent = 0
+        self.failed = 0
+        self.latency = LatencyStats()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._depth
+
+    def start(self) -> None:
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._space = asyncio.Condition()
+            self._dispatcher = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """Deliver what is queued, up to `timeout` seconds, then stop."""
+        if self._dispatcher is None:
+            return
+        deadline = time.monotonic() + timeout
+        while (self._depth or self._tasks) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        self._dispatcher.cancel()
+        await asyncio.gather(self._dispatcher, return_exceptions=True)
+        self._dispatcher = None
+
+    async def send(self, chat_id: Any, text: str) -> Any:
+        """Queue `text` for `chat_id`, split if needed, and wait until every
+        chunk is delivered. Returns the Bot API result of the last chunk."""
+        self.start()
+        chunks = self._split(text) or [text]
+
+        async with self._space:
+            await self._space.wait_for(
+                lambda: self._depth == 0 or self._depth + len(chunks) <= self.max_queue
+            )
+            future = asyncio.get_running_loop().create_future()
+            queue = self._queues.get(chat_id)
+            if queue is None:
+                queue = self._queues[chat_id] = deque()
+                self._rotation.append(chat_id)
+            for index, chunk in enumerate(chunks):
+                queue.append(
+                    _Outgoing(chat_id, chunk, future, index == len(chunks) - 1)
+                )
+            self._depth += len(chunks)
+        self._wakeup.set()
+        return await future
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "queue_depth": self._depth,
+            "queued_chats": len(self._queues),
+            "in_flight": len(self._tasks),
+            "sent": self.sent,
+            "failed": self.failed,
+            "send_latency": self.latency.snapshot(),
+        }
+
+    def _chat_bucket(self, chat_id: Any) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(
+                self.chat_rate, self.chat_burst
+            )
+        self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    def _next_chat(self) -> Tuple[Optional[Any], Optional[float]]:
+        """Next chat allowed to send, or how long until one could be."""
+        min_delay = None
+        for _ in range(len(self._rotation)):
+            chat_id = self._rotation[0]
+            self._rotation.rotate(-1)
+            if chat_id in self._busy:
+                continue
+            bucket = self._chat_bucket(chat_id)
+            delay = bucket.delay()
+            if delay == 0:
+                bucket.reserve()
+                return chat_id, None
+            min_delay = delay if min_delay is None else min(min_delay, delay)
+        return None, min_delay
+
+    async def _run(self) -> None:
+        while True:
+            chat_id, delay = self._next_chat()
+            if chat_id is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await asyncio.sleep(self.global_bucket.reserve())
+            await self._in_flight.acquire()
+            item = self._queues[chat_id].popleft()
+            self._busy.add(chat_id)
+            task = asyncio.create_task(self._deliver(item))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _deliver(self, item: _Outgoing) -> None:
+        dropped = 0
+        try:
+            result = await self._send_fn(item.chat_id, item.chunk)
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Telegram send to {item.chat_id} failed: {e}")
+            if not item.future.done():
+                item.future.set_exception(e)
+            # The rest of the message would arrive with a hole in it
+            queue = self._queues[item.chat_id]
+            kept = [queued for queued in queue if queued.future is not item.future]
+            dropped = len(queue) - len(kept)
+            queue.clear()
+            queue.extend(kept)
+        else:
+            self.sent += 1
+            if item.is_last and not item.future.done():
+                item.future.set_result(result)
+        finally:
+            self.latency.add(time.monotonic() - item.enqueued_at)
+            self._in_flight.release()
+            self._busy.discard(item.chat_id)
+            if not self._queues[item.chat_id]:
+                del self._queues[item.chat_id]
+                self._rotation.remove(item.chat_id)
+            while len(self._chat_buckets) > self.max_queue:
+                self._chat_buckets.popitem(last=False)
+            async with self._space:
+                self._depth -= 1 + dropped
+                self._space.notify_all()
+            self._wakeup.set()
+
+
+class SyncSendThrottle:
+    """Blocking per chat and global rate limit for the synchronous send path.
+
+    The buckets are per process, so with several Celery processes the global
+    rate applies to each of them."""
+
+    def __init__(
+        self,
+        global_rate: float = config.TELEGRAM_GLOBAL_RATE,
+        chat_rate: float = config.TELEGRAM_CHAT_RATE,
+        chat_burst: float = config.TELEGRAM_CHAT_BURST,
+        max_chats: int = config.TELEGRAM_SEND_QUEUE_SIZE,
+    ):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_chats = max_chats
+        self._chat_buckets: OrderedDict[Any, TokenBucket] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def wait(self, chat_id: Any) -> None:
+        with self._lock:
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self._chat_buckets[chat_id] = TokenBucket(
+                    self.chat_rate, self.chat_burst
+                )
+            self._chat_buckets.move_to_end(chat_id)
+            while len(self._chat_buckets) > self.max_chats:
+                self._chat_buckets.popitem(last=False)
+        delay = max(bucket.reserve(), self.global_bucket.reserve())
+        if delay:
+            time.sleep(delay)
@@ -0,0 +1,89 @@
+import inspect
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from src import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Resources:
+    """Clients and engines created on first use instead of at import, so a
+    process builds only what it uses: the API process never the sync engine,
+    the Celery worker never the async one. Thread safe, the Celery pool
+    threads share it."""
+
+    def __init__(self):
+        self._factories: Dict[str, Callable[[], Any]] = {}
+        self._closers: Dict[str, Callable[[Any], Any]] = {}
+        self._instances: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+        self.created_ms: Dict[str, float] = {}
+
+    def register(
+        self,
+        name: str,
+        factory: Callable[[], Any],
+        close: Optional[Callable[[Any], Any]] = None,
+    ) -> None:
+        self._factories[name] = factory
+        if close is not None:
+            self._closers[name] = close
+
+    def get(self, name: str) -> Any:
+        instance = self._instances.get(name)
+        if instance is not None:
+            return instance
+        with self._lock:
+            instance = self._instances.get(name)
+            if instance is None:
+                started_at = time.perf_counter()
+                instance = self._factories[name]()
+                self._instances[name] = instance
+                self.created_ms[name] = round((time.perf_counter() - started_at) * 1000, 2)
+                logger.info(f"Created {name} in {self.created_ms[name]} ms")
+        return instance
+
+    def peek(self, name: str) -> Optional[Any]:
+        """The instance if it was created, without creating it."""
+        return self._instances.get(name)
+
+    def created(self) -> List[str]:
+        return list(self._instances)
+
+    async def aclose(self) -> None:
+        """Close what was created, the last created first."""
+        for name in reversed(list(self._instances)):
+            instance = self._instances.pop(name)
+            close = self._closers.get(name)
+            if close is None:
+                continue
+            try:
+                result = close(instance)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                logger.error(f"Closing {name} failed: {e}")
+
+    def close_sync(self) -> None:
+        """For processes without an event loop, coroutine closers are skipped."""
+        for name in reversed(list(self._instances)):
+            close = self._closers.get(name)
+            if close is None or inspect.iscoroutinefunction(close):
+                continue
+            instance = self._instances.pop(name)
+            try:
+                close(instance)
+            except Exception as e:
+                logger.error(f"Closing {name} failed: {e}")
+
+    def snapshot(self) -> Dict:
+        return {
+            "registered": sorted(self._factories),
+            "created_ms": dict(self.created_ms),
+            "open": self.created(),
+        }
+
+
+resources = Resources()
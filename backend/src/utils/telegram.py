@@ -1,30 +1,205 @@
+import asyncio
+import json
+import time
+from typing import Any, Dict, List, Optional
+
 import httpx
 
+from src.utils.markdown import (
+    escape_markdown_v2,
+    escaped_length,
+    render_entities,
+    render_markdown_v2,
+)
+from src.utils.metrics import ERRORS, TELEGRAM_SEND_SECONDS
+from src.utils.rate_limit import SendScheduler, SyncSendThrottle, split_message
 from src import config
+from src import logging
 
+logger = logging.getLogger(__name__)
 
-async def send_telegram_message(chat_id: int, text: str):
-    async with httpx.AsyncClient() as client:
-        payload = {
-            "chat_id": chat_id,
-            "text": escape_markdown_v2(text),
-            "parse_mode": "MarkdownV2",
-        }
-        await client.post(f"{config.TELEGRAM_API_BASE}/sendMessage", data=payload)
+try:
+    import h2  # noqa: F401
 
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
 
-def send_telegram_message_sync(chat_id: int, text: str):
-    with httpx.Client() as client:
-        payload = {
-            "chat_id": chat_id,
-            "text": escape_markdown_v2(text),
-            "parse_mode": "MarkdownV2",
+
+class TelegramClient:
+    """Long lived, pooled HTTP client for the Telegram Bot API.
+
+    The async and the sync clients are created on first use, `start` and
+    `close` exist so the API lifespan and the workers can create them up front
+    and release the connections on shutdown."""
+
+    def __init__(
+        self,
+        base_url: str = config.TELEGRAM_API_BASE,
+        timeout: float = config.TELEGRAM_TIMEOUT,
+        connect_timeout: float = config.TELEGRAM_CONNECT_TIMEOUT,
+        max_connections: int = config.TELEGRAM_MAX_CONNECTIONS,
+        max_keepalive_connections: int = config.TELEGRAM_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry: float = config.TELEGRAM_KEEPALIVE_EXPIRY,
+        http2: bool = config.TELEGRAM_HTTP2,
+        max_retries: int = config.TELEGRAM_MAX_RETRIES,
+        max_retry_after: float = config.TELEGRAM_MAX_RETRY_AFTER,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+        sync_transport: Optional[httpx.BaseTransport] = None,
+    ):
+        self.base_url = base_url
+        self.max_retries = max_retries
+        self.max_retry_after = max_retry_after
+        self._client_kwargs = {
+            "timeout": httpx.Timeout(timeout, connect=connect_timeout),
+            "limits": httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry,
+            ),
+            "http2": http2 and HTTP2_AVAILABLE,
         }
-        client.post(f"{config.TELEGRAM_API_BASE}/sendMessage", data=payload)
+        self._transport = transport
+        self._sync_transport = sync_transport
+        self._async_client: Optional[httpx.AsyncClient] = None
+        self._sync_client: Optional[httpx.Client] = None
+
+    @property
+    def async_client(self) -> httpx.AsyncClient:
+        if self._async_client is None or self._async_client.is_closed:
+            self._async_client = httpx.AsyncClient(
+                base_url=self.base_url, transport=self._transport, **self._client_kwargs
+            )
+        return self._async_client
+
+    @property
+    def sync_client(self) -> httpx.Client:
+        if self._sync_client is None or self._sync_client.is_closed:
+            self._sync_client = httpx.Client(
+                base_url=self.base_url,
+                transport=self._sync_transport,
+                **self._client_kwargs,
+            )
+        return self._sync_client
+
+    async def start(self) -> None:
+        self.async_client
+        logger.info(f"Telegram client started, http2: {self._client_kwargs['http2']}")
+
+    async def aclose(self) -> None:
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+
+    def start_sync(self) -> None:
+        self.sync_client
+
+    def close_sync(self) -> None:
+        if self._sync_client is not None:
+            self._sync_client.close()
+            self._sync_client = None
+
+    def _retry_after(self, response: httpx.Response, attempt: int) -> Optional[float]:
+        """Seconds to wait before retrying, None when the call should not be retried."""
+        if attempt >= self.max_retries:
+            return None
+        if response.status_code == 429:
+            try:
+                retry_after = response.json()["parameters"]["retry_after"]
+            except (ValueError, KeyError, TypeError):
+                retry_after = 1
+            return min(float(retry_after), self.max_retry_after)
+        if response.status_code >= 500:
+            return min(2**attempt * 0.5, self.max_retry_after)
+        return None
+
+    def _parse(self, method: str, response: httpx.Response) -> Dict[str, Any]:
+        data = response.json()
+        if not data.get("ok"):
+            ERRORS.labels("telegram").inc()
+            logger.error(f"Telegram {method} failed: {data.get('description')}")
+        return data
+
+    async def call(
+        self, method: str, data: Dict[str, Any], timeout: Optional[float] = None
+    ) -> Dict[str, Any]:
+        """`timeout` overrides the client timeout, for long polls."""
+        extra = {"timeout": timeout} if timeout is not None else {}
+        attempt = 0
+        started_at = time.perf_counter()
+        while True:
+            response = await self.async_client.post(f"/{method}", data=data, **extra)
+            delay = self._retry_after(response, attempt)
+            if delay is None:
+                TELEGRAM_SEND_SECONDS.labels(method).observe(time.perf_counter() - started_at)
+                return self._parse(method, response)
+            logger.info(f"Telegram {method} got {response.status_code}, retry in {delay}s")
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def call_sync(
+        self, method: str, data: Dict[str, Any], timeout: Optional[float] = None
+    ) -> Dict[str, Any]:
+        extra = {"timeout": timeout} if timeout is not None else {}
+        attempt = 0
+        started_at = time.perf_counter()
+        while True:
+            response = self.sync_client.post(f"/{method}", data=data, **extra)
+            delay = self._retry_after(response, attempt)
+            if delay is None:
+                TELEGRAM_SEND_SECONDS.labels(method).observe(time.perf_counter() - started_at)
+                return self._parse(method, response)
+            logger.info(f"Telegram {method} got {response.status_code}, retry in {delay}s")
+            time.sleep(delay)
+            attempt += 1
 
 
-def escape_markdown_v2(text: str) -> str:
-    escape_chars = r"_*[]()~`>#+-=|{}.!"
-    for char in escape_chars:
-        text = text.replace(char, f"\\{char}")
-    return text
+telegram_client = TelegramClient()
+
+
+def format_message(text: str, mode: str = config.TELEGRAM_FORMAT) -> Dict[str, Any]:
+    """`text` and `parse_mode` or `entities` fields of a message."""
+    if mode == "entities":
+        plain, entities = render_entities(text)
+        if not entities:
+            return {"text": plain}
+        return {"text": plain, "entities": json.dumps(entities)}
+    if mode == "escape":
+        return {"text": escape_markdown_v2(text), "parse_mode": "MarkdownV2"}
+    return {"text": render_markdown_v2(text), "parse_mode": "MarkdownV2"}
+
+
+def is_format_error(data: Dict[str, Any]) -> bool:
+    return not data.get("ok") and "can't parse entities" in (data.get("description") or "")
+
+
+async def send_message_chunk(chat_id: int, chunk: str) -> Dict[str, Any]:
+    data = await telegram_client.call("sendMessage", {"chat_id": chat_id, **format_message(chunk)})
+    if is_format_error(data):
+        # Better unformatted than not delivered
+        data = await telegram_client.call("sendMessage", {"chat_id": chat_id, "text": chunk})
+    return data
+
+
+def split_escaped_message(text: str) -> List[str]:
+    return split_message(text, cost=escaped_length)
+
+
+send_scheduler = SendScheduler(send_message_chunk, split=split_escaped_message)
+send_throttle = SyncSendThrottle()
+
+
+async def send_telegram_message(chat_id: int, text: str):
+    return await send_scheduler.send(chat_id, text)
+
+
+def send_telegram_message_sync(chat_id: int, text: str):
+    data = None
+    for chunk in split_escaped_message(text) or [text]:
+        send_throttle.wait(chat_id)
+        data = telegram_client.call_sync(
+            "sendMessage", {"chat_id": chat_id, **format_message(chunk)}
+        )
+        if is_format_error(data):
+            data = telegram_client.call_sync("sendMessage", {"chat_id": chat_id, "text": chunk})
+    return data
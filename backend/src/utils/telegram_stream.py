@@ -0,0 +1,135 @@
+import asyncio
+import time
+from typing import Optional
+
+from src.utils.markdown import IncrementalMarkdownV2
+from src.utils.rate_limit import TELEGRAM_MESSAGE_LIMIT
+from src.utils.telegram import (
+    format_message,
+    is_format_error,
+    send_scheduler,
+    send_telegram_message,
+    split_escaped_message,
+    telegram_client,
+)
+from src import config
+from src import logging
+
+logger = logging.getLogger(__name__)
+
+
+class TelegramStreamWriter:
+    """Show a reply while it is generated.
+
+    A placeholder message is sent first, deltas are coalesced and applied with
+    `editMessageText` at most once every `edit_interval` seconds, the lines
+    already complete formatted when the format is "markdown" and the rest as
+    plain text. `finish` applies the complete formatted reply, `fail` turns
+    the message into the error reply. When the text outgrows one Telegram
+    message the current one is frozen and a new one is started."""
+
+    def __init__(
+        self,
+        chat_id: int,
+        edit_interval: float = config.TELEGRAM_EDIT_INTERVAL,
+        placeholder: str = config.TELEGRAM_STREAM_PLACEHOLDER,
+    ):
+        self.chat_id = chat_id
+        self.edit_interval = edit_interval
+        self.placeholder = placeholder
+        self.message_id: Optional[int] = None
+        # Text already frozen in previous messages
+        self._done_text = ""
+        self._text = ""
+        self._shown_text = ""
+        self._last_edit_at = 0.0
+        self._renderer = (
+            IncrementalMarkdownV2() if config.TELEGRAM_FORMAT == "markdown" else None
+        )
+        self.edits = 0
+
+    async def start(self) -> None:
+        await self._new_message()
+
+    async def feed(self, delta: str) -> None:
+        self._text += delta
+        if self._renderer is not None:
+            self._renderer.feed(delta)
+        if len(self._text) > TELEGRAM_MESSAGE_LIMIT:
+            await self._roll_over()
+        if time.monotonic() - self._last_edit_at >= self.edit_interval:
+            await self._edit(self._text)
+
+    async def finish(self, final_text: str) -> None:
+        """Replace the streamed plain text with the formatted `final_text`."""
+        if final_text.startswith(self._done_text):
+            remaining = final_text[len(self._done_text) :]
+        else:
+            # The final output does not match the deltas, keep the frozen
+            # messages as they are
+            remaining = self._text
+        chunks = split_escaped_message(remaining.strip()) or [self.placeholder]
+
+        await self._edit(chunks[0], markdown=True)
+        for chunk in chunks[1:]:
+            await send_telegram_message(self.chat_id, chunk)
+
+    async def fail(self, text: str) -> None:
+        """Replace the message being streamed with `text`, for a reply that
+        cannot be completed. The messages already frozen are kept."""
+        if self.message_id is None:
+            await send_telegram_message(self.chat_id, text)
+            return
+        await asyncio.sleep(send_scheduler.global_bucket.reserve())
+        data = await telegram_client.call(
+            "editMessageText",
+            {"chat_id": self.chat_id, "message_id": self.message_id, "text": text},
+        )
+        if not data.get("ok"):
+            # The placeholder is gone, deleted by the user for instance
+            await send_telegram_message(self.chat_id, text)
+
+    async def _new_message(self) -> None:
+        data = await send_telegram_message(self.chat_id, self.placeholder)
+        self.message_id = data["result"]["message_id"]
+        self._shown_text = self.placeholder
+        self._last_edit_at = time.monotonic()
+
+    async def _roll_over(self) -> None:
+        chunks = split_escaped_message(self._text)
+        if len(chunks) < 2:
+            return
+        rest = self._text[len(chunks[0]) :].lstrip("\n ")
+        await self._edit(chunks[0], markdown=True)
+        self._done_text += self._text[: len(self._text) - len(rest)]
+        self._text = rest
+        if self._renderer is not None:
+            self._renderer = IncrementalMarkdownV2()
+            self._renderer.feed(rest)
+        await self._new_message()
+
+    async def _edit(self, text: str, markdown: bool = False) -> None:
+        if not text or (text == self._shown_text and not markdown):
+            return
+        payload = {"chat_id": self.chat_id, "message_id": self.message_id}
+        rendered = self._renderer.text() if self._renderer is not None and not markdown else None
+        if markdown:
+            payload.update(format_message(text))
+        elif rendered and len(rendered) <= TELEGRAM_MESSAGE_LIMIT:
+            payload["text"] = rendered
+            payload["parse_mode"] = "MarkdownV2"
+        else:
+            payload["text"] = text[:TELEGRAM_MESSAGE_LIMIT]
+        # Edits count against the bot wide limit as much as sends do
+        await asyncio.sleep(send_scheduler.global_bucket.reserve())
+        data = await telegram_client.call("editMessageText", payload)
+        if is_format_error(data):
+            payload = {
+                "chat_id": self.chat_id,
+                "message_id": self.message_id,
+                "text": text[:TELEGRAM_MESSAGE_LIMIT],
+            }
+            await telegram_client.call("editMessageText", payload)
+        self._shown_text = text
+        self._last_edit_at = time.monotonic()
+        self.edits += 1
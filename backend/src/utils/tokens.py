@@ -0,0 +1,63 @@
+import json
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+from src import config
+from src import logging
+
+logger = logging.getLogger(__name__)
+
+# Every chat message costs a few tokens on top of its content
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+@lru_cache(maxsize=8)
+def get_encoding(model: str):
+    """tiktoken encoding of `model`, None when tiktoken or its encoding file is
+    not available, in that case the counts are estimated."""
+    try:
+        import tiktoken
+
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        logger.warning(f"Falling back to estimated token counts: {e}")
+        return None
+
+
+def count_tokens(text: Optional[str], model: str = config.OPENAI_AGENT_MODEL) -> int:
+    if not text:
+        return 0
+    encoding = get_encoding(model)
+    if encoding is None:
+        # About four characters per token for English text
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(
+    messages: List[Dict[str, str]], model: str = config.OPENAI_AGENT_MODEL
+) -> int:
+    return sum(
+        count_tokens(message.get("content"), model) + MESSAGE_OVERHEAD_TOKENS
+        for message in messages
+    )
+
+
+def count_agent_prompt_tokens(agent, model: str = config.OPENAI_AGENT_MODEL) -> int:
+    """What an agent sends with every call besides the conversation: its
+    instructions and the schemas of its function tools. Hosted tools like web
+    search add a few tokens that are not counted."""
+    tokens = count_tokens(agent.instructions, model) if isinstance(agent.instructions, str) else 0
+    for tool in agent.tools:
+        schema = getattr(tool, "params_json_schema", None)
+        if schema is not None:
+            tokens += count_tokens(
+                json.dumps(
+                    {"name": tool.name, "description": tool.description, "parameters": schema}
+                ),
+                model,
+            )
+    return tokens
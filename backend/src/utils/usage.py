@@ -0,0 +1,295 @@
+import asyncio
+import threading
+import time
+from dataclasses import dataclass
+from datetime import date, timedelta
+from typing import Dict, List, Tuple
+
+from agents.usage import Usage
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert
+
+from src.database.database import AsyncSessionLocal, SessionLocal, get_engine, get_sync_engine
+from src.models.usage import UsageRollup
+from src.utils.metrics import TOKENS
+from src import config
+from src import logging
+
+logger = logging.getLogger(__name__)
+
+# (chat_id, day, model, stage)
+RollupKey = Tuple[str, date, str, str]
+
+
+def usage_cost(model: str, input_tokens: int, output_tokens: int) -> float:
+    """Cost in USD from `MODEL_PRICES`, zero for a model without a price."""
+    input_price, output_price = config.MODEL_PRICES.get(model, (0.0, 0.0))
+    return (input_tokens * input_price + output_tokens * output_price) / 1_000_000
+
+
+class UsageCollector:
+    """Token usage of one request by stage and model, the only place where
+    the usage of model responses is added up."""
+
+    def __init__(self):
+        self.stages: Dict[Tuple[str, str], Usage] = {}
+
+    def add(self, stage: str, model: str, usage: Usage) -> None:
+        if not usage.requests and not usage.total_tokens:
+            return
+        self.stages.setdefault((stage, model), Usage()).add(usage)
+
+    def add_raw_responses(self, stage: str, model: str, raw_responses: List) -> None:
+        for item in raw_responses:
+            self.add(stage, model, item.usage)
+
+    def add_response_usage(self, stage: str, model: str, response_usage) -> None:
+        """Usage of an OpenAI Responses API call or `response.completed` event."""
+        self.add(
+            stage,
+            model,
+            Usage(
+                requests=1,
+                input_tokens=response_usage.input_tokens,
+                output_tokens=response_usage.output_tokens,
+                total_tokens=response_usage.total_tokens,
+            ),
+        )
+
+    def total(self) -> Usage:
+        total = Usage()
+        for usage in self.stages.values():
+            total.add(usage)
+        return total
+
+
+@dataclass
+class RollupDelta:
+    requests: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    total_tokens: int = 0
+    cost_usd: float = 0.0
+
+    def add(self, other: "RollupDelta") -> None:
+        self.requests += other.requests
+        self.input_tokens += other.input_tokens
+        self.output_tokens += other.output_tokens
+        self.total_tokens += other.total_tokens
+        self.cost_usd += other.cost_usd
+
+
+def rollup_upsert():
+    """Upsert that adds the deltas to the existing rollups, executed with many
+    rows at once."""
+    statement = insert(UsageRollup)
+    return statement.on_conflict_do_update(
+        index_elements=["chat_id", "day", "model", "stage"],
+        set_={
+            column: getattr(UsageRollup, column) + getattr(statement.excluded, column)
+            for column in ("requests", "input_tokens", "output_tokens", "total_tokens", "cost_usd")
+        }
+        | {"updated_at": func.now()},
+    )
+
+
+class UsageLedger:
+    """In memory usage counters, flushed to `usage_rollups` every
+    `flush_interval` seconds, and the per chat daily token quota.
+
+    The daily counter of a chat is seeded from the rollups plus the usage
+    this process has not flushed, and counts this process's usage from then
+    on. Every process runs its own ledger, so the counter is seeded again
+    after `quota_refresh` seconds, which brings in what the others flushed.
+    In between the quota check is a dict lookup."""
+
+    def __init__(
+        self,
+        daily_token_quota: int = config.DAILY_TOKEN_QUOTA,
+        flush_interval: float = config.USAGE_FLUSH_INTERVAL,
+        quota_refresh: float = config.USAGE_QUOTA_REFRESH,
+    ):
+        self.daily_token_quota = daily_token_quota
+        self.flush_interval = flush_interval
+        self.quota_refresh = quota_refresh
+        self._pending: Dict[RollupKey, RollupDelta] = {}
+        self._day = date.today()
+        self._tokens_today: Dict[str, int] = {}
+        self._seeded_at: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._task = None
+        self._stopping = asyncio.Event()
+        self._last_flush = time.monotonic()
+
+    def _roll_day(self) -> date:
+        today = date.today()
+        if today != self._day:
+            self._day = today
+            self._tokens_today.clear()
+            self._seeded_at.clear()
+        return today
+
+    def _fresh(self, chat_id: str) -> bool:
+        return time.monotonic() - self._seeded_at.get(chat_id, float("-inf")) < self.quota_refresh
+
+    def record(self, chat_id: str, usage: UsageCollector) -> None:
+        with self._lock:
+            today = self._roll_day()
+            for (stage, model), stage_usage in usage.stages.items():
+                delta = RollupDelta(
+                    requests=stage_usage.requests,
+                    input_tokens=stage_usage.input_tokens,
+                    output_tokens=stage_usage.output_tokens,
+                    total_tokens=stage_usage.total_tokens,
+                    cost_usd=usage_cost(
+                        model, stage_usage.input_tokens, stage_usage.output_tokens
+                    ),
+                )
+                self._pending.setdefault((chat_id, today, model, stage), RollupDelta()).add(delta)
+                TOKENS.labels(stage, model, "input").inc(stage_usage.input_tokens)
+                TOKENS.labels(stage, model, "output").inc(stage_usage.output_tokens)
+                if chat_id in self._tokens_today:
+                    self._tokens_today[chat_id] += stage_usage.total_tokens
+
+    def pending_for(self, chat_id: str) -> Dict[RollupKey, RollupDelta]:
+        with self._lock:
+            return {key: delta for key, delta in self._pending.items() if key[0] == chat_id}
+
+    def _today_statement(self, chat_id: str, today: date):
+        return select(func.coalesce(func.sum(UsageRollup.total_tokens), 0)).filter(
+            UsageRollup.chat_id == chat_id, UsageRollup.day == today
+        )
+
+    def _seed(self, chat_id: str, stored_tokens: int, today: date) -> int:
+        with self._lock:
+            if today == self._day and not self._fresh(chat_id):
+                pending = sum(
+                    delta.total_tokens
+                    for key, delta in self._pending.items()
+                    if key[0] == chat_id and key[1] == today
+                )
+                self._tokens_today[chat_id] = stored_tokens + pending
+                self._seeded_at[chat_id] = time.monotonic()
+            return self._tokens_today.get(chat_id, stored_tokens)
+
+    async def tokens_today(self, chat_id: str) -> int:
+        today = self._roll_day()
+        if chat_id in self._tokens_today and self._fresh(chat_id):
+            return self._tokens_today[chat_id]
+        async with AsyncSessionLocal() as session:
+            stored_tokens = await session.scalar(self._today_statement(chat_id, today))
+        return self._seed(chat_id, stored_tokens, today)
+
+    def tokens_today_sync(self, chat_id: str) -> int:
+        today = self._roll_day()
+        if chat_id in self._tokens_today and self._fresh(chat_id):
+            return self._tokens_today[chat_id]
+        with SessionLocal() as session:
+            stored_tokens = session.scalar(self._today_statement(chat_id, today))
+        return self._seed(chat_id, stored_tokens, today)
+
+    async def within_quota(self, chat_id: str) -> bool:
+        if not self.daily_token_quota:
+            return True
+        return await self.tokens_today(chat_id) < self.daily_token_quota
+
+    def within_quota_sync(self, chat_id: str) -> bool:
+        if not self.daily_token_quota:
+            return True
+        return self.tokens_today_sync(chat_id) < self.daily_token_quota
+
+    def _take_pending(self) -> List[Dict]:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+        return [
+            {
+                "chat_id": chat_id,
+                "day": day,
+                "model": model,
+                "stage": stage,
+                "requests": delta.requests,
+                "input_tokens": delta.input_tokens,
+                "output_tokens": delta.output_tokens,
+                "total_tokens": delta.total_tokens,
+                "cost_usd": delta.cost_usd,
+            }
+            for (chat_id, day, model, stage), delta in pending.items()
+        ]
+
+    def _restore(self, rows: List[Dict], error: Exception) -> None:
+        logger.error(f"Usage flush of {len(rows)} rollups failed: {error}")
+        with self._lock:
+            for row in rows:
+                key = (row["chat_id"], row["day"], row["model"], row["stage"])
+                self._pending.setdefault(key, RollupDelta()).add(
+                    RollupDelta(
+                        row["requests"],
+                        row["input_tokens"],
+                        row["output_tokens"],
+                        row["total_tokens"],
+                        row["cost_usd"],
+                    )
+                )
+
+    async def flush(self) -> None:
+        rows = self._take_pending()
+        if not rows:
+            return
+        try:
+            async with get_engine().begin() as conn:
+                await conn.execute(rollup_upsert(), rows)
+        except Exception as e:
+            self._restore(rows, e)
+
+    def flush_sync(self) -> None:
+        rows = self._take_pending()
+        if not rows:
+            return
+        try:
+            with get_sync_engine().begin() as conn:
+                conn.execute(rollup_upsert(), rows)
+        except Exception as e:
+            self._restore(rows, e)
+
+    def flush_sync_if_due(self) -> None:
+        """For the Celery worker, which has no background loop."""
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush_sync()
+
+    async def start(self) -> None:
+        if self._task is not None and not self._task.done():
+            return
+        self._stopping.clear()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._stopping.set()
+        await self._task
+        self._task = None
+        await self.flush()
+
+    async def _run(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+
+usage_ledger = UsageLedger()
+
+
+async def read_rollups(chat_id: str, days: int) -> List[UsageRollup]:
+    """Rollups of the last `days` days, served by the primary key."""
+    since = date.today() - timedelta(days=days - 1)
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            select(UsageRollup)
+            .filter(UsageRollup.chat_id == chat_id, UsageRollup.day >= since)
+            .order_by(UsageRollup.day)
+        )
+        return result.scalars().all()
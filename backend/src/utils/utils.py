@@ -12,12 +12,12 @@ async def verify_api_key(api_key: str = Depends(oauth2_scheme)) -> bool:
         if config.SERVER_API_KEY == api_key:
             return True
         else:
-            HTTPException(
+            raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Invalid API key",
             )
     else:
-        HTTPException(
+        raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Provide API key",
         )
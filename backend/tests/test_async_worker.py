@@ -0,0 +1,104 @@
+import asyncio
+
+from src.tasks.async_worker import AsyncWorker, InMemoryBroker
+
+
+def run_worker(worker, jobs, until):
+    """Publish `jobs`, run `worker` until `until()` holds, then stop it."""
+
+    async def main():
+        for job in jobs:
+            await worker.broker.publish(job)
+        task = asyncio.create_task(worker.run())
+        while not until():
+            await asyncio.sleep(0.01)
+        worker.stop()
+        await task
+
+    asyncio.run(asyncio.wait_for(main(), 10))
+
+
+def test_done_job_is_acked():
+    broker = InMemoryBroker()
+    calls = []
+
+    async def handler(job, final_attempt):
+        calls.append((job, final_attempt))
+
+    worker = AsyncWorker(broker, handler=handler, max_attempts=3, retry_delay=0)
+    run_worker(worker, [{"chat_id": 1, "text": "hi"}], lambda: calls and not broker.unacked)
+
+    assert calls == [({"chat_id": 1, "text": "hi"}, False)]
+    assert broker.dead_letters == []
+
+
+def test_failed_job_is_retried():
+    broker = InMemoryBroker()
+    calls = []
+
+    async def handler(job, final_attempt):
+        calls.append((job.get("attempts", 0), final_attempt))
+        if len(calls) == 1:
+            raise RuntimeError("model unavailable")
+
+    worker = AsyncWorker(broker, handler=handler, max_attempts=3, retry_delay=0)
+    run_worker(worker, [{"chat_id": 1, "text": "hi"}], lambda: len(calls) == 2 and not broker.unacked)
+
+    assert calls == [(0, False), (1, False)]
+    assert broker.dead_letters == []
+
+
+def test_last_failure_is_dead_lettered():
+    broker = InMemoryBroker()
+    calls = []
+
+    async def handler(job, final_attempt):
+        calls.append((job.get("attempts", 0), final_attempt))
+        raise RuntimeError("model unavailable")
+
+    worker = AsyncWorker(broker, handler=handler, max_attempts=2, retry_delay=0)
+    run_worker(worker, [{"chat_id": 1, "text": "hi"}], lambda: broker.dead_letters and not broker.unacked)
+
+    assert calls == [(0, False), (1, True)]
+    assert broker.dead_letters == [
+        {"chat_id": 1, "text": "hi", "attempts": 2, "error": "model unavailable"}
+    ]
+
+
+def test_in_flight_is_limited():
+    broker = InMemoryBroker()
+    running = []
+    peak = 0
+    done = []
+
+    async def handler(job, final_attempt):
+        nonlocal peak
+        running.append(job)
+        peak = max(peak, len(running))
+        await asyncio.sleep(0.02)
+        running.remove(job)
+        done.append(job)
+
+    worker = AsyncWorker(broker, max_in_flight=3, handler=handler)
+    jobs = [{"chat_id": chat_id, "text": "hi"} for chat_id in range(10)]
+    run_worker(worker, jobs, lambda: len(done) == 10 and not broker.unacked)
+
+    assert peak == 3
+
+
+def test_cancelled_job_gives_its_slot_back():
+    broker = InMemoryBroker()
+    done = []
+
+    async def handler(job, final_attempt):
+        if job["chat_id"] == 0:
+            raise asyncio.CancelledError
+        done.append(job)
+
+    worker = AsyncWorker(broker, max_in_flight=1, handler=handler)
+    jobs = [{"chat_id": chat_id, "text": "hi"} for chat_id in range(3)]
+    run_worker(worker, jobs, lambda: len(done) == 2)
+
+    assert [job["chat_id"] for job in done] == [1, 2]
+    # Not acked, a Redis broker queues it again once the lease expires
+    assert broker.unacked == 1
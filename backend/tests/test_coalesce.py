@@ -0,0 +1,57 @@
+import asyncio
+import time
+
+from src.tasks.coalesce import (
+    InMemoryChatMailbox,
+    TurnResult,
+    mailbox_entry,
+    run_chat_mailbox_sync,
+)
+
+
+class SyncMailbox(InMemoryChatMailbox):
+    """The sync methods of `RedisChatMailbox` over the in memory mailbox."""
+
+    def peek_sync(self, chat_id):
+        return asyncio.run(self.peek(chat_id))
+
+    def drain_sync(self, chat_id):
+        return asyncio.run(self.drain(chat_id))
+
+    def acquire_sync(self, chat_id, ttl):
+        return asyncio.run(self.acquire(chat_id, ttl))
+
+    def renew_sync(self, chat_id, token, ttl):
+        return asyncio.run(self.renew(chat_id, token, ttl))
+
+    def release_sync(self, chat_id, token):
+        asyncio.run(self.release(chat_id, token))
+
+
+def test_debounce_is_rescheduled_holding_the_lease():
+    mailbox = SyncMailbox()
+    asyncio.run(mailbox.push("1", mailbox_entry("hi", [{"role": "user", "content": "hi"}])))
+    asyncio.run(mailbox.push("1", mailbox_entry("there", [{"role": "user", "content": "there"}])))
+    handled, scheduled = [], []
+
+    def handler(**job):
+        handled.append(job)
+        return TurnResult("reply", 10)
+
+    started_at = time.monotonic()
+    run_chat_mailbox_sync(1, handler, lambda delay, state: scheduled.append((delay, state)), mailbox)
+
+    assert time.monotonic() - started_at < 0.5
+    assert not handled
+    delay, state = scheduled[0]
+    assert 0 < delay <= 1.0
+    # Another job finds the lease taken
+    assert mailbox.acquire_sync("1", 60) is None
+
+    for entry in mailbox._entries["1"]:
+        entry["at"] -= delay
+    run_chat_mailbox_sync(1, handler, scheduled.append, mailbox, **state)
+
+    assert [job["text"] for job in handled] == ["hi\nthere"]
+    assert len(scheduled) == 1
+    assert mailbox.acquire_sync("1", 60) is not None
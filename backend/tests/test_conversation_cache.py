@@ -0,0 +1,46 @@
+from types import SimpleNamespace
+
+from src.cache.conversation import ConversationCache, Turn
+
+
+def user(is_verified):
+    return SimpleNamespace(is_verified=is_verified, first_name="Ada", age=30, gender="Other")
+
+
+def message(query, response):
+    return SimpleNamespace(query=query, response=response)
+
+
+def test_only_verified_users_are_cached():
+    cache = ConversationCache()
+    state = cache.put_user("1", user(False))
+
+    assert not state.is_verified
+    assert cache.get("1") is None
+
+    cache.put_user("1", user(True))
+    assert cache.get("1").user_info["name"] == "Ada"
+
+
+def test_turns_come_from_the_database():
+    cache = ConversationCache()
+    cache.put_user("1", user(True))
+    written_elsewhere = [message("q1", "r1"), message("q2", "r2")]
+
+    assert cache.with_recent_turns("1", written_elsewhere) == [Turn("q1", "r1"), Turn("q2", "r2")]
+
+
+def test_unflushed_turns_are_added_once():
+    cache = ConversationCache()
+    cache.append_turn("1", "q2", "r2")
+
+    assert cache.with_recent_turns("1", [message("q1", "r1")]) == [Turn("q1", "r1"), Turn("q2", "r2")]
+    flushed = [message("q1", "r1"), message("q2", "r2")]
+    assert cache.with_recent_turns("1", flushed) == [Turn("q1", "r1"), Turn("q2", "r2")]
+
+
+def test_recent_turns_expire():
+    cache = ConversationCache(recent_ttl=0)
+    cache.append_turn("1", "q2", "r2")
+
+    assert cache.with_recent_turns("1", []) == []
@@ -0,0 +1,33 @@
+import pytest
+
+from src.utils.markdown import render_entities, render_markdown_v2
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("**a** and **b**", "*a* and *b*"),
+        ("__a__ and __b__", "*a* and *b*"),
+        ("~~x~~ and ~~y~~", "~x~ and ~y~"),
+        ("*a* and *b*", "_a_ and _b_"),
+        ("_a_ and _b_", "_a_ and _b_"),
+        ("**bold text** and **more**", "*bold text* and *more*"),
+        ("**a**", "*a*"),
+    ],
+)
+def test_adjacent_and_one_character_spans(text, expected):
+    assert render_markdown_v2(text) == expected
+
+
+def test_adjacent_spans_are_separate_entities():
+    text, entities = render_entities("**a** and **b**")
+
+    assert text == "a and b"
+    assert entities == [
+        {"type": "bold", "offset": 0, "length": 1},
+        {"type": "bold", "offset": 6, "length": 1},
+    ]
+
+
+def test_unclosed_marker_is_escaped():
+    assert render_markdown_v2("2 * 3 = 6.") == "2 \\* 3 \\= 6\\."
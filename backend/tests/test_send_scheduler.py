@@ -0,0 +1,31 @@
+import asyncio
+
+import pytest
+
+from src.utils.rate_limit import SendScheduler
+
+
+def test_failed_chunk_drops_the_rest_of_its_message():
+    sent = []
+
+    async def send_fn(chat_id, chunk):
+        if chunk == "b":
+            raise RuntimeError("Bad Request")
+        sent.append(chunk)
+        return {"ok": True}
+
+    async def main():
+        scheduler = SendScheduler(
+            send_fn, global_rate=1000, chat_rate=1000, chat_burst=1000, split=list
+        )
+        with pytest.raises(RuntimeError):
+            await scheduler.send(1, "abcd")
+        await scheduler.send(1, "xy")
+        await scheduler.stop()
+        return scheduler
+
+    scheduler = asyncio.run(asyncio.wait_for(main(), 10))
+
+    assert sent == ["a", "x", "y"]
+    assert scheduler.queue_depth == 0
+    assert scheduler.failed == 1
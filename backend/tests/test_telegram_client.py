@@ -0,0 +1,91 @@
+import asyncio
+
+import httpcore
+import httpx
+
+from src.utils.telegram import TelegramClient
+
+SENDS = 1000
+OK_RESPONSE = (
+    b"HTTP/1.1 200 OK\r\n"
+    b"Content-Type: application/json\r\n"
+    b"Content-Length: 42\r\n"
+    b"\r\n"
+    b'{"ok": true, "result": {"message_id": 1}}\n'
+)
+
+
+class CountingBackend(httpcore.AsyncMockBackend):
+    """Every connection replays `buffer`, one chunk per read."""
+
+    def __init__(self, buffer):
+        super().__init__(buffer)
+        self.connections = 0
+
+    async def connect_tcp(self, *args, **kwargs):
+        self.connections += 1
+        return await super().connect_tcp(*args, **kwargs)
+
+
+class SyncCountingBackend(httpcore.MockBackend):
+    def __init__(self, buffer):
+        super().__init__(buffer)
+        self.connections = 0
+
+    def connect_tcp(self, *args, **kwargs):
+        self.connections += 1
+        return super().connect_tcp(*args, **kwargs)
+
+
+def test_sends_reuse_one_connection():
+    backend = CountingBackend([OK_RESPONSE] * SENDS)
+    transport = httpx.AsyncHTTPTransport()
+    # The real connection pool over the mock network
+    transport._pool = httpcore.AsyncConnectionPool(network_backend=backend)
+    client = TelegramClient(base_url="http://telegram.test/botTEST", transport=transport)
+
+    async def main():
+        for i in range(SENDS):
+            data = await client.call("sendMessage", {"chat_id": 1, "text": f"reply {i}"})
+            assert data["ok"]
+        await client.aclose()
+
+    asyncio.run(main())
+
+    assert backend.connections == 1
+
+
+def test_sync_sends_reuse_one_connection():
+    backend = SyncCountingBackend([OK_RESPONSE] * SENDS)
+    transport = httpx.HTTPTransport()
+    transport._pool = httpcore.ConnectionPool(network_backend=backend)
+    client = TelegramClient(base_url="http://telegram.test/botTEST", sync_transport=transport)
+
+    for i in range(SENDS):
+        assert client.call_sync("sendMessage", {"chat_id": 1, "text": f"reply {i}"})["ok"]
+    client.close_sync()
+
+    assert backend.connections == 1
+
+
+def test_retry_after_is_honoured():
+    responses = [
+        httpx.Response(429, json={"ok": False, "parameters": {"retry_after": 7}}),
+        httpx.Response(200, json={"ok": True, "result": {"message_id": 1}}),
+    ]
+    requests = []
+
+    def handler(request):
+        requests.append(request.url.path)
+        return responses[len(requests) - 1]
+
+    client = TelegramClient(
+        base_url="http://telegram.test/botTEST",
+        sync_transport=httpx.MockTransport(handler),
+        max_retry_after=0,
+    )
+
+    assert client._retry_after(responses[0], 0) == 0
+    assert client.call_sync("sendMessage", {"chat_id": 1, "text": "hi"})["ok"]
+    assert requests == ["/botTEST/sendMessage", "/botTEST/sendMessage"]
+    assert TelegramClient(max_retry_after=30)._retry_after(responses[0], 0) == 7
@@ -0,0 +1,47 @@
+import asyncio
+
+from src.utils import telegram_stream
+from src.utils.telegram_stream import TelegramStreamWriter
+
+
+class FakeBotApi:
+    def __init__(self, edit_ok=True):
+        self.edit_ok = edit_ok
+        self.sent = []
+        self.edits = []
+
+    async def send(self, chat_id, text):
+        self.sent.append(text)
+        return {"ok": True, "result": {"message_id": len(self.sent)}}
+
+    async def call(self, method, payload):
+        self.edits.append((payload["message_id"], payload["text"]))
+        return {"ok": self.edit_ok}
+
+
+def stream_and_fail(monkeypatch, bot):
+    monkeypatch.setattr(telegram_stream, "send_telegram_message", bot.send)
+    monkeypatch.setattr(telegram_stream.telegram_client, "call", bot.call)
+
+    async def main():
+        writer = TelegramStreamWriter(1, edit_interval=0, placeholder="…")
+        await writer.start()
+        await writer.feed("Breathing slowly can")
+        await writer.fail("Something went wrong")
+
+    asyncio.run(main())
+
+
+def test_fail_edits_the_placeholder(monkeypatch):
+    bot = FakeBotApi()
+    stream_and_fail(monkeypatch, bot)
+
+    assert bot.sent == ["…"]
+    assert bot.edits[-1] == (1, "Something went wrong")
+
+
+def test_fail_sends_when_the_placeholder_is_gone(monkeypatch):
+    bot = FakeBotApi(edit_ok=False)
+    stream_and_fail(monkeypatch, bot)
+
+    assert bot.sent == ["…", "Something went wrong"]
@@ -0,0 +1,26 @@
+from datetime import date
+
+from agents.usage import Usage
+
+from src.utils.usage import UsageCollector, UsageLedger
+
+
+def collector(total_tokens: int) -> UsageCollector:
+    usage = UsageCollector()
+    usage.add("agent", "gpt-4o-mini", Usage(requests=1, total_tokens=total_tokens))
+    return usage
+
+
+def test_quota_counter_is_seeded_again_with_other_processes_usage():
+    ledger = UsageLedger(daily_token_quota=100, quota_refresh=60)
+    today = date.today()
+    assert ledger._seed("1", 10, today) == 10
+    ledger.record("1", collector(5))
+    # Fresh, the rollups are not read again
+    assert ledger._seed("1", 50, today) == 15
+
+    ledger._seeded_at["1"] -= 61
+    # The rollups now hold what the other processes flushed, plus the
+    # usage this process has not flushed yet
+    assert ledger._seed("1", 90, today) == 95
+    assert ledger.tokens_today_sync("1") == 95
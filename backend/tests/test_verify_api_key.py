@@ -0,0 +1,40 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from src import config
+from src.utils.utils import verify_api_key
+
+
+def test_wrong_or_missing_key_is_rejected(monkeypatch):
+    monkeypatch.setattr(config, "SERVER_API_KEY", "secret")
+
+    assert asyncio.run(verify_api_key("secret"))
+    for api_key in ("wrong", ""):
+        with pytest.raises(HTTPException) as error:
+            asyncio.run(verify_api_key(api_key))
+        assert error.value.status_code == 401
+
+
+def test_stats_endpoints_need_the_key(monkeypatch):
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+
+    from src.routes.health import router as health_router
+    from src.routes.metrics import router as metrics_router
+
+    monkeypatch.setattr(config, "SERVER_API_KEY", "secret")
+    app = FastAPI()
+    app.include_router(health_router)
+    app.include_router(metrics_router)
+    client = TestClient(app)
+    prefix = f"/api/{config.API_VERSION}"
+
+    assert client.get(f"{prefix}/health").status_code == 200
+    for path in ("/cache", "/message-writer", "/db/pool", "/resources", "/llm"):
+        assert client.get(prefix + path).status_code == 401
+    assert client.get("/metrics").status_code == 401
+    headers = {"Authorization": "Bearer secret"}
+    assert client.get(f"{prefix}/llm", headers=headers).status_code == 200
+    assert client.get("/metrics", headers=headers).status_code == 200
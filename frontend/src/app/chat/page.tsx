@@ -23,6 +23,18 @@ type Message = {
     tools?: ToolExecution[]
 }
 
+// One conversation, and one quota, per browser
+const CLIENT_ID_KEY = "chat_user_id"
+
+function getClientId(): string {
+    let clientId = localStorage.getItem(CLIENT_ID_KEY)
+    if (!clientId) {
+        clientId = crypto.randomUUID()
+        localStorage.setItem(CLIENT_ID_KEY, clientId)
+    }
+    return clientId
+}
+
 export default function Home() {
     const [messages, setMessages] = useState<Message[]>([
         { id: 1, text: "Hello! How can I help you today?", sender: "assistant" }
@@ -75,7 +87,7 @@ export default function Home() {
             const requestBody = {
                 query: userMessage,
                 chat_history: chatHistory,
-                user_id: "abcd-efgh-ijkl-mnop"
+                user_id: getClientId()
             }
 
             const response = await fetch(`${env.NEXT_PUBLIC_SERVER_URL}/api/v0/agent/chat`, {